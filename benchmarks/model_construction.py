@@ -0,0 +1,120 @@
+"""
+    How many Message(event, room) objects per second we can build, with and without validation.
+
+    "strict" is the default, every model goes through pydantic validation. "trusted" is
+    configure_security(trusted=True), models are built without it. Each is run with Message and LazyMessage,
+    building the message and reading message.content.body like a typical handler does. Room building for one
+    big room is timed the same way. Models are built from the classes compiled for the mode, like a Client does.
+    A LazyRoom build is mostly indexing the state events, which is the same work in both modes, so its two
+    numbers should come out close.
+
+    python benchmarks/model_construction.py --messages 50000 --runs 5
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+
+#run straight from a checkout, without installing halcyon
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from halcyon.message import Message, LazyMessage
+from halcyon.room import Room, LazyRoom
+from halcyon.security import configure_security, get_security_snapshot
+
+
+def textEvent(n):
+    return {
+        "type": "m.room.message",
+        "sender": "@user" + str(n % 10) + ":matrix.org",
+        "event_id": "$event" + str(n),
+        "origin_server_ts": 1700000000000 + n,
+        "content": {"msgtype": "m.text", "body": "Message number " + str(n), "format": "org.matrix.custom.html",
+                    "formatted_body": "<p>Message number " + str(n) + "</p>"},
+        "unsigned": {"age": 1234},
+    }
+
+
+def imageEvent(n):
+    return {
+        "type": "m.room.message",
+        "sender": "@user" + str(n % 10) + ":matrix.org",
+        "event_id": "$image" + str(n),
+        "origin_server_ts": 1700000000000 + n,
+        "content": {"msgtype": "m.image", "body": "image" + str(n) + ".jpg", "url": "mxc://matrix.org/abc" + str(n),
+                    "info": {"size": 2534288, "mimetype": "image/jpeg", "w": 3024, "h": 4032,
+                             "thumbnail_url": "mxc://matrix.org/thumb" + str(n),
+                             "thumbnail_info": {"w": 300, "h": 300, "mimetype": "image/jpeg", "size": 46144}},
+                    "m.relates_to": {"m.in_reply_to": {"event_id": "$event" + str(n - 1)}}},
+    }
+
+
+def roomState(members):
+    state = [
+        {"type": "m.room.create", "state_key": "", "content": {"creator": "@user0:matrix.org", "room_version": "10"}},
+        {"type": "m.room.name", "state_key": "", "content": {"name": "Benchmark room"}},
+        {"type": "m.room.power_levels", "state_key": "", "content": {"users": {"@user0:matrix.org": 100}, "users_default": 0}},
+    ]
+    state += [{
+        "type": "m.room.member",
+        "state_key": "@user" + str(m) + ":matrix.org",
+        "content": {"membership": "join", "displayname": "User " + str(m), "avatar_url": "mxc://matrix.org/abc" + str(m)},
+    } for m in range(members)]
+    return state
+
+
+def best(runs, fn):
+    # A collection landing in one mode's runs and not the other's is bigger than the gap being measured
+    times = []
+    for _ in range(runs):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+        finally:
+            gc.enable()
+    return min(times)
+
+
+def buildMessages(messageClass, events, room):
+    def run():
+        for event in events:
+            messageClass(event, room).content.body
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Message and Room construction, validated and trusted")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--members", type=int, default=5000, help="members in the room benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    room = Room(roomState(10), "!bench:matrix.org")
+    texts = [textEvent(n) for n in range(args.messages)]
+    images = [imageEvent(n) for n in range(args.messages)]
+    state = roomState(args.members)
+    print(str(args.messages) + " messages, " + str(args.members) + " member room, best of " + str(args.runs))
+    print()
+    print("{:<10} {:<14} {:>14} {:>14} {:>14}".format("mode", "model", "text msg/s", "image msg/s", "room ms"))
+
+    try:
+        for mode, trusted in (("strict", False), ("trusted", True)):
+            configure_security("strict", trusted=trusted)
+            snapshot = get_security_snapshot()
+            for messageClass, roomClass in ((Message, Room), (LazyMessage, LazyRoom)):
+                messageClass, roomClass = messageClass.variant(snapshot), roomClass.variant(snapshot)
+                text = best(args.runs, buildMessages(messageClass, texts, room))
+                image = best(args.runs, buildMessages(messageClass, images, room))
+                built = best(args.runs, lambda: roomClass(state, "!big:matrix.org").name)
+                print("{:<10} {:<14} {:>14,.0f} {:>14,.0f} {:>14.2f}".format(
+                    mode, messageClass.__name__, args.messages / text, args.messages / image, built * 1000))
+    finally:
+        configure_security("strict")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+    How long each json codec takes to decode a /sync response, in ms per MB.
+
+    Builds a fake initial sync (lots of joined rooms, each with state and a timeline) and decodes it with every
+    codec installed here, both whole (resp.json()) and with the streaming decoder (streamSync=True).
+
+    python benchmarks/sync_decode.py --rooms 2000 --runs 5
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+#run straight from a checkout, without installing halcyon
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from halcyon.codec import getCodec, available
+from halcyon.syncstream import decodeSyncStream
+
+
+def fakeSync(rooms, eventsPerRoom):
+    join = {}
+    for r in range(rooms):
+        roomID = "!room" + str(r) + ":matrix.org"
+        state = [{
+            "type": "m.room.member",
+            "state_key": "@user" + str(m) + ":matrix.org",
+            "sender": "@user" + str(m) + ":matrix.org",
+            "event_id": "$member" + str(r) + "_" + str(m),
+            "origin_server_ts": 1700000000000 + m,
+            "content": {"membership": "join", "displayname": "User " + str(m) + " ✨", "avatar_url": "mxc://matrix.org/abc" + str(m)},
+        } for m in range(10)]
+        timeline = [{
+            "type": "m.room.message",
+            "sender": "@user" + str(e % 10) + ":matrix.org",
+            "event_id": "$event" + str(r) + "_" + str(e),
+            "origin_server_ts": 1700000000000 + e,
+            "content": {"msgtype": "m.text", "body": "Message number " + str(e) + " with some \"quoted\" text and ünïcödé"},
+            "unsigned": {"age": 1234},
+        } for e in range(eventsPerRoom)]
+        join[roomID] = {
+            "state": {"events": state},
+            "timeline": {"events": timeline, "limited": False, "prev_batch": "p" + str(r)},
+            "ephemeral": {"events": []},
+            "account_data": {"events": []},
+            "unread_notifications": {"highlight_count": 0, "notification_count": r % 5},
+        }
+    return {"next_batch": "s1_2_3", "rooms": {"join": join, "invite": {}, "leave": {}}, "presence": {"events": []}}
+
+
+def best(runs, fn):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark /sync decoding per json codec")
+    parser.add_argument("--rooms", type=int, default=1000)
+    parser.add_argument("--events", type=int, default=20, help="timeline events per room")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--chunk", type=int, default=65536, help="chunk size for the streaming decoder")
+    args = parser.parse_args()
+
+    body = json.dumps(fakeSync(args.rooms, args.events), ensure_ascii=False).encode("utf-8")
+    megabytes = len(body) / (1024 * 1024)
+    chunks = [body[i:i + args.chunk] for i in range(0, len(body), args.chunk)]
+    print("Sync body: " + str(round(megabytes, 2)) + " MB, " + str(args.rooms) + " rooms, best of " + str(args.runs))
+    print()
+    print("{:<10} {:>16} {:>16}".format("codec", "whole ms/MB", "streamed ms/MB"))
+
+    for name in available():
+        codec = getCodec(name)
+        whole = best(args.runs, lambda: codec.loads(body))
+        streamed = best(args.runs, lambda: decodeSyncStream(chunks, codec.loads))
+        print("{:<10} {:>16.2f} {:>16.2f}".format(name, whole * 1000 / megabytes, streamed * 1000 / megabytes))
+
+
+if __name__ == "__main__":
+    main()
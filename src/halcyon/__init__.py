@@ -1,3 +1,12 @@
 from .halcyon import *
 from .restrunner import *
-from .security import configure_security, get_security_mode, get_custom_security_settings
\ No newline at end of file
+from .dispatch import SequentialDispatcher, ConcurrentDispatcher, RoomLaneDispatcher
+from .filters import SyncFilter
+from .checkpoint import CheckpointStore, FileCheckpointStore, SQLiteCheckpointStore
+from .security import configure_security, get_security_mode, get_custom_security_settings, is_trusted, get_security_snapshot, SecuritySnapshot
+from .pool import ConnectionPool, ConnectionPoolConfig
+from .ratelimit import OutboundScheduler, RateLimited
+from .outbox import Outbox, OutboxStore, FileOutboxStore, SQLiteOutboxStore
+from .codec import getCodec
+from .roomcache import RoomCache
+from .snapshot import RoomSnapshotStore, FileRoomSnapshotStore, SQLiteRoomSnapshotStore
@@ -0,0 +1,102 @@
+"""
+    Compiled m.room.server_acl matching.
+
+    ServerAclMatcher turns the allow and deny globs of one ACL event into a single regex each, and remembers the
+    answer for every server it has been asked about, so checking the server of every sender is a dict lookup
+    instead of an fnmatch loop over every pattern. The rules follow the spec: the port is ignored, IP literals
+    are denied when allow_ip_literals is false, deny wins over allow, and a server has to match allow to get in.
+"""
+
+import ipaddress
+import re
+
+
+# Servers remembered per ACL before the cache starts over
+MAX_CACHED_SERVERS = 10000
+
+
+def globToRegex(glob):
+    """
+        @param glob str a server ACL glob, * matches any run of characters and ? one character
+
+        @return str the regex for it
+    """
+    return "".join(".*" if char == "*" else "." if char == "?" else re.escape(char) for char in glob)
+
+
+def _compile(globs):
+    globs = [glob for glob in globs or () if isinstance(glob, str)]
+    if not globs:
+        return None
+    return re.compile("|".join("(?:" + globToRegex(glob) + ")" for glob in globs), re.IGNORECASE | re.DOTALL)
+
+
+def serverHost(server):
+    """
+        @param server str a server name, maybe with a port
+
+        @return str the server name without the port, IPv6 literals keep their brackets
+    """
+    if server.startswith("["):
+        end = server.find("]")
+        return server[:end + 1] if end != -1 else server
+    return server.rsplit(":", 1)[0]
+
+
+def isIPLiteral(host):
+    try:
+        ipaddress.ip_address(host[1:-1] if host.startswith("[") else host)
+    except ValueError:
+        return False
+    return True
+
+
+class ServerAclMatcher:
+    """
+        @param allow list globs of servers that may take part in the room
+        @param deny list globs of servers that may not, checked first
+        @param allowIPLiterals bool OPTIONAL whether servers named by an IP address are allowed. Defaults True
+    """
+    __slots__ = ("allow", "deny", "allowIPLiterals", "_allow", "_deny", "_cache")
+
+    def __init__(self, allow=None, deny=None, allowIPLiterals=True):
+        self.allow = tuple(allow or ())
+        self.deny = tuple(deny or ())
+        self.allowIPLiterals = allowIPLiterals is not False
+        self._allow = _compile(self.allow)
+        self._deny = _compile(self.deny)
+        self._cache = dict()
+
+    def _check(self, server):
+        host = serverHost(server)
+        if not self.allowIPLiterals and isIPLiteral(host):
+            return False
+        if self._deny is not None and self._deny.fullmatch(host):
+            return False
+        return self._allow is not None and self._allow.fullmatch(host) is not None
+
+    def allowed(self, server):
+        """
+            @param server str the server name, ie the part of a user ID after the first colon
+
+            @return bool whether the ACL lets the server take part in the room
+        """
+        allowed = self._cache.get(server)
+        if allowed is None:
+            if len(self._cache) >= MAX_CACHED_SERVERS:
+                self._cache.clear()
+            allowed = self._cache[server] = self._check(server)
+        return allowed
+
+    def __eq__(self, other):
+        if not isinstance(other, ServerAclMatcher):
+            return NotImplemented
+        return (self.allow, self.deny, self.allowIPLiterals) == (other.allow, other.deny, other.allowIPLiterals)
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return (self.allow, self.deny, self.allowIPLiterals)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
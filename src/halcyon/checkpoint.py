@@ -0,0 +1,217 @@
+"""
+    Sync checkpoints. Keeps the /sync since token on disk so a restart picks up where we left off,
+    instead of doing a fresh initial sync and dropping everything that arrived while we were down.
+
+    A token is only written once every event in its batch has been handed to a handler (at-least-once delivery).
+    If the bot dies mid batch, that batch is synced and dispatched again on the next start.
+
+    Tokens are written on a writer thread, so the fsync or commit never stalls the event loop. If batches finish
+    faster than the disk keeps up, the tokens in between are skipped and only the newest one is written.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from halcyon.storage import writeAtomic
+
+
+class CheckpointStore:
+    """
+        Base checkpoint store. Subclass this to keep tokens somewhere else (redis, a database...).
+        save and close are called on the tracker's writer thread
+    """
+    def load(self, key):
+        """
+            @param key String the account the token belongs to
+
+            @return String the last committed since token, or None
+        """
+        raise NotImplementedError
+
+    def save(self, key, token):
+        """
+            @param key String the account the token belongs to
+            @param token String the since token to resume from
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class FileCheckpointStore(CheckpointStore):
+    """
+        Keeps tokens in a small json file, rewritten atomically on every commit
+
+        @param path String the file to keep the tokens in
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _read(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return dict()
+        except (OSError, ValueError) as e:
+            logging.warning("Checkpoint file unreadable, starting from scratch: " + str(e))
+            return dict()
+
+    def load(self, key):
+        return self._read().get(key)
+
+    def save(self, key, token):
+        tokens = self._read()
+        tokens[key] = token
+        writeAtomic(self.path, json.dumps(tokens))
+
+
+class SQLiteCheckpointStore(CheckpointStore):
+    """
+        Keeps tokens in an SQLite database. Handy if you already keep bot state in one
+
+        @param path String the database file, ":memory:" works for testing
+    """
+    def __init__(self, path):
+        self.path = path
+        #tokens are saved from the tracker's writer thread
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS sync_checkpoint (account TEXT PRIMARY KEY, token TEXT NOT NULL, updated INTEGER NOT NULL)")
+        self._db.commit()
+
+    def load(self, key):
+        row = self._db.execute("SELECT token FROM sync_checkpoint WHERE account = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def save(self, key, token):
+        self._db.execute("INSERT OR REPLACE INTO sync_checkpoint (account, token, updated) VALUES (?, ?, ?)", (key, token, time.time_ns()))
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+class _Batch:
+    __slots__ = ("token", "pending", "sealed")
+
+    def __init__(self, token):
+        self.token = token
+        self.pending = 0
+        self.sealed = False
+
+
+class BatchTracker:
+    """
+        Tracks which sync batches have been fully dispatched, and commits their tokens in order.
+        A batch is done once it is sealed and every handler submitted for it has finished (or failed).
+        Tokens are only committed for a run of finished batches from the oldest one, so a slow batch
+        holds back the checkpoint for every batch after it.
+
+        @param store CheckpointStore where to commit tokens
+        @param key String the account the tokens belong to
+    """
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+        self.committed = None
+        self._batches = deque()
+        self._unsaved = None
+        self._unsavedLock = threading.Lock()
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="halcyon-checkpoint")
+
+    def load(self):
+        """
+            @return String the token to resume from, or None
+        """
+        self.committed = self.store.load(self.key)
+        return self.committed
+
+    def begin(self, token):
+        """
+            Start tracking a batch
+
+            @param token String the next_batch token of the sync response
+
+            @return the batch, pass it to track() and seal()
+        """
+        batch = _Batch(token)
+        self._batches.append(batch)
+        return batch
+
+    def track(self, batch, handler):
+        """
+            Wrap a handler so the batch knows when it finished
+
+            @param batch the batch from begin()
+            @param handler coroutine function the event handler
+
+            @return coroutine function to hand to the dispatcher
+        """
+        batch.pending += 1
+        state = {"finished": False}
+
+        def finish():
+            if not state["finished"]:
+                state["finished"] = True
+                batch.pending -= 1
+                self._advance()
+
+        @functools.wraps(handler)
+        async def tracked(*args):
+            try:
+                await handler(*args)
+            finally:
+                finish()
+
+        #lets the caller give the slot back if the dispatcher refused the handler
+        tracked.release = finish
+        return tracked
+
+    def seal(self, batch):
+        """Mark a batch as fully submitted"""
+        batch.sealed = True
+        self._advance()
+
+    def _advance(self):
+        token = None
+        while self._batches and self._batches[0].sealed and self._batches[0].pending == 0:
+            finished = self._batches.popleft()
+            if finished.token is not None:
+                token = finished.token
+
+        if token is not None and token != self.committed:
+            self.committed = token
+            with self._unsavedLock:
+                self._unsaved = token
+            self._writer.submit(self._save)
+
+    def _save(self):
+        """Runs on the writer thread. Writes the newest token, the ones it overtook don't matter any more"""
+        with self._unsavedLock:
+            token, self._unsaved = self._unsaved, None
+        if token is None:
+            return
+
+        try:
+            self.store.save(self.key, token)
+        except Exception as e:
+            #We'll commit a later token next time round, worst case some events are delivered twice
+            logging.error("Could not save sync checkpoint: " + str(e))
+
+    async def flush(self):
+        """Wait until every committed token is on disk"""
+        await asyncio.wrap_future(self._writer.submit(self._save))
+
+    async def close(self):
+        """Write the last token, then close the store"""
+        await self.flush()
+        await asyncio.wrap_future(self._writer.submit(self.store.close))
+        self._writer.shutdown(wait=False)
@@ -0,0 +1,100 @@
+"""
+    Pluggable JSON codecs.
+
+    Decoding /sync is the most CPU heavy thing a bot does. orjson and msgspec are several times faster than the
+    stdlib json module, so when one of them is installed we use it for request payloads, responses, and tokens.
+    Neither is required, "auto" falls back to the stdlib.
+
+    A codec is anything with dumps(obj) -> bytes and loads(bytes or str) -> obj, plus a name.
+    See benchmarks/sync_decode.py for how the backends compare.
+"""
+
+import json
+
+
+class StdlibCodec:
+    """The json module from the standard library. Always available"""
+    name = "json"
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':')).encode("utf-8")
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec:
+    """https://github.com/ijl/orjson"""
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+        self._options = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj):
+        return self._orjson.dumps(obj, option=self._options)
+
+    def loads(self, data):
+        return self._orjson.loads(data)
+
+
+class MsgspecCodec:
+    """https://github.com/jcrist/msgspec"""
+    name = "msgspec"
+
+    def __init__(self):
+        import msgspec
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder()
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj)
+
+    def loads(self, data):
+        return self._decoder.decode(data)
+
+
+CODECS = {
+    "orjson": OrjsonCodec,
+    "msgspec": MsgspecCodec,
+    "json": StdlibCodec,
+}
+
+# Fastest first, for "auto"
+_PREFERENCE = ["orjson", "msgspec", "json"]
+
+
+def available():
+    """
+        @return list the names of every codec that can be used here, fastest first
+    """
+    names = []
+    for name in _PREFERENCE:
+        try:
+            CODECS[name]()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def getCodec(codec="auto"):
+    """
+        @param codec String/object OPTIONAL "auto", "orjson", "msgspec", "json", or your own codec object
+
+        @return a codec
+    """
+    if codec is None or codec == "auto":
+        return CODECS[available()[0]]()
+
+    if not isinstance(codec, str):
+        return codec
+
+    if codec not in CODECS:
+        raise ValueError("Unknown json codec " + codec + ", pick one of " + ", ".join(CODECS))
+
+    try:
+        return CODECS[codec]()
+    except ImportError:
+        raise ValueError("The " + codec + " json codec isn't installed, try pip install " + codec)
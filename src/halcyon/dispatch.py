@@ -0,0 +1,204 @@
+"""
+    Event dispatchers. These decide how the handlers (on_message, on_room_invite...) are run
+    for every event that comes out of a /sync batch.
+
+    SequentialDispatcher - the classic behaviour, one handler at a time, in sync order
+    ConcurrentDispatcher - every event becomes a task in a bounded pool
+    RoomLaneDispatcher - one ordered lane per room, lanes run in parallel
+"""
+
+import asyncio
+import logging
+from collections import deque
+
+
+class SequentialDispatcher:
+    """
+        Runs each handler to completion before the next one starts. Handler errors propagate to the caller.
+    """
+    def __init__(self):
+        self.dispatched = 0
+
+    async def submit(self, roomID, handler, *args):
+        """
+            Run a handler for an event
+
+            @param roomID String the room the event belongs to, None if it isn't tied to a room
+            @param handler coroutine function the event handler to call
+            @param args the arguments to pass to the handler
+        """
+        self.dispatched += 1
+        await handler(*args)
+
+    async def drain(self):
+        """Wait for every submitted handler to finish"""
+        pass
+
+    async def close(self):
+        """Stop the dispatcher, waiting for outstanding handlers"""
+        await self.drain()
+
+
+class ConcurrentDispatcher(SequentialDispatcher):
+    """
+        Runs every event as its own task, with at most maxConcurrency handlers running at once.
+        When the pool is full, submit() waits for a free slot, which pushes back on the sync loop.
+
+        Error policy:
+            "log"   - log the exception and carry on (default)
+            "raise" - remember the first exception and raise it from the next submit() or drain()
+            callable - called as errorPolicy(exception, handler, args), carry on
+    """
+    def __init__(self, maxConcurrency=16, errorPolicy="log"):
+        super().__init__()
+        if maxConcurrency < 1:
+            raise ValueError("maxConcurrency must be at least 1")
+
+        if errorPolicy not in ("log", "raise") and not callable(errorPolicy):
+            raise ValueError("errorPolicy must be 'log', 'raise' or a callable")
+
+        self.maxConcurrency = maxConcurrency
+        self.errorPolicy = errorPolicy
+        self.failed = 0
+
+        self._slots = None  # Created lazily so it binds to the running loop
+        self._tasks = set()
+        self._error = None
+
+    def _ensure_slots(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.maxConcurrency)
+
+    def _raise_pending(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    @property
+    def inFlight(self):
+        """Number of handlers currently running"""
+        return len(self._tasks)
+
+    async def submit(self, roomID, handler, *args):
+        self._raise_pending()
+        self._ensure_slots()
+
+        await self._slots.acquire()
+        self.dispatched += 1
+        task = asyncio.ensure_future(self._run(handler, args))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, handler, args):
+        try:
+            await handler(*args)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failed += 1
+            self._handle_error(e, handler, args)
+        finally:
+            self._slots.release()
+
+    def _handle_error(self, error, handler, args):
+        if self.errorPolicy == "raise":
+            if self._error is None:
+                self._error = error
+            return
+
+        if callable(self.errorPolicy):
+            try:
+                self.errorPolicy(error, handler, args)
+                return
+            except Exception:
+                logging.exception("Dispatch error callback failed")
+
+        logging.error("Unhandled exception in " + getattr(handler, "__name__", repr(handler)), exc_info=error)
+
+    async def drain(self):
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+        self._raise_pending()
+
+    async def close(self):
+        try:
+            await self.drain()
+        finally:
+            for task in list(self._tasks):
+                task.cancel()
+
+
+class _Lane:
+    """A FIFO of pending handlers for one room"""
+    __slots__ = ("queue", "task", "space", "waiting")
+
+    def __init__(self, maxBacklog):
+        self.queue = deque()
+        self.task = None
+        self.space = asyncio.Semaphore(maxBacklog)
+        self.waiting = 0
+
+
+class RoomLaneDispatcher(ConcurrentDispatcher):
+    """
+        Keeps one FIFO lane per room ID. Events inside a lane run strictly in the order they were submitted,
+        while different rooms run in parallel, so a busy room can't starve the others.
+
+        Lanes are created on the first event for a room and thrown away as soon as they go idle.
+
+        @param maxConcurrency int How many handlers may run at once across every lane
+        @param maxBacklog int How many events a single lane may queue before submit() waits
+        @param errorPolicy the same policies as ConcurrentDispatcher. A failed handler doesn't stop its lane
+    """
+    def __init__(self, maxConcurrency=16, maxBacklog=100, errorPolicy="log"):
+        super().__init__(maxConcurrency=maxConcurrency, errorPolicy=errorPolicy)
+        if maxBacklog < 1:
+            raise ValueError("maxBacklog must be at least 1")
+
+        self.maxBacklog = maxBacklog
+        self._lanes = dict()
+
+    @property
+    def laneCount(self):
+        """Number of rooms with queued or running events"""
+        return len(self._lanes)
+
+    @property
+    def inFlight(self):
+        return sum(len(lane.queue) + (1 if lane.task else 0) for lane in self._lanes.values())
+
+    async def submit(self, roomID, handler, *args):
+        self._raise_pending()
+        self._ensure_slots()
+
+        lane = self._lanes.get(roomID)
+        if lane is None:
+            lane = _Lane(self.maxBacklog)
+            self._lanes[roomID] = lane
+
+        lane.waiting += 1
+        try:
+            await lane.space.acquire()
+        finally:
+            lane.waiting -= 1
+
+        self.dispatched += 1
+        lane.queue.append((handler, args))
+        if lane.task is None:
+            lane.task = asyncio.ensure_future(self._runLane(roomID, lane))
+            self._tasks.add(lane.task)
+            lane.task.add_done_callback(self._tasks.discard)
+
+    async def _runLane(self, roomID, lane):
+        try:
+            while lane.queue:
+                handler, args = lane.queue.popleft()
+                lane.space.release()
+
+                await self._slots.acquire()
+                await self._run(handler, args)
+        finally:
+            lane.task = None
+            #garbage collect idle lanes. Anyone still waiting for space will restart the lane
+            if not lane.waiting and self._lanes.get(roomID) is lane:
+                del self._lanes[roomID]
@@ -0,0 +1,208 @@
+"""
+    Server side /sync filters. https://spec.matrix.org/latest/client-server-api/#filtering
+
+    A filter lets the homeserver drop the parts of /sync we'd throw away anyway (presence, typing, account data...).
+    Filters are registered once per user and referenced by ID, so we keep the IDs in a small json file
+    keyed by a hash of the filter.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+from halcyon.storage import writeAtomic
+
+
+# Every state event type the Room object knows how to read
+ROOM_STATE_TYPES = [
+    "m.room.create",
+    "m.room.join_rules",
+    "m.room.name",
+    "m.room.topic",
+    "m.room.canonical_alias",
+    "m.room.aliases",
+    "m.room.avatar",
+    "m.room.related_groups",
+    "m.room.guest_access",
+    "m.room.history_visibility",
+    "m.room.member",
+    "m.room.power_levels",
+    "m.room.server_acl",
+    "m.room.encryption",
+]
+
+# Which timeline events each Client handler cares about
+HANDLER_EVENT_TYPES = {
+    "on_message": ["m.room.message"],
+    "on_message_edit": ["m.room.message"],
+}
+
+# Handlers that need a section of /sync that isn't the joined room timeline
+HANDLER_SECTIONS = {
+    "on_room_leave": "leave",
+}
+
+DEFAULT_FILTER_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "halcyon", "filters.json")
+
+_EVERYTHING = ["*"]
+
+
+class SyncFilter:
+    """
+        Builds a matrix filter definition.
+
+        Type lists follow the spec, None means "every type" and [] means "nothing".
+
+        @param timelineTypes list OPTIONAL event types to keep in joined room timelines
+        @param timelineLimit int OPTIONAL max number of timeline events per room, per sync
+        @param stateTypes list OPTIONAL state event types to keep
+        @param lazyLoadMembers bool OPTIONAL only send member events for senders in the timeline
+        @param presence bool OPTIONAL include presence events
+        @param accountData bool OPTIONAL include global and per room account data
+        @param ephemeral bool OPTIONAL include typing notifications and receipts
+        @param includeLeave bool OPTIONAL include rooms we've left
+    """
+    def __init__(self, timelineTypes=None, timelineLimit=None, stateTypes=None, lazyLoadMembers=False,
+                 presence=True, accountData=True, ephemeral=True, includeLeave=False):
+        self.timelineTypes = timelineTypes
+        self.timelineLimit = timelineLimit
+        self.stateTypes = stateTypes
+        self.lazyLoadMembers = lazyLoadMembers
+        self.presence = presence
+        self.accountData = accountData
+        self.ephemeral = ephemeral
+        self.includeLeave = includeLeave
+
+    @classmethod
+    def fromHandlers(cls, handlerNames, includeState=True):
+        """
+            Build the smallest filter that still feeds every registered handler
+
+            @param handlerNames iterable the names of the registered handlers, ie {"on_message", "on_ready"}
+            @param includeState bool OPTIONAL keep room state events, so the room cache can stay up to date
+
+            @return SyncFilter
+        """
+        timelineTypes = []
+        for name in sorted(handlerNames):
+            for eventType in HANDLER_EVENT_TYPES.get(name, []):
+                if eventType not in timelineTypes:
+                    timelineTypes.append(eventType)
+
+        stateTypes = list(ROOM_STATE_TYPES) if includeState else []
+        if includeState:
+            #state changes also show up in the timeline, and we want those too
+            timelineTypes += [x for x in ROOM_STATE_TYPES if x not in timelineTypes]
+
+        sections = {HANDLER_SECTIONS[name] for name in handlerNames if name in HANDLER_SECTIONS}
+
+        return cls(
+            timelineTypes=timelineTypes,
+            stateTypes=stateTypes,
+            presence=False,
+            accountData=False,
+            ephemeral=False,
+            includeLeave="leave" in sections,
+        )
+
+    def toDict(self):
+        """
+            @return dict the filter in the format the homeserver expects
+        """
+        timeline = {}
+        if self.timelineTypes is not None:
+            timeline["types"] = list(self.timelineTypes)
+        if self.timelineLimit is not None:
+            timeline["limit"] = self.timelineLimit
+
+        state = {}
+        if self.stateTypes is not None:
+            state["types"] = list(self.stateTypes)
+        if self.lazyLoadMembers:
+            state["lazy_load_members"] = True
+
+        roomFilter = {
+            "timeline": timeline,
+            "state": state,
+            "include_leave": self.includeLeave,
+        }
+
+        if not self.ephemeral:
+            roomFilter["ephemeral"] = {"not_types": _EVERYTHING}
+        if not self.accountData:
+            roomFilter["account_data"] = {"not_types": _EVERYTHING}
+
+        definition = {"room": roomFilter}
+        if not self.presence:
+            definition["presence"] = {"not_types": _EVERYTHING}
+        if not self.accountData:
+            definition["account_data"] = {"not_types": _EVERYTHING}
+
+        return definition
+
+    def filterHash(self, userID=""):
+        """
+            A stable hash of the filter, used as the cache key. Filter IDs belong to a user, so include them
+
+            @param userID String OPTIONAL the user the filter is registered for
+
+            @return String hex digest
+        """
+        return filterHash(self.toDict(), userID)
+
+
+def filterHash(definition, userID=""):
+    """
+        @param definition dict a filter definition
+        @param userID String OPTIONAL the user the filter is registered for
+
+        @return String hex digest
+    """
+    canonical = json.dumps(definition, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(bytes(userID + "|" + canonical, "utf-8")).hexdigest()
+
+
+class FilterCache:
+    """
+        Maps filter hashes to the filter IDs the homeserver gave us, backed by a json file
+
+        @param path String OPTIONAL where to keep the cache file
+    """
+    def __init__(self, path=None):
+        self.path = path or DEFAULT_FILTER_CACHE
+        self._ids = None
+
+    def _load(self):
+        if self._ids is not None:
+            return self._ids
+
+        try:
+            with open(self.path, "r") as f:
+                self._ids = json.load(f)
+        except FileNotFoundError:
+            self._ids = dict()
+        except (OSError, ValueError) as e:
+            logging.warning("Filter cache unreadable, starting fresh: " + str(e))
+            self._ids = dict()
+
+        return self._ids
+
+    def get(self, key):
+        return self._load().get(key)
+
+    def set(self, key, filterID):
+        self._load()[key] = filterID
+        self._save()
+
+    def forget(self, key):
+        ids = self._load()
+        if key in ids:
+            del ids[key]
+            self._save()
+
+    def _save(self):
+        try:
+            writeAtomic(self.path, json.dumps(self._ids))
+        except OSError as e:
+            logging.warning("Could not save filter cache: " + str(e))
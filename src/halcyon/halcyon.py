@@ -2,6 +2,7 @@ import enum, json, requests, logging, base64
 import markdown, re
 import asyncio
 import time
+import aiohttp
 
 from PIL import Image
 import io
@@ -9,20 +10,49 @@ import blurhash
 
 import functools
 import signal
+import heapq
 
 import halcyon.restrunner
 from halcyon.message import *
 from halcyon.room import *
 from halcyon.enums import *
-from halcyon.security import configure_security
+from halcyon.security import configure_security, get_security_snapshot
+from halcyon.dispatch import SequentialDispatcher
+from halcyon.filters import SyncFilter, FilterCache, filterHash, ROOM_STATE_TYPES
+from halcyon.checkpoint import BatchTracker
+from halcyon.outbox import Outbox
+from halcyon.codec import getCodec
+from halcyon.roomcache import RoomCache, SingleFlight, NegativeCache
+from halcyon.snapshot import RoomSnapshot
+
+ROOM_CACHE_MODES = ("fetch", "sync", "lazy")
+
+
+class _RoomFetch:
+    """A background fetch of an uncached room, and the messages from it waiting to go out"""
+    __slots__ = ("task", "done", "waiting")
+
+    def __init__(self):
+        self.task = None
+        self.done = False
+        self.waiting = []
+
 
 class Client:
     """
         This is the general interface that is exposed to the user
     """
-    def __init__(self, loop=None, ignoreFirstSync=True, security_mode='strict'):
-        # Configure security mode for this client session
-        configure_security(security_mode)
+    def __init__(self, loop=None, ignoreFirstSync=True, security_mode='strict', dispatcher=None, pipelineSync=False, maxPendingBatches=1,
+                 syncFilter=None, filterCachePath=None, checkpointStore=None, roomCacheRefreshInterval=None,
+                 streamSync=False, connectionPool=None, scheduler=None,
+                 outboxStore=None, codec="auto", roomCacheConcurrency=16, roomCacheTimeout=30,
+                 roomCacheMode="fetch", roomCacheMaxRooms=None, roomCacheTTL=None, roomCacheMaxBytes=None,
+                 roomCacheSnapshot=None, roomCacheSnapshotInterval=300, lazyRooms=False,
+                 lazyMessages=False, trusted_models=False):
+        # Configure security mode for this client session. trusted_models skips pydantic validation for server events.
+        # The client keeps this snapshot, and builds rooms and messages from model classes compiled for it
+        configure_security(security_mode, trusted=trusted_models)
+        self.security = get_security_snapshot()
         
         # Fix deprecated event loop initialization
         if loop is None:
@@ -47,10 +77,100 @@ class Client:
         self.firstSync = True
         self.revokeSessionTokenOnExit = False
         self.security_mode = security_mode
+        self.trusted_models = trusted_models
+
+        #How handlers get run for each event. Defaults to one at a time, in order
+        self.dispatcher = dispatcher if dispatcher else SequentialDispatcher()
+
+        #Start the next /sync while the last batch is still being handled.
+        #maxPendingBatches is how many synced batches can wait for dispatch before we stop polling
+        if maxPendingBatches < 1:
+            raise ValueError("maxPendingBatches must be at least 1")
+        self.pipelineSync = pipelineSync
+        self.maxPendingBatches = maxPendingBatches
+
+        #Decode /sync as it downloads, handing out one room at a time. Keeps memory down on huge accounts.
+        #The pipelined loop needs next_batch up front, so it always uses the regular decoder
+        self.streamSync = streamSync
+
+        #Server side sync filter. None to sync everything, "auto" to build one from the registered handlers,
+        #or pass a SyncFilter/filter dict. The ID the server gives us is cached on disk
+        self.syncFilter = syncFilter
+        self.syncFilterID = None
+        self._syncFilterKey = None
+        self.filterCache = FilterCache(filterCachePath)
+        self._handlers = set()
+
+        #aiohttp connection pool handed to the Runner. Pass the same ConnectionPool to several clients to share connections
+        self.connectionPool = connectionPool
+
+        #Paces outbound sends and retries them when the homeserver rate limits us. See halcyon.ratelimit
+        self.scheduler = scheduler
+
+        #Keep outgoing messages on disk until the server has them, and replay them after a crash. See halcyon.outbox
+        self.outbox = Outbox(outboxStore) if outboxStore else None
+
+        #json codec for requests, responses and tokens. "auto" uses orjson or msgspec when installed. See halcyon.codec
+        self.codec = getCodec(codec)
+
+        #Where to keep the since token between restarts. See halcyon.checkpoint
+        self.checkpoint = BatchTracker(checkpointStore, None) if checkpointStore else None
+
+        #Limits for the room cache, all off by default. See halcyon.roomcache
+        self.roomCacheMaxRooms = roomCacheMaxRooms
+        self.roomCacheTTL = roomCacheTTL
+        self.roomCacheMaxBytes = roomCacheMaxBytes
 
         self.roomCache = dict()
+
+        #Build rooms as LazyRoom, which only parses members, power levels and the like when they are first read
+        self._roomClass = (LazyRoom if lazyRooms else room).variant(self.security)
+
+        #Hand handlers LazyMessage, which only builds content, edit and the rest when they are first read
+        self._messageClass = (LazyMessage if lazyMessages else message).variant(self.security)
+
+        #Concurrent misses for one room share a single fetch, and rooms that fail to fetch are left alone for a
+        #while (5s, doubling up to 5 minutes) instead of being fetched again for every message
+        self._roomFills = SingleFlight()
+        self.roomFailures = NegativeCache(baseTTL=5, maxTTL=300)
+
+        #Messages from rooms that aren't cached yet, waiting on a background fetch of the room. roomID -> _RoomFetch
+        self._awaitingRoom = dict()
+        self._roomWaits = set()
+
         self._cache_lock = None  # Will be initialized in async context
 
+        #The room cache is kept current from sync, the full refresh is an opt in safety net that runs in the
+        #background. None or 0 leaves it off
+        self.roomCacheRefreshInterval = roomCacheRefreshInterval
+        self._refreshTask = None
+
+        #How many room state fetches run at once while warming the cache, and how long one room gets before we skip it
+        if roomCacheConcurrency < 1:
+            raise ValueError("roomCacheConcurrency must be at least 1")
+        self.roomCacheConcurrency = roomCacheConcurrency
+        self.roomCacheTimeout = roomCacheTimeout
+
+        #How the room cache is filled on startup. "fetch" asks for each room's state, "sync" reads it all out of one
+        #state only /sync, "lazy" starts empty and fills in the background, busiest rooms first
+        if roomCacheMode not in ROOM_CACHE_MODES:
+            raise ValueError("roomCacheMode must be one of " + ", ".join(ROOM_CACHE_MODES))
+        self.roomCacheMode = roomCacheMode
+        self.initialSyncTimeout = 600#seconds, the first sync of a big account can take minutes
+
+        #lazy mode: timeline events seen per room, and the background task warming the rest of the cache
+        self._roomActivity = dict()
+        self._warmQueue = []
+        self._warmTask = None
+
+        #Keep the room cache on disk between restarts, saved every roomCacheSnapshotInterval seconds and on exit.
+        #See halcyon.snapshot. _roomCacheToken is the since token the cached state is current as of
+        self.roomCacheSnapshot = roomCacheSnapshot
+        self.roomCacheSnapshotInterval = roomCacheSnapshotInterval
+        self._roomCacheToken = None
+        self._snapshotAge = time.time_ns()
+        self._snapshotSave = None
+
     def _ensure_async_lock(self):
         """Ensure the async lock is created"""
         if self._cache_lock is None:
@@ -64,7 +184,7 @@ class Client:
 
             @return the base64 string
         """
-        return str(base64.b64encode(bytes(json.dumps(tokenDict, separators=(',', ':')), "utf-8")), "utf-8")
+        return str(base64.b64encode(self.codec.dumps(tokenDict)), "utf-8")
 
     def _decodeTokenDict(self, token):
         """
@@ -76,7 +196,7 @@ class Client:
         """
 
         try:
-            return json.loads(str(base64.b64decode(token), "utf-8"))
+            return self.codec.loads(base64.b64decode(token))
         except Exception as e:
             print(token)
             logging.error("Cannot decode token dict, double check your token is okay?")
@@ -104,7 +224,7 @@ class Client:
                     accessToken = decodedToken["token"]
                     deviceID = decodedToken["device_id"]
 
-            self.restrunner = halcyon.restrunner.Runner(homeserver=homeserver, user_id=userID, access_token=accessToken, device_id=deviceID)
+            self.restrunner = halcyon.restrunner.Runner(homeserver=homeserver, user_id=userID, access_token=accessToken, device_id=deviceID, connectionPool=self.connectionPool, scheduler=self.scheduler, codec=self.codec)
 
             resp = self.restrunner.whoami()
             if "errcode" not in resp:
@@ -114,7 +234,7 @@ class Client:
 
         if userID and password:
             if homeserver:
-                self.restrunner = halcyon.restrunner.Runner(homeserver=homeserver, user_id=userID)
+                self.restrunner = halcyon.restrunner.Runner(homeserver=homeserver, user_id=userID, connectionPool=self.connectionPool, scheduler=self.scheduler, codec=self.codec)
                 client._generateNewSessionToken(userID, password)
                 self.logoutOnDeath = True
                 #TODO: state.json file
@@ -127,16 +247,22 @@ class Client:
         exit(1)
 
 
+    def _newRoomCache(self):
+        """
+            @return RoomCache an empty room cache with the configured limits
+        """
+        return RoomCache(maxRooms=self.roomCacheMaxRooms, ttl=self.roomCacheTTL, maxBytes=self.roomCacheMaxBytes)
+
     def _roomcacheinit(self, cachePublicRooms=False):
         """
             Build a cache of room info that can be linked into incoming messages
         """
         self.roomCache["cache_age"] = time.time_ns()#nanoseconds since epoch
-        self.roomCache["rooms"] = dict()
+        self.roomCache["rooms"] = self._newRoomCache()
 
         joined_rooms = self.restrunner.joinedRooms()
         for roomID in joined_rooms:
-            self.roomCache["rooms"][roomID] = room(rawEvents=self.restrunner.getRoomState(roomID), roomID=roomID)
+            self.roomCache["rooms"][roomID] = self._roomClass(rawEvents=self.restrunner.getRoomState(roomID), roomID=roomID)
 
     async def _roomcacheinit_async(self, cachePublicRooms=False):
         """
@@ -145,11 +271,270 @@ class Client:
         self._ensure_async_lock()
         async with self._cache_lock:
             self.roomCache["cache_age"] = time.time_ns()#nanoseconds since epoch
-            self.roomCache["rooms"] = dict()
+            self.roomCache["rooms"] = self._newRoomCache()
+
+        if self.roomCacheSnapshot and await self._roomcacheinitFromSnapshot():
+            if self.roomCacheMode == "lazy":
+                #whatever didn't make it into the snapshot still warms in the background
+                self._warmTask = asyncio.ensure_future(self._lazyWarmRoomCache())
+            return
+
+        if self.roomCacheMode == "sync":
+            await self._roomcacheinitFromSync()
+            return
+
+        if self.roomCacheMode == "lazy":
+            #rooms are fetched on first use, the rest fill in behind the scenes
+            self._warmTask = asyncio.ensure_future(self._lazyWarmRoomCache())
+            return
+
+        joined_rooms = await self.restrunner.joinedRooms_async()
+        await self._warmRoomCache(joined_rooms)
+
+    def _roomStateFilter(self):
+        """
+            @return String a sync filter that leaves nothing but room state
+        """
+        stateFilter = SyncFilter(timelineTypes=ROOM_STATE_TYPES, timelineLimit=0, stateTypes=ROOM_STATE_TYPES,
+                                 presence=False, accountData=False, ephemeral=False).toDict()
+        return str(self.codec.dumps(stateFilter), "utf-8")
+
+    async def _roomcacheinitFromSync(self):
+        """
+            Build the room cache out of one initial /sync, filtered down to room state.
+            The server sends the full state of every joined room, so this is one request instead of one per room
+        """
+        stateFilter = self._roomStateFilter()
+
+        rooms = dict()
+        if self.streamSync:
+            resp = dict()
+            async for section, roomID, data in self.restrunner.sync_stream_async(serverSideFilter=stateFilter, requestTimeout=self.initialSyncTimeout):
+                if section == "join":
+                    rooms[roomID] = self._roomFromSync(roomID, data)
+                else:
+                    resp = data
+        else:
+            resp = await self.restrunner.sync_async(serverSideFilter=stateFilter, requestTimeout=self.initialSyncTimeout)
+            for roomID, joinedRoom in resp.get("rooms", {}).get("join", {}).items():
+                rooms[roomID] = self._roomFromSync(roomID, joinedRoom)
+
+        async with self._cache_lock:
+            self.roomCache["rooms"].update(rooms)
+        logging.info("Room cache: " + str(len(rooms)) + " rooms from the initial sync")
+
+        self._resumeFromStateSync(resp.get("next_batch"))
+
+    def _resumeFromStateSync(self, token):
+        """
+            Carry on from a state only sync the room cache was built from. The events before it are the ones
+            ignoreFirstSync would throw away anyway, and a checkpoint, loaded after this, still wins
+        """
+        if not token:
+            return
+        self._roomCacheToken = token
+        if self.ignoreFirstSync and not self.sinceToken:
+            self.sinceToken = token
+            self.firstSync = False
+
+    async def _roomcacheinitFromSnapshot(self):
+        """
+            Load the room cache from the snapshot, then bring it up to date with one state only /sync from the
+            snapshot's token. Rooms joined since come with their full state, rooms left are dropped
+
+            @return bool False if there was no usable snapshot, and the cache should be built the usual way
+        """
+        loop = asyncio.get_running_loop()
+        key = str(self.restrunner.USER_ID)
+        try:
+            snapshot = await loop.run_in_executor(None, self.roomCacheSnapshot.load, key)
+        except Exception as e:
+            logging.warning("Could not load the room cache snapshot: " + str(e))
+            return False
+        if snapshot is None:
+            return False
+
+        try:
+            resp = await self.restrunner.sync_async(serverSideFilter=self._roomStateFilter(), since=snapshot.token,
+                                                    requestTimeout=self.initialSyncTimeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning("Could not catch the room cache snapshot up, building the cache from scratch: " + str(e))
+            return False
+        if "next_batch" not in resp:
+            logging.warning("Could not catch the room cache snapshot up, building the cache from scratch: " + str(resp))
+            return False
+
+        rooms = self.roomCache["rooms"]
+        async with self._cache_lock:
+            for count, (roomID, rawEvents) in enumerate(snapshot.rooms.items(), 1):
+                rooms[roomID] = self._roomClass(rawEvents=rawEvents, roomID=roomID)
+                if count % 100 == 0:
+                    await asyncio.sleep(0)
+
+            for roomID, joinedRoom in resp.get("rooms", {}).get("join", {}).items():
+                cachedRoom = self._cachedRoom(roomID)
+                if cachedRoom is None:
+                    rooms[roomID] = self._roomFromSync(roomID, joinedRoom)
+                    continue
+                cachedRoom.apply_state_events(joinedRoom.get("state", {}).get("events", []))
+                cachedRoom.apply_state_events(joinedRoom.get("timeline", {}).get("events", []))
+                if isinstance(rooms, RoomCache):
+                    rooms.resize(roomID)
+
+            for roomID in resp.get("rooms", {}).get("leave", {}):
+                self._forgetRoom(roomID)
+
+        logging.info("Room cache: " + str(len(snapshot)) + " rooms from the snapshot, "
+                     + str(len(resp.get("rooms", {}).get("join", {}))) + " updated since")
+        self._resumeFromStateSync(resp["next_batch"])
+        return True
+
+    async def _saveRoomCacheSnapshot(self):
+        """
+            Write the room cache and the token it is current as of to the snapshot store. A save asked for while
+            another is still writing waits for it, then goes ahead with the newer state
+        """
+        if not self.roomCacheSnapshot or not self._roomCacheToken:
+            return
+
+        while self._snapshotSave is not None and not self._snapshotSave.done():
+            #wait() doesn't cancel the write if we're cancelled, so shutdown can still wait on it
+            await asyncio.wait([self._snapshotSave])
+
+        #copy the lists here, sync keeps replacing events in them while the store writes
+        cachedRooms = self.roomCache.get("rooms", {})
+        rooms = {roomID: list(cachedRoom._rawEvents or []) for roomID, cachedRoom in cachedRooms.items()}
+        changed = cachedRooms.takeChanged() if isinstance(cachedRooms, RoomCache) else None
+        snapshot = RoomSnapshot(self._roomCacheToken, rooms, changed=changed)
+
+        self._snapshotSave = asyncio.get_running_loop().run_in_executor(None, self.roomCacheSnapshot.save, str(self.restrunner.USER_ID), snapshot)
+        self._snapshotSave.add_done_callback(functools.partial(self._snapshotSaved, cachedRooms, snapshot))
+        await asyncio.wait([self._snapshotSave])
 
-            joined_rooms = self.restrunner.joinedRooms()
-            for roomID in joined_rooms:
-                self.roomCache["rooms"][roomID] = room(rawEvents=self.restrunner.getRoomState(roomID), roomID=roomID)
+    def _snapshotSaved(self, cachedRooms, snapshot, future):
+        """
+            Log how a snapshot save went. The rooms of a failed save are marked changed again, for the next one
+        """
+        if future.cancelled():
+            return
+        if future.exception() is None:
+            logging.debug("Room cache snapshot saved, " + str(len(snapshot)) + " rooms")
+            return
+
+        logging.error("Could not save the room cache snapshot: " + str(future.exception()))
+        if snapshot.changed is not None:
+            cachedRooms.changed.update(snapshot.changed)
+
+    async def _maybeSaveRoomCacheSnapshot(self):
+        """
+            Save a room cache snapshot if the last one is older than roomCacheSnapshotInterval
+        """
+        if not self.roomCacheSnapshot or not self.roomCacheSnapshotInterval:
+            return
+
+        if time.time_ns() > self._snapshotAge + self.roomCacheSnapshotInterval * 1000000000:
+            self._snapshotAge = time.time_ns()
+            await self._saveRoomCacheSnapshot()
+
+    def _noteRoomActivity(self, roomID, eventCount):
+        """
+            Count timeline events per room, so the lazy warm up gets to the busy rooms first
+        """
+        count = self._roomActivity.get(roomID, 0) + eventCount
+        self._roomActivity[roomID] = count
+        if self._warmTask is not None and not self._warmTask.done() and not self._isCached(roomID):
+            heapq.heappush(self._warmQueue, (-count, roomID))
+
+    async def _lazyWarmRoomCache(self):
+        """
+            Background task for roomCacheMode="lazy". Fetches one room at a time, the most active rooms first,
+            skipping rooms that were already fetched on first use
+        """
+        try:
+            joined_rooms = await self.restrunner.joinedRooms_async()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning("Could not list joined rooms, rooms will only be cached on first use: " + str(e))
+            return
+
+        for roomID in joined_rooms:
+            heapq.heappush(self._warmQueue, (-self._roomActivity.get(roomID, 0), roomID))
+
+        warmed = 0
+        while self._warmQueue:
+            negativeCount, roomID = heapq.heappop(self._warmQueue)
+            #stale entry, the room got busier (and was pushed again) or is already cached
+            if -negativeCount != self._roomActivity.get(roomID, 0) or self._isCached(roomID):
+                continue
+
+            if getattr(self.roomCache["rooms"], "full", False):
+                logging.info("Room cache is full, the rest of the rooms will be cached on first use")
+                break
+
+            try:
+                await asyncio.wait_for(self._addRoomToCache_async(roomID), self.roomCacheTimeout)
+                warmed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning("Could not cache room " + roomID + ": " + (str(e) or type(e).__name__))
+
+            #stay out of the way of dispatch
+            await asyncio.sleep(0)
+
+        logging.info("Room cache: warmed " + str(warmed) + " rooms in the background")
+
+    def _roomFromSync(self, roomID, joinedRoom):
+        """
+            @param roomID String the room ID
+            @param joinedRoom dict the rooms.join entry for the room from /sync
+
+            @return room built from the state section, plus any state changes in the timeline
+        """
+        events = list(joinedRoom.get("state", {}).get("events", []))
+        events += [event for event in joinedRoom.get("timeline", {}).get("events", []) if "state_key" in event]
+        return self._roomClass(rawEvents=events, roomID=roomID)
+
+    async def _warmRoomCache(self, roomIDs):
+        """
+            Fetch the state of many rooms at once, at most roomCacheConcurrency at a time.
+            A room that fails or takes longer than roomCacheTimeout is skipped, and gets fetched on first use instead
+
+            @param roomIDs list the rooms to fetch
+
+            @return (int, int) how many rooms were loaded and how many failed
+        """
+        total = len(roomIDs)
+        progress = {"loaded": 0, "failed": 0, "logged": 0}
+        slots = asyncio.Semaphore(self.roomCacheConcurrency)
+
+        async def warm(roomID):
+            async with slots:
+                try:
+                    await asyncio.wait_for(self._addRoomToCache_async(roomID), self.roomCacheTimeout)
+                    progress["loaded"] += 1
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    progress["failed"] += 1
+                    logging.warning("Could not cache room " + roomID + ": " + (str(e) or type(e).__name__))
+
+            done = progress["loaded"] + progress["failed"]
+            #log every 10%, the handler hears about every room
+            if done * 10 // total > progress["logged"]:
+                progress["logged"] = done * 10 // total
+                logging.info("Room cache: " + str(done) + "/" + str(total) + " rooms (" + str(progress["failed"]) + " failed)")
+            try:
+                await self.on_room_cache_progress(progress["loaded"], progress["failed"], total)
+            except Exception as e:
+                logging.error("on_room_cache_progress raised: " + str(e))
+
+        if total:
+            await asyncio.gather(*[warm(roomID) for roomID in roomIDs])
+        return progress["loaded"], progress["failed"]
 
     def _refreshRoomCache(self):
         """
@@ -158,21 +543,64 @@ class Client:
         for roomID in self.roomCache["rooms"]:
             self._addRoomToCache(roomID)
 
+    async def _refreshRoomCache_async(self):
+        """
+            Used to refresh the room caches existing rooms - Async version
+        """
+        await self._warmRoomCache(list(self.roomCache["rooms"]))
+
     def _addRoomToCache(self, roomID):
         """
             Add a room to the room cache, can be used to refresh an old room cache
         """
-        self.roomCache["rooms"][roomID] = room(rawEvents=self.restrunner.getRoomState(roomID), roomID=roomID)
+        self.roomCache["rooms"][roomID] = self._roomClass(rawEvents=self.restrunner.getRoomState(roomID), roomID=roomID)
 
     async def _addRoomToCache_async(self, roomID):
         """
-            Add a room to the room cache, can be used to refresh an old room cache - Async version
+            Add a room to the room cache, can be used to refresh an old room cache - Async version.
+            If the room is already being fetched, this waits for that fetch instead of starting another
+        """
+        await self._roomFills.do(roomID, functools.partial(self._fillRoom, roomID))
+
+    async def _fillRoom(self, roomID):
+        """
+            Fetch a room's state and cache it. Use _addRoomToCache_async, which makes sure only one runs per room
         """
+        try:
+            rawEvents = await self.restrunner.getRoomState_async(roomID)
+        except Exception:
+            retryIn = self.roomFailures.failed(roomID)
+            logging.debug("Not fetching room " + roomID + " again for " + str(retryIn) + "s")
+            raise
+        self.roomFailures.succeeded(roomID)
+
         self._ensure_async_lock()
         async with self._cache_lock:
-            self.roomCache["rooms"][roomID] = room(rawEvents=self.restrunner.getRoomState(roomID), roomID=roomID)
+            self.roomCache["rooms"][roomID] = self._roomClass(rawEvents=rawEvents, roomID=roomID)
 
 
+    def _cachedRoom(self, roomID):
+        """
+            @param roomID String the room ID
+
+            @return the cached room, or None if it isn't cached. Never fetches
+        """
+        return self.roomCache.get("rooms", {}).get(roomID)
+
+    def _isCached(self, roomID):
+        """Like _cachedRoom, but doesn't count as a use of the room"""
+        return roomID in self.roomCache.get("rooms", {})
+
+    def _forgetRoom(self, roomID):
+        """
+            Drop a room we left from the cache
+        """
+        rooms = self.roomCache.get("rooms", {})
+        if isinstance(rooms, RoomCache):
+            rooms.discard(roomID)
+        else:
+            rooms.pop(roomID, None)
+
     def _getRoom(self, roomID):
         """
             retrieve a room from the roomcache, caching if it is not already in the cache
@@ -187,7 +615,31 @@ class Client:
             if roomID in self.roomCache["rooms"]:
                 return self.roomCache["rooms"][roomID]
             else:
-                return room()
+                return self._roomClass()
+
+    async def _getRoom_async(self, roomID):
+        """
+            retrieve a room from the roomcache, caching if it is not already in the cache - Async version
+            @param roomID String the room ID
+        """
+        cachedRoom = self._cachedRoom(roomID)
+        if cachedRoom is not None:
+            return cachedRoom
+
+        #failed recently, don't hammer the server on every message
+        if self.roomFailures.blocked(roomID):
+            return self._roomClass()
+
+        try:
+            await self._addRoomToCache_async(roomID)
+        except Exception as e:
+            logging.warning("Could not fetch room " + roomID + ": " + str(e))
+
+        #if it doesn't populate, return an empty room
+        if roomID in self.roomCache["rooms"]:
+            return self.roomCache["rooms"][roomID]
+        else:
+            return self._roomClass()
 
     def _destruction(self):
         if self.logoutOnDeath:
@@ -201,8 +653,35 @@ class Client:
         """Async version of cleanup with proper resource management"""
         if self.logoutOnDeath:
             logging.info("Logging out user")
-            logging.info(str(self._logoutUser()))
+            logging.info(str(await self._logoutUser_async()))
         
+        if self._warmTask is not None:
+            self._warmTask.cancel()
+        if self._refreshTask is not None:
+            self._refreshTask.cancel()
+
+        # Let running handlers finish before the session goes away, including messages still waiting on their room
+        if self._roomWaits:
+            await asyncio.wait(list(self._roomWaits))
+        try:
+            await self.dispatcher.close()
+        except Exception as e:
+            logging.error("Error while stopping the dispatcher: " + str(e))
+
+        if self.checkpoint:
+            await self.checkpoint.close()
+
+        #the last save waits for one still writing, and the store is closed only once nothing is writing to it
+        if self.roomCacheSnapshot:
+            await self._saveRoomCacheSnapshot()
+            if self._snapshotSave is not None:
+                await asyncio.wait([self._snapshotSave])
+            self.roomCacheSnapshot.close()
+
+        # Unsent events stay in the outbox store for the next run
+        if self.outbox:
+            await self.outbox.close()
+
         # Close aiohttp session
         if self.restrunner:
             await self.restrunner._close_session()
@@ -219,15 +698,83 @@ class Client:
 
         return self.restrunner.revokeAccessToken(revokeAllTokens)
 
+    async def _logoutUser_async(self, revokeAllTokens=False):
+        """
+            Revoke the specified access token, or all - Async version
+            
+            @param revokeAllTokens Bool Revoke every valid session token, on all devices.
+        """
+
+        return await self.restrunner.revokeAccessToken_async(revokeAllTokens)
+
 
     async def _homeserverSync(self):
+        """
+            Run one sync, then dispatch everything in it
+        """
+        if self.streamSync:
+            await self._streamedSync()
+            return
 
-        resp = await self.restrunner.sync_async(since=self.sinceToken, timeout=self.long_poll_timeout)
-        if "next_batch" not in resp:#This should catch bad syncs
+        resp = await self._fetchSync()
+        if resp is None:
             return
 
+        await self._processSync(resp)
+
+    async def _fetchSync(self):
+        """
+            Long poll the homeserver for the next batch. As soon as this returns, the sinceToken points at the batch after it
+
+            @return dict the sync response, or None for a bad sync
+        """
+        try:
+            resp = await self.restrunner.sync_async(serverSideFilter=self.syncFilterID, since=self.sinceToken, timeout=self.long_poll_timeout)
+        except aiohttp.ClientResponseError as e:
+            if await self._syncFilterRejected(e.status):
+                return None
+            raise
+        if "next_batch" not in resp:#This should catch bad syncs
+            await self._syncFilterRejected(resp.get("errcode"))
+            return None
+
         self.sinceToken = resp["next_batch"]
+        return resp
+
+    async def _processSync(self, resp):
+        """
+            Hand every event in a sync response to the dispatcher
 
+            @param resp dict a sync response from _fetchSync
+        """
+        batch = self.checkpoint.begin(resp["next_batch"]) if self.checkpoint else None
+        await self._dispatchSync(resp, batch)
+        self._roomCacheToken = resp["next_batch"]
+
+        #Everything has been submitted, once the handlers finish the token can be committed
+        if batch is not None:
+            self.checkpoint.seal(batch)
+
+    async def _dispatch(self, batch, roomID, handler, *args):
+        """
+            Submit a handler to the dispatcher, tracking it against its sync batch when checkpointing
+
+            @param batch the checkpoint batch, or None
+            @param roomID String the room the event came from
+            @param handler coroutine function the event handler
+        """
+        if batch is None:
+            await self.dispatcher.submit(roomID, handler, *args)
+            return
+
+        tracked = self.checkpoint.track(batch, handler)
+        try:
+            await self.dispatcher.submit(roomID, tracked, *args)
+        except BaseException:
+            tracked.release()
+            raise
+
+    async def _dispatchSync(self, resp, batch):
         if "device_one_time_keys_count" in resp:
             if "signed_curve25519" in resp["device_one_time_keys_count"]:
                 self.encryptedCurveCount = resp["device_one_time_keys_count"]["signed_curve25519"]
@@ -248,16 +795,7 @@ class Client:
             #events for rooms you are in
             if "join" in resp["rooms"]:
                 for roomID in resp["rooms"]["join"]:
-                    if "timeline" in resp["rooms"]["join"][roomID]:
-                        if "events" in resp["rooms"]["join"][roomID]["timeline"]:
-                            for event in resp["rooms"]["join"][roomID]["timeline"]["events"]:
-                                if event["type"] == "m.room.message":
-                                    #support asyncio.create_task( ?
-                                    newMsg = message(event, self._getRoom(roomID))
-                                    if newMsg.edit:
-                                        await self.on_message_edit(newMsg)
-                                    else:
-                                        await self.on_message(newMsg)
+                    await self._dispatchJoinedRoom(roomID, resp["rooms"]["join"][roomID], batch)
 
             if "invite" in resp["rooms"]:
                 for roomID in resp["rooms"]["invite"]:
@@ -268,17 +806,156 @@ class Client:
                                 Because of this, we are going to compress the following types inside the room obj
                                 m.room.create m.room.join_rules m.room.name m.room.member 
                             """
-                            newRoom = room(rawEvents=resp["rooms"]["invite"][roomID]["invite_state"]["events"], roomID=roomID)
-                            await self.on_room_invite(newRoom)
+                            newRoom = self._roomClass(rawEvents=resp["rooms"]["invite"][roomID]["invite_state"]["events"], roomID=roomID)
+                            await self._dispatch(batch, roomID, self.on_room_invite, newRoom)
                     
 
             if "leave" in resp["rooms"]:
                 for roomID in resp["rooms"]["leave"]:
-                    await self.on_room_leave(roomID)
+                    self._forgetRoom(roomID)
+                    await self._dispatch(batch, roomID, self.on_room_leave, roomID)
 
         #print(json.dumps(resp))
         #print(json.dumps(self.restrunner.sync(since=self.sinceToken)))
 
+    async def _dispatchJoinedRoom(self, roomID, joinedRoom, batch):
+        """
+            Update the cache from, and dispatch the timeline of, one joined room in a sync response
+
+            @param roomID String the room ID
+            @param joinedRoom dict the rooms.join entry for the room
+            @param batch the checkpoint batch, or None
+        """
+        cachedRoom = self._cachedRoom(roomID)
+        stateChanged = False
+        if cachedRoom is not None and "state" in joinedRoom:
+            cachedRoom.apply_state_events(joinedRoom["state"].get("events", []))
+            stateChanged = True
+
+        if "timeline" in joinedRoom:
+            if "events" in joinedRoom["timeline"]:
+                self._noteRoomActivity(roomID, len(joinedRoom["timeline"]["events"]))
+                for event in joinedRoom["timeline"]["events"]:
+                    #state changes in the timeline keep the cache current, in order with the messages
+                    if cachedRoom is not None and "state_key" in event:
+                        cachedRoom.apply_state_event(event)
+                        stateChanged = True
+
+                    if event["type"] == "m.room.message":
+                        if cachedRoom is None or roomID in self._awaitingRoom:
+                            #fetch the room off the sync path, the message goes out once it's in
+                            await self._dispatchOnceCached(batch, roomID, event)
+                            continue
+
+                        await self._dispatchMessage(batch, roomID, self._messageClass(event, cachedRoom))
+
+        if stateChanged and isinstance(self.roomCache["rooms"], RoomCache):
+            self.roomCache["rooms"].resize(roomID)
+
+    async def _dispatchMessage(self, batch, roomID, newMsg):
+        if newMsg.edit:
+            await self._dispatch(batch, roomID, self.on_message_edit, newMsg)
+        else:
+            await self._dispatch(batch, roomID, self.on_message, newMsg)
+
+    async def _dispatchOnceCached(self, batch, roomID, event):
+        """
+            Hand on a message from a room that isn't cached. The room is fetched in the background and the message
+            queued until it's in, so the sync loop never waits on the fetch, whatever the dispatcher. Later messages
+            from the room queue up behind it, and the batch isn't committed until they've gone out. Once the room
+            is in, the sync loop waits for the queue like it would for any handler, and carries on as usual
+        """
+        fetch = self._awaitingRoom.get(roomID)
+        if fetch is not None and fetch.done:
+            await asyncio.shield(fetch.task)
+            fetch = None
+
+        if fetch is None:
+            cachedRoom = self._cachedRoom(roomID)
+            if cachedRoom is not None:
+                await self._dispatchMessage(batch, roomID, self._messageClass(event, cachedRoom))
+                return
+            fetch = self._awaitingRoom[roomID] = _RoomFetch()
+            fetch.task = asyncio.ensure_future(self._fetchAndDispatch(roomID, fetch))
+            self._roomWaits.add(fetch.task)
+            fetch.task.add_done_callback(self._roomWaits.discard)
+
+        handler = self.checkpoint.track(batch, self._dispatchUncachedMessage) if batch is not None else self._dispatchUncachedMessage
+        fetch.waiting.append((handler, event))
+
+    async def _fetchAndDispatch(self, roomID, fetch):
+        """
+            Background task for _dispatchOnceCached. Fetches the room, then hands every queued message to the dispatcher
+        """
+        try:
+            try:
+                await asyncio.wait_for(self._getRoom_async(roomID), self.roomCacheTimeout)
+            except asyncio.TimeoutError:
+                logging.warning("Could not fetch room " + roomID + " in time, handling its messages without it")
+            fetch.done = True
+
+            while fetch.waiting:
+                handler, event = fetch.waiting.pop(0)
+                try:
+                    await self.dispatcher.submit(roomID, handler, roomID, event)
+                except Exception as e:
+                    #nobody up the stack to hand this to, a sequential dispatcher raises handler errors here
+                    logging.error("Error handling a message from " + roomID + ": " + (str(e) or type(e).__name__))
+                    if hasattr(handler, "release"):
+                        #no-op if it ran, frees the batch if the dispatcher never took it
+                        handler.release()
+        finally:
+            for handler, event in fetch.waiting:
+                if hasattr(handler, "release"):
+                    handler.release()
+            if self._awaitingRoom.get(roomID) is fetch:
+                del self._awaitingRoom[roomID]
+
+    async def _dispatchUncachedMessage(self, roomID, event):
+        """
+            Handler for a message from a room that isn't cached yet. Fetches the room, then hands the message on
+        """
+        newMsg = self._messageClass(event, await self._getRoom_async(roomID))
+        if newMsg.edit:
+            await self.on_message_edit(newMsg)
+        else:
+            await self.on_message(newMsg)
+
+    async def _streamedSync(self):
+        """
+            Run one sync, dispatching each joined room while the rest of the response is still downloading
+        """
+        ignoring = self.ignoreFirstSync and self.firstSync
+        batch = self.checkpoint.begin(None) if self.checkpoint else None
+        resp = None
+        try:
+            try:
+                async for section, roomID, data in self.restrunner.sync_stream_async(serverSideFilter=self.syncFilterID, since=self.sinceToken, timeout=self.long_poll_timeout):
+                    if section == "join":
+                        if not ignoring:
+                            await self._dispatchJoinedRoom(roomID, data, batch)
+                    else:
+                        resp = data
+            except aiohttp.ClientResponseError as e:
+                if await self._syncFilterRejected(e.status):
+                    return
+                raise
+
+            if resp is None or "next_batch" not in resp:#This should catch bad syncs
+                return
+
+            self.sinceToken = resp["next_batch"]
+            if batch is not None:
+                batch.token = resp["next_batch"]
+
+            #the joined rooms are already handled, this does invites, leaves and the first sync bookkeeping
+            await self._dispatchSync(resp, batch)
+            self._roomCacheToken = resp["next_batch"]
+        finally:
+            #a batch that never got its token just drops out, without committing anything
+            if batch is not None:
+                self.checkpoint.seal(batch)
+
     async def send_message(self, roomID, body, textFormat=None, replyTo=None, isNotice=False):
         """
             Send a message to a specified room.
@@ -336,9 +1013,17 @@ class Client:
                 }
             }
 
-        return(await self.restrunner.sendEvent_async(roomID=roomID, eventType="m.room.message", eventPayload=messageContent))
+        return(await self._sendEvent(roomID, "m.room.message", messageContent))
     
 
+    async def _sendEvent(self, roomID, eventType, eventPayload):
+        """
+            Send through the outbox if there is one, straight to the server if not
+        """
+        if self.outbox:
+            return await self.outbox.send(roomID, eventType, eventPayload)
+        return await self.restrunner.sendEvent_async(roomID=roomID, eventType=eventType, eventPayload=eventPayload)
+
     async def send_typing(self, roomID, seconds=None):
         """
             Send a typing event to a room. Useful when doing a lot of work in the background
@@ -346,7 +1031,7 @@ class Client:
             @param roomID String the room id that you want to type in
             @param seconds int OPTIONAL How many seconds you want to type for. Default 10
         """
-        self.restrunner.sendTyping(roomID, seconds)
+        await self.restrunner.sendTyping_async(roomID, seconds)
 
 
     async def _send_file(self, roomID, body, fileURL, messageType=None, info=None, fileName=None):
@@ -382,7 +1067,7 @@ class Client:
         if fileName:
             messageContent["filename"] = fileName
 
-        return(await self.restrunner.sendEvent_async(roomID=roomID, eventType="m.room.message", eventPayload=messageContent))
+        return(await self._sendEvent(roomID, "m.room.message", messageContent))
 
 
     async def send_image(self, roomID, fileBuffer, fileName, generate_blurhash=True, generate_thumbnail=True):
@@ -433,8 +1118,8 @@ class Client:
 
 
     async def join_room(self, roomID):
-        resp = self.restrunner.joinRoom(roomID)
-        self._addRoomToCache(roomID)#update the cache, since we might be able to see more room info
+        resp = await self.restrunner.joinRoom_async(roomID)
+        await self._addRoomToCache_async(roomID)#update the cache, since we might be able to see more room info
         return resp
 
 
@@ -449,7 +1134,7 @@ class Client:
         #validation for presence value?
         #halcyon.Status.idle
 
-        resp = self.restrunner.setUserPresence(presence=presence, statusMessage=statusMessage)
+        resp = await self.restrunner.setUserPresence_async(presence=presence, statusMessage=statusMessage)
         # {'errcode': 'M_NOT_JSON', 'error': 'Content not JSON.'}
         if 'errcode' in resp:
             logging.error("Change presence error: " + resp["error"])
@@ -497,8 +1182,76 @@ class Client:
     def event(self, coro):
         # Validation we don't need to worry about
         setattr(self, coro.__name__, coro)
+        self._handlers.add(coro.__name__)
         return coro
 
+    def _handlerNames(self):
+        """
+            @return set the handlers registered with @client.event, plus the ones a Client subclass overrides
+        """
+        names = set(self._handlers)
+        for name in dir(Client):
+            if name.startswith("on_") and getattr(type(self), name) is not getattr(Client, name):
+                names.add(name)
+        return names
+
+    def _buildSyncFilter(self):
+        """
+            @return dict the filter definition to use, or None to sync everything
+        """
+        if self.syncFilter is None:
+            return None
+        if self.syncFilter == "auto":
+            return SyncFilter.fromHandlers(self._handlerNames()).toDict()
+        if isinstance(self.syncFilter, SyncFilter):
+            return self.syncFilter.toDict()
+        return self.syncFilter
+
+    async def _resolveSyncFilter(self):
+        """
+            Register the sync filter with the homeserver, reusing a cached filter ID when we've uploaded the same filter before
+        """
+        definition = self._buildSyncFilter()
+        if definition is None:
+            return
+
+        key = self._syncFilterKey = filterHash(definition, str(self.restrunner.USER_ID) + "@" + str(self.restrunner.HOMESERVER))
+        filterID = self.filterCache.get(key)
+        if filterID:
+            self.syncFilterID = filterID
+            return
+
+        try:
+            resp = await self.restrunner.createFilter_async(definition)
+        except Exception as e:
+            logging.warning("Could not register sync filter, syncing everything: " + str(e))
+            return
+
+        if "filter_id" not in resp:
+            logging.warning("Could not register sync filter, syncing everything: " + str(resp))
+            return
+
+        self.syncFilterID = resp["filter_id"]
+        self.filterCache.set(key, self.syncFilterID)
+
+    async def _syncFilterRejected(self, error):
+        """
+            A sync that fails with 400/404 (M_UNKNOWN, M_NOT_FOUND) while we send a filter ID usually means the
+            homeserver doesn't know that filter anymore. Forget the cached ID and upload the filter again
+
+            @param error int/String the HTTP status or errcode the sync failed with
+
+            @return bool whether the filter was registered again, so the sync is worth retrying
+        """
+        if self.syncFilterID is None or error not in (400, 404, "M_UNKNOWN", "M_NOT_FOUND"):
+            return False
+
+        logging.warning("Homeserver rejected sync filter " + str(self.syncFilterID) + ", registering it again")
+        self.filterCache.forget(self._syncFilterKey)
+        self.syncFilterID = None
+        await self._resolveSyncFilter()
+        return True
+
     async def __aenter__(self):
         """Async context manager entry"""
         self._ensure_async_lock()
@@ -528,21 +1281,119 @@ class Client:
         """on room leave passes room id"""
         pass
 
+    async def on_room_cache_progress(self, loaded, failed, total):
+        """on room cache progress stub. Called after every room while the cache warms up"""
+        pass
+
+    async def _maybeRefreshRoomCache(self):
+        """
+            Start a background refresh of the room cache if it is older than roomCacheRefreshInterval.
+            Sync carries on while it runs
+        """
+        if not self.roomCacheRefreshInterval:
+            return
+        if self._refreshTask is not None and not self._refreshTask.done():
+            return
+
+        if (time.time_ns() > (self.roomCache["cache_age"] + self.roomCacheRefreshInterval * 1000000000)):
+            logging.debug("Updating room cache")
+            self._ensure_async_lock()
+            async with self._cache_lock:
+                self.roomCache["cache_age"] = time.time_ns()
+            self._refreshTask = asyncio.ensure_future(self._refreshRoomCache_async())
+
+    def _loadCheckpoint(self):
+        """
+            Resume from the last committed since token, if we have one
+        """
+        if not self.checkpoint:
+            return
+
+        self.checkpoint.key = str(self.restrunner.USER_ID)
+        token = self.checkpoint.load()
+        if token:
+            logging.info("Resuming sync from checkpoint")
+            self.sinceToken = token
+            #this sync holds everything we missed while offline, so don't throw it away
+            self.firstSync = False
+
     async def _halcyonMainLoop(self):
+        await self._roomcacheinit_async()
+        self._loadCheckpoint()
+        if self.outbox:
+            self.outbox.bind(self.restrunner)
+        await self._resolveSyncFilter()
         await self.on_ready()
+        if self.pipelineSync:
+            await self._pipelinedMainLoop()
+            return
+
         while True:
             await self._homeserverSync()
 
-            #update room cache every hour
-            if (time.time_ns() > (self.roomCache["cache_age"] + 3600000000000)):
-                logging.debug("Updating room cache")
-                self._ensure_async_lock()
-                async with self._cache_lock:
-                    self.roomCache["cache_age"] = time.time_ns()
-                    self._refreshRoomCache()
+            #full room cache refresh, every hour by default
+            await self._maybeRefreshRoomCache()
+            await self._maybeSaveRoomCacheSnapshot()
 
             await asyncio.sleep(self.loopPollInterval)
 
+    async def _syncProducer(self, batches, slots):
+        """
+            Keep a long poll open at all times. Each batch is queued for dispatch, and the next poll starts straight away.
+            A poll only starts once it has a slot, so fetched batches waiting for dispatch, plus the poll in flight,
+            never go over maxPendingBatches
+
+            @param batches asyncio.Queue where the sync responses go
+            @param slots asyncio.Semaphore with maxPendingBatches slots, the main loop frees one as it takes a batch
+        """
+        failures = 0
+        while True:
+            await slots.acquire()
+            try:
+                resp = await self._fetchSync()
+            except asyncio.CancelledError:
+                slots.release()
+                raise
+            except Exception as e:
+                slots.release()
+                failures += 1
+                backoff = min(2 ** failures, 60)
+                logging.warning("Sync failed, retrying in " + str(backoff) + "s: " + str(e))
+                await asyncio.sleep(backoff)
+                continue
+
+            failures = 0
+            if resp is None:
+                slots.release()
+                await asyncio.sleep(self.loopPollInterval)
+                continue
+
+            batches.put_nowait(resp)
+
+    async def _pipelinedMainLoop(self):
+        """
+            Sync and dispatch at the same time. The next /sync is already in flight while the current batch is handled
+        """
+        batches = asyncio.Queue()
+        slots = asyncio.Semaphore(self.maxPendingBatches)
+        producer = asyncio.ensure_future(self._syncProducer(batches, slots))
+        try:
+            while True:
+                getter = asyncio.ensure_future(batches.get())
+                done, _ = await asyncio.wait({getter, producer}, return_when=asyncio.FIRST_COMPLETED)
+                if getter not in done:
+                    getter.cancel()
+                    producer.result()#surface whatever killed the producer
+                    return
+
+                #the batch is ours now, let the producer start the next poll while we handle it
+                slots.release()
+                await self._processSync(getter.result())
+                await self._maybeRefreshRoomCache()
+                await self._maybeSaveRoomCacheSnapshot()
+        finally:
+            producer.cancel()
+
     def run(self, halcyonToken=None, userID=None, password=None, homeserver=None, loopPollInterval=None, longPollTimeout=None):
         
         if loopPollInterval:
@@ -555,7 +1406,6 @@ class Client:
 
         #login
         self._init(halcyonToken, userID, password, homeserver)
-        self._roomcacheinit()
         
         # Set up event loop properly
         if self.loop is None:
@@ -0,0 +1,75 @@
+"""
+    Shared plumbing for the lazily parsed models (LazyRoom, LazyMessage).
+
+    A lazy model leaves some of its fields out of __dict__ until they're first read, and builds them in
+    __getattr__. Anything that looks at every field at once (dumping, comparing, copying, pickling) has to build
+    the rest first, which is what this mixin does. Put it before the model in the bases.
+"""
+
+
+class LazyFieldsMixin:
+    def _init_lazy(self, values, private):
+        """
+            Set the model up the way pydantic's __init__ would, without validating anything. The fields in values
+            go in as they are, everything else is left for __getattr__
+        """
+        object.__setattr__(self, "__dict__", values)
+        object.__setattr__(self, "__pydantic_fields_set__", set(values))
+        object.__setattr__(self, "__pydantic_extra__", {} if self.model_config.get("extra") == "allow" else None)
+        object.__setattr__(self, "__pydantic_private__", private)
+
+    def _materialise_all(self):
+        """Build every field that hasn't been read yet"""
+        raise NotImplementedError
+
+    def _set_lazy(self, name, value):
+        """Validate a field the way the model's __init__ would have (unless we're trusted), and keep it"""
+        if self.security().trusted:
+            convert = self.trusted_converters.get(name)
+            if convert is not None and value is not None:
+                value = convert(value)
+            self.__dict__[name] = value
+            self.__pydantic_fields_set__.add(name)
+            return value
+        self.__pydantic_validator__.validate_assignment(self, name, value)
+        return self.__dict__[name]
+
+    def _load_all(self):
+        """Build everything, and put the fields back in declaration order so dumps match the eager model"""
+        self._materialise_all()
+        fields = type(self).model_fields
+        if list(self.__dict__)[:len(fields)] != list(fields):
+            ordered = {name: self.__dict__[name] for name in fields if name in self.__dict__}
+            ordered.update(self.__dict__)
+            self.__dict__.clear()
+            self.__dict__.update(ordered)
+        # Dumping serialises nested models without going through their model_dump
+        for value in self.__dict__.values():
+            if isinstance(value, LazyFieldsMixin):
+                value._load_all()
+
+    def model_dump(self, **kwargs):
+        self._load_all()
+        return super().model_dump(**kwargs)
+
+    def model_dump_json(self, **kwargs):
+        self._load_all()
+        return super().model_dump_json(**kwargs)
+
+    def model_copy(self, **kwargs):
+        self._load_all()
+        return super().model_copy(**kwargs)
+
+    def __repr_args__(self):
+        self._load_all()
+        return super().__repr_args__()
+
+    def __eq__(self, other):
+        self._load_all()
+        if isinstance(other, LazyFieldsMixin):
+            other._load_all()
+        return super().__eq__(other)
+
+    def __getstate__(self):
+        self._load_all()
+        return super().__getstate__()
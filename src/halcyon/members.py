@@ -0,0 +1,222 @@
+"""
+    Compact member store for Room.
+
+    A room used to keep a pydantic RoomMember per member event plus three plain lists, so a membership check was a
+    list scan and an 80k member room cost tens of MB. MemberTable keeps one row per user instead: the interned
+    user ID, a membership code in an array, and the member event's content (which the room already holds in its
+    raw state). RoomMember objects are only built when member_details is read. The members, left and invited views
+    are still lists, but keep every user's position, so `user in room.members` and moving a user between them
+    are O(1).
+"""
+
+import functools
+import sys
+from array import array
+from collections.abc import MutableMapping
+
+
+# Membership codes kept in MemberTable, UNKNOWN_MEMBERSHIP is read back from the content
+MEMBERSHIPS = ("leave", "join", "invite", "ban", "knock")
+MEMBERSHIP_CODES = {membership: code for code, membership in enumerate(MEMBERSHIPS)}
+UNKNOWN_MEMBERSHIP = 255
+
+
+class MembershipView(list):
+    """
+        The users with one membership. A real list, with every user's position in it kept alongside, so checking
+        for a user or taking one out doesn't scan it. Users are in the order they got the membership, except that
+        the table takes a user out by moving the last user into their place. Edits the positions can't follow
+        cheaply (insert, sort, slicing...) drop them, and they're worked out again on next use
+    """
+    __slots__ = ("_positions",)
+
+    def __init__(self, userIDs=()):
+        super().__init__(userIDs)
+        self._positions = None
+
+    def _index(self):
+        positions = self._positions
+        if positions is None:
+            positions = self._positions = dict()
+            for position, userID in enumerate(self):
+                positions.setdefault(userID, position)
+        return positions
+
+    def _add(self, userID):
+        positions = self._index()
+        positions.setdefault(userID, len(self))
+        list.append(self, userID)
+
+    def _discard(self, userID):
+        """Take a user out in O(1), the last user takes their place"""
+        positions = self._index()
+        position = positions.pop(userID, None)
+        if position is None:
+            return
+        if len(positions) + 1 != len(self):
+            #someone appended a user twice, only a plain delete keeps the positions right
+            list.__delitem__(self, position)
+            self._positions = None
+            return
+
+        last = list.pop(self)
+        if position < len(self):
+            list.__setitem__(self, position, last)
+            positions[last] = position
+
+    def __contains__(self, userID):
+        return userID in self._index()
+
+    def __reduce_ex__(self, protocol):
+        # Rebuilt from the users alone, the positions are worked out again
+        return (type(self), (list(self),))
+
+    def append(self, userID):
+        self._add(userID)
+
+
+def _dropsPositions(method):
+    @functools.wraps(method)
+    def edit(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._positions = None
+        return result
+    return edit
+
+
+for _name in ("extend", "insert", "remove", "pop", "clear", "sort", "reverse", "__setitem__", "__delitem__", "__iadd__", "__imul__"):
+    setattr(MembershipView, _name, _dropsPositions(getattr(list, _name)))
+
+
+class MemberDetails(MutableMapping):
+    """room.member_details, a RoomMember is built the first time a user's details are read"""
+    __slots__ = ("_table",)
+
+    def __init__(self, table):
+        self._table = table
+
+    def __getitem__(self, userID):
+        return self._table.member(userID)
+
+    def __setitem__(self, userID, member):
+        self._table.setMember(userID, member)
+
+    def __delitem__(self, userID):
+        self._table.forget(userID)
+
+    def __contains__(self, userID):
+        return userID in self._table
+
+    def __iter__(self):
+        return iter(self._table._rows)
+
+    def __len__(self):
+        return len(self._table)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class MemberTable:
+    """
+        Every user with a membership in the room, one row each
+
+        @param memberClass class to build a RoomMember with, from (user_id, content)
+    """
+    __slots__ = ("memberClass", "_rows", "_userIDs", "_codes", "_content", "_built", "joined", "left", "invited",
+                 "details", "_views")
+
+    def __init__(self, memberClass):
+        self.memberClass = memberClass
+        self._rows = dict()
+        self._userIDs = []
+        self._codes = array("B")
+        self._content = []
+        self._built = dict()
+
+        self.joined = MembershipView()
+        self.left = MembershipView()
+        self.invited = MembershipView()
+        self.details = MemberDetails(self)
+        self._views = {"join": self.joined, "leave": self.left, "invite": self.invited}
+
+    def _row(self, userID):
+        row = self._rows.get(userID)
+        if row is None:
+            userID = sys.intern(userID)
+            row = self._rows[userID] = len(self._userIDs)
+            self._userIDs.append(userID)
+            self._codes.append(UNKNOWN_MEMBERSHIP)
+            self._content.append(None)
+        return row
+
+    def apply(self, userID, content):
+        """
+            Record a member event. A membership change moves the user to the end of their new view, like the
+            old lists did
+        """
+        if userID in self._rows:
+            for view in self._views.values():
+                view._discard(userID)
+            self._built.pop(userID, None)
+
+        row = self._row(userID)
+        membership = content.get("membership")
+        self._codes[row] = MEMBERSHIP_CODES.get(membership, UNKNOWN_MEMBERSHIP)
+        self._content[row] = content
+
+        view = self._views.get(membership)
+        if view is not None:
+            view._add(self._userIDs[row])
+
+    def membership(self, userID):
+        """
+            @return str the user's membership, without building their RoomMember. None if they have none
+        """
+        row = self._rows.get(userID)
+        if row is None:
+            return None
+        code = self._codes[row]
+        if code == UNKNOWN_MEMBERSHIP:
+            return (self._content[row] or {}).get("membership", "leave")
+        return MEMBERSHIPS[code]
+
+    def member(self, userID):
+        """
+            @return RoomMember for the user, built on first use. Raises KeyError if they have no membership
+        """
+        member = self._built.get(userID)
+        if member is None:
+            row = self._rows[userID]
+            member = self._built[userID] = self.memberClass(self._userIDs[row], self._content[row])
+        return member
+
+    def setMember(self, userID, member):
+        """Store a RoomMember as is. Like assigning into the old dict, the views are left alone"""
+        row = self._row(userID)
+        self._codes[row] = MEMBERSHIP_CODES.get(member.membership, UNKNOWN_MEMBERSHIP)
+        self._content[row] = member._raw or {"membership": member.membership}
+        self._built[userID] = member
+
+    def forget(self, userID):
+        row = self._rows.pop(userID)
+        self._userIDs[row] = None
+        self._content[row] = None
+        self._built.pop(userID, None)
+
+    def __contains__(self, userID):
+        return userID in self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _state(self):
+        return ({userID: self._content[row] for userID, row in self._rows.items()},
+                self.joined, self.left, self.invited)
+
+    def __eq__(self, other):
+        if not isinstance(other, MemberTable):
+            return NotImplemented
+        return self._state() == other._state()
+
+    __hash__ = None
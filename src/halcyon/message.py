@@ -1,7 +1,9 @@
-from pydantic import BaseModel, Field, field_validator, PrivateAttr
-from typing import Optional, Dict, Any, Union, List
+from pydantic import Field, field_validator, PrivateAttr
+from typing import Optional, Dict, Any, Union, List, ClassVar
 from halcyon.enums import msgType
-from halcyon.security import get_nested_config, get_message_config, get_security_mode
+from halcyon.security import get_nested_config, get_message_config
+from halcyon.lazy import LazyFieldsMixin
+from halcyon.model import HalcyonModel
 
 """
     Matrix message content handler. Supports all Matrix message types with full spec compliance (v1.15).
@@ -28,7 +30,7 @@ from halcyon.security import get_nested_config, get_message_config, get_security
         - Full backward compatibility with existing code
 """
 
-class IdReturn(BaseModel):
+class IdReturn(HalcyonModel):
     """Helper class for Matrix ID references"""
     model_config = get_nested_config()
     
@@ -43,7 +45,7 @@ class IdReturn(BaseModel):
         return self.id is not None
 
 
-class FileThumbnail(BaseModel):
+class FileThumbnail(HalcyonModel):
     """File thumbnail metadata"""
     model_config = get_nested_config()
     
@@ -81,7 +83,7 @@ class FileThumbnail(BaseModel):
         return bool(self._raw) or any([self.size, self.mimetype, self.height, self.width, self.url, self.file])
 
 
-class FileInfo(BaseModel):
+class FileInfo(HalcyonModel):
     """File metadata for attachments"""
     model_config = get_nested_config()
     
@@ -95,7 +97,7 @@ class FileInfo(BaseModel):
     
     def __init__(self, raw_content: Optional[Dict[str, Any]] = None, **kwargs):
         if raw_content:
-            thumbnail = FileThumbnail(
+            thumbnail = self._model(FileThumbnail)(
                 raw_content.get("thumbnail_info"),
                 thumbnailURL=raw_content.get("thumbnail_url"),
                 thumbnailFile=raw_content.get("thumbnail_file")
@@ -119,9 +121,10 @@ class FileInfo(BaseModel):
         return bool(self._raw)
 
 
-class MessageContent(BaseModel):
+class MessageContent(HalcyonModel):
     """Matrix message content with support for all message types"""
     model_config = get_nested_config(populate_by_name=True)
+    config_overrides: ClassVar[Dict[str, Any]] = {"populate_by_name": True}
     
     # Core fields (all message types)
     type: Optional[msgType] = Field(None, alias="msgtype")
@@ -152,6 +155,9 @@ class MessageContent(BaseModel):
     
     _raw: Optional[Dict[str, Any]] = PrivateAttr(default_factory=dict)
     
+    # validate_msgtype, for trusted mode
+    trusted_converters: ClassVar[Dict[str, Any]] = {"type": msgType}
+    
     @field_validator('type')
     @classmethod
     def validate_msgtype(cls, v):
@@ -171,7 +177,7 @@ class MessageContent(BaseModel):
                 url=raw_content.get("url"),
                 file=raw_content.get("file"),
                 filename=raw_content.get("filename"),
-                info=FileInfo(raw_content.get("info")) if raw_content.get("info") else None,
+                info=self._model(FileInfo)(raw_content.get("info")) if raw_content.get("info") else None,
                 geo_uri=raw_content.get("geo_uri"),
                 server_notice_type=raw_content.get("server_notice_type"),
                 admin_contact=raw_content.get("admin_contact"),
@@ -184,7 +190,7 @@ class MessageContent(BaseModel):
             self._raw = raw_content
             
             # Handle lax mode - store extra fields dynamically
-            if get_security_mode() == 'lax':
+            if self.security().lax:
                 known_fields = {'msgtype', 'body', 'format', 'formatted_body', 'url', 'file', 'filename', 'info', 
                                'geo_uri', 'server_notice_type', 'admin_contact', 'limit_type', 'from_device', 'methods', 'to'}
                 for key, value in raw_content.items():
@@ -199,7 +205,7 @@ class MessageContent(BaseModel):
         return bool(self._raw)
 
 
-class Relates(BaseModel):
+class Relates(HalcyonModel):
     """Message relations (replies, edits, reactions)"""
     model_config = get_nested_config()
     
@@ -223,9 +229,10 @@ class Relates(BaseModel):
         return bool(self._raw)
 
 
-class Message(BaseModel):
+class Message(HalcyonModel):
     """Matrix message event"""
     model_config = get_message_config()
+    config_overrides: ClassVar[Dict[str, Any]] = {"arbitrary_types_allowed": True}
     
     type: Optional[str] = None
     sender: Optional[str] = None
@@ -241,10 +248,10 @@ class Message(BaseModel):
     def __init__(self, rawMessage: Optional[Dict[str, Any]] = None, room=None, **kwargs):
         if rawMessage:
             # Parse the message
-            event_obj = IdReturn(rawMessage.get("event_id"))
-            content_obj = MessageContent(rawMessage.get("content"))
-            edit_obj = MessageContent(rawMessage.get("content", {}).get("m.new_content")) if rawMessage.get("content", {}).get("m.new_content") else None
-            relates_obj = Relates(rawMessage.get("content", {}).get("m.relates_to")) if rawMessage.get("content", {}).get("m.relates_to") else None
+            event_obj = self._model(IdReturn)(rawMessage.get("event_id"))
+            content_obj = self._model(MessageContent)(rawMessage.get("content"))
+            edit_obj = self._model(MessageContent)(rawMessage.get("content", {}).get("m.new_content")) if rawMessage.get("content", {}).get("m.new_content") else None
+            relates_obj = self._model(Relates)(rawMessage.get("content", {}).get("m.relates_to")) if rawMessage.get("content", {}).get("m.relates_to") else None
             
             super().__init__(
                 type=rawMessage.get("type"),
@@ -268,6 +275,97 @@ class Message(BaseModel):
         return self._hasData
 
 
+def _content(rawMessage):
+    return rawMessage.get("content") or {}
+
+
+# The raw content key behind each MessageContent field
+CONTENT_KEYS = {
+    "type": "msgtype", "body": "body", "format": "format", "formattedBody": "formatted_body", "url": "url",
+    "file": "file", "filename": "filename", "info": "info", "geo_uri": "geo_uri",
+    "server_notice_type": "server_notice_type", "admin_contact": "admin_contact", "limit_type": "limit_type",
+    "from_device": "from_device", "methods": "methods", "to": "to",
+}
+
+
+class LazyMessageContent(LazyFieldsMixin, MessageContent):
+    """
+    Same attributes as MessageContent, but a field is only read out of the raw content, and validated, the first
+    time it's used. So a validation error turns up on first access instead of when the message is built.
+    """
+    def __init__(self, raw_content: Optional[Dict[str, Any]] = None, **kwargs):
+        if not raw_content or kwargs:
+            super().__init__(raw_content, **kwargs)
+            return
+
+        values = dict()
+        if self.security().lax:
+            values.update((key, value) for key, value in raw_content.items() if key not in _KNOWN_CONTENT_KEYS)
+        self._init_lazy(values, {"_raw": raw_content})
+
+    def __getattr__(self, name: str):
+        key = CONTENT_KEYS.get(name)
+        if key is not None:
+            # Straight from the private dict, self._raw would come back through here
+            value = self.__pydantic_private__["_raw"].get(key)
+            if key == "info":
+                value = self._model(FileInfo)(value) if value else None
+            return self._set_lazy(name, value)
+        return super().__getattr__(name)
+
+    def _materialise_all(self):
+        for field in CONTENT_KEYS:
+            if field not in self.__dict__:
+                getattr(self, field)
+
+
+_KNOWN_CONTENT_KEYS = frozenset(CONTENT_KEYS.values())
+
+
+# How LazyMessage builds each field from the raw event
+LAZY_BUILDERS = {
+    "type": lambda model, rawMessage: rawMessage.get("type"),
+    "sender": lambda model, rawMessage: rawMessage.get("sender"),
+    "origin_server_ts": lambda model, rawMessage: rawMessage.get("origin_server_ts"),
+    "event": lambda model, rawMessage: model._model(IdReturn)(rawMessage.get("event_id")),
+    "content": lambda model, rawMessage: model._model(LazyMessageContent)(rawMessage.get("content")),
+    "edit": lambda model, rawMessage: model._model(LazyMessageContent)(_content(rawMessage)["m.new_content"]) if _content(rawMessage).get("m.new_content") else None,
+}
+
+
+class LazyMessage(LazyFieldsMixin, Message):
+    """
+    Same attributes as Message, but it only keeps the raw event when it's built. Each field is read out of the
+    event, and validated, the first time it's used, and content and edit are LazyMessageContent, so a handler
+    that looks at message.content.body and returns only ever parses the body. relates is set straight away,
+    the message.relates alias below would shadow it otherwise.
+    """
+    def __init__(self, rawMessage: Optional[Dict[str, Any]] = None, room=None, **kwargs):
+        if not rawMessage or kwargs:
+            super().__init__(rawMessage, room, **kwargs)
+            return
+
+        self._init_lazy({"room": room}, {"_raw": rawMessage, "_hasData": True})
+        relates = _content(rawMessage).get("m.relates_to")
+        if relates:
+            self._set_lazy("relates", self._model(Relates)(relates))
+        else:
+            self.__dict__["relates"] = None
+            self.__pydantic_fields_set__.add("relates")
+
+    def __getattr__(self, name: str):
+        builder = LAZY_BUILDERS.get(name)
+        if builder is not None:
+            # Straight from the private dict, self._raw would come back through here
+            return self._set_lazy(name, builder(self, self.__pydantic_private__["_raw"]))
+        return super().__getattr__(name)
+
+    def _materialise_all(self):
+        for field in LAZY_BUILDERS:
+            if field not in self.__dict__:
+                getattr(self, field)
+
+
 # Create compatibility aliases for the old nested class structure
 message = Message
 message.messageContent = MessageContent
@@ -0,0 +1,159 @@
+"""
+    Base model for the Message and Room trees.
+
+    Everything in them is built from events our own homeserver sent, so full pydantic validation mostly checks
+    data that is already right. With configure_security(trusted=True) models are built the way model_construct
+    does it, straight into the instance with no validation, which makes building them several times cheaper.
+    Strict validation stays the default.
+
+    The security configuration a model follows is read when it's built, from the current SecuritySnapshot.
+    A Client instead builds from variant(snapshot) classes, compiled once for its own snapshot, so they don't
+    look at the global configuration at all.
+"""
+
+import copyreg
+from typing import Any, ClassVar, Dict, Optional
+
+from pydantic import BaseModel, ConfigDict
+
+from halcyon.security import SecuritySnapshot, get_security_snapshot
+
+
+class _Template:
+    """What a class needs to be built without validation, worked out once per class"""
+    __slots__ = ("fields", "defaults", "mutable", "private", "privateFactories", "allowExtra", "converters")
+
+    def __init__(self, cls):
+        self.fields = frozenset(cls.model_fields)
+        self.defaults = dict()
+        mutable = []
+        for name, field in cls.model_fields.items():
+            if field.is_required():
+                continue
+            default = field.get_default(call_default_factory=True)
+            self.defaults[name] = default
+            if isinstance(default, (list, dict, set)):
+                mutable.append((name, type(default)))
+        self.mutable = tuple(mutable)
+        self.converters = tuple(cls.trusted_converters.items())
+
+        self.private = dict()
+        privateFactories = []
+        for name, attr in (cls.__private_attributes__ or {}).items():
+            if attr.default_factory is not None:
+                privateFactories.append((name, attr.default_factory))
+            else:
+                self.private[name] = attr.get_default()
+        self.privateFactories = tuple(privateFactories)
+
+        self.allowExtra = cls.model_config.get("extra") == "allow"
+
+
+_templates = dict()
+_setattr = object.__setattr__
+
+
+def _template(cls):
+    template = _templates.get(cls)
+    if template is None:
+        template = _templates[cls] = _Template(cls)
+    return template
+
+
+class HalcyonModel(BaseModel):
+    """
+        BaseModel that skips validation in trusted mode. Subclasses call super().__init__(**fields) as usual
+
+        trusted_converters maps a field to the function its validator would have run on it, they are still
+        applied in trusted mode
+    """
+    trusted_converters: ClassVar[Dict[str, Any]] = {}
+    # Config every variant of the class keeps, whatever the security mode says
+    config_overrides: ClassVar[Dict[str, Any]] = {}
+    # The snapshot a variant was compiled for. None on the classes themselves, they follow the current one
+    security_snapshot: ClassVar[Optional[SecuritySnapshot]] = None
+
+    def __init__(self, **data):
+        if not self.security().trusted:
+            super().__init__(**data)
+            return
+        self._construct_trusted(data)
+
+    @classmethod
+    def security(cls) -> SecuritySnapshot:
+        """The security configuration this class builds with"""
+        return cls.security_snapshot or get_security_snapshot()
+
+    @classmethod
+    def variant(cls, snapshot: SecuritySnapshot):
+        """
+            This class compiled for one security configuration, with its model_config built from the snapshot.
+            Built once and kept on the snapshot, so every call after the first is a dict lookup
+        """
+        base = cls.__mro__[1] if cls.security_snapshot is not None else cls
+        built = snapshot.variants.get(base)
+        if built is None:
+            built = type(base.__name__, (base,), {
+                "__module__": base.__module__,
+                "__qualname__": base.__qualname__,
+                "model_config": ConfigDict(**snapshot.config_dict(**base.config_overrides)),
+                "security_snapshot": snapshot,
+            })
+            built = snapshot.variants.setdefault(base, built)
+        return built
+
+    @classmethod
+    def _model(cls, model):
+        """The class to build a nested model with, the variant for our snapshot if we're one"""
+        snapshot = cls.security_snapshot
+        return model if snapshot is None else model.variant(snapshot)
+
+    def __reduce_ex__(self, protocol):
+        reduced = super().__reduce_ex__(protocol)
+        if type(self).security_snapshot is None or reduced[0] is not copyreg.__newobj__:
+            return reduced
+        # Variants can't be found by name, unpickle as the class itself
+        args = (type(self).__mro__[1],) + tuple(reduced[1][1:])
+        return (_new, args) + tuple(reduced[2:])
+
+    def _construct_trusted(self, data):
+        # Runs for every small model in a message, so the empty cases skip their loops
+        template = _templates.get(type(self)) or _template(type(self))
+
+        values = template.defaults.copy()
+        if template.mutable:
+            for name, kind in template.mutable:
+                values[name] = kind(values[name])
+
+        extra = {} if template.allowExtra else None
+        if template.fields.issuperset(data):
+            values.update(data)
+            fieldsSet = set(data)
+        else:
+            fieldsSet = set()
+            for name, value in data.items():
+                if name in template.fields:
+                    values[name] = value
+                    fieldsSet.add(name)
+                elif extra is not None:
+                    extra[name] = value
+
+        if template.converters:
+            for name, convert in template.converters:
+                if values.get(name) is not None:
+                    values[name] = convert(values[name])
+
+        private = template.private.copy() if template.private else None
+        if template.privateFactories:
+            private = private or {}
+            for name, factory in template.privateFactories:
+                private[name] = factory()
+
+        _setattr(self, "__dict__", values)
+        _setattr(self, "__pydantic_fields_set__", fieldsSet)
+        _setattr(self, "__pydantic_extra__", extra)
+        _setattr(self, "__pydantic_private__", private)
+
+
+def _new(cls, *args):
+    return cls.__new__(cls, *args)
@@ -0,0 +1,341 @@
+"""
+    Durable outbox. Events are written to disk with their transaction ID before they are sent, and only removed
+    once the homeserver has accepted them. After a crash, whatever was still pending is sent again with the same
+    transaction ID, so the homeserver drops the ones that did make it instead of posting them twice.
+    https://spec.matrix.org/latest/client-server-api/#transaction-identifiers
+
+    Transaction IDs are scoped to the access token, so replays only dedupe if the bot comes back with the same token.
+
+    Each room gets its own lane. Up to pipelineDepth PUTs per room are in flight at once, started in the order
+    they were queued, and results are handed back in that order. Set pipelineDepth=1 where strict ordering on
+    the server matters more than throughput, since concurrent requests can still land in a different order.
+
+    Store writes (the fsync or commit that makes an event durable) run on one writer thread per outbox, in the
+    order they were made, so a slow disk holds up the sends waiting on it but never the event loop.
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from collections import deque
+
+import aiohttp
+from halcyon.storage import writeAtomic
+
+
+class OutboxEntry:
+    """One event waiting to be sent"""
+    __slots__ = ("txnID", "account", "roomID", "eventType", "payload")
+
+    def __init__(self, txnID, account, roomID, eventType, payload):
+        self.txnID = txnID
+        self.account = account
+        self.roomID = roomID
+        self.eventType = eventType
+        self.payload = payload
+
+    def toDict(self):
+        return {"txn": self.txnID, "account": self.account, "room": self.roomID, "type": self.eventType, "payload": self.payload}
+
+    @classmethod
+    def fromDict(cls, data):
+        return cls(data["txn"], data["account"], data["room"], data["type"], data["payload"])
+
+
+class OutboxStore:
+    """
+        Base outbox store. Subclass this to keep pending events somewhere else. add, remove and close are called
+        on the outbox's writer thread, one at a time
+    """
+    def add(self, entry):
+        """
+            Durably record an event before it is sent
+
+            @param entry OutboxEntry
+        """
+        raise NotImplementedError
+
+    def remove(self, txnID):
+        """
+            The homeserver accepted (or permanently refused) an event, forget it
+
+            @param txnID String
+        """
+        raise NotImplementedError
+
+    def pending(self, account):
+        """
+            @param account String the account to replay for
+
+            @return list of OutboxEntry, in the order they were added
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class FileOutboxStore(OutboxStore):
+    """
+        Append only log, one json line per added or finished event. The log is compacted down to the pending
+        events every time it is opened
+
+        @param path String the log file
+    """
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._entries = self._read()
+        self._compact()
+        self._file = open(self.path, "a")
+
+    def _read(self):
+        entries = dict()
+        try:
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        #a torn write at the end of the log, the event it belonged to was never acknowledged
+                        logging.warning("Skipping unreadable outbox record")
+                        continue
+                    if record.get("op") == "add":
+                        entries[record["txn"]] = OutboxEntry.fromDict(record)
+                    elif record.get("op") == "done":
+                        entries.pop(record["txn"], None)
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _compact(self):
+        writeAtomic(self.path, "".join(json.dumps(dict(entry.toDict(), op="add")) + "\n" for entry in self._entries.values()))
+
+    def _append(self, record):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def add(self, entry):
+        self._append(dict(entry.toDict(), op="add"))
+        self._entries[entry.txnID] = entry
+
+    def remove(self, txnID):
+        if self._entries.pop(txnID, None) is not None:
+            self._append({"op": "done", "txn": txnID})
+
+    def pending(self, account):
+        return [entry for entry in self._entries.values() if entry.account == account]
+
+    def close(self):
+        self._file.close()
+
+
+class SQLiteOutboxStore(OutboxStore):
+    """
+        Keeps pending events in an SQLite database
+
+        @param path String the database file, ":memory:" works for testing
+    """
+    def __init__(self, path):
+        self.path = path
+        #the outbox writes from its own thread
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS outbox (seq INTEGER PRIMARY KEY AUTOINCREMENT, txn TEXT UNIQUE NOT NULL, "
+                         "account TEXT NOT NULL, room TEXT NOT NULL, type TEXT NOT NULL, payload TEXT NOT NULL, added INTEGER NOT NULL)")
+        self._db.commit()
+
+    def add(self, entry):
+        self._db.execute("INSERT INTO outbox (txn, account, room, type, payload, added) VALUES (?, ?, ?, ?, ?, ?)",
+                         (entry.txnID, entry.account, entry.roomID, entry.eventType, json.dumps(entry.payload), time.time_ns()))
+        self._db.commit()
+
+    def remove(self, txnID):
+        self._db.execute("DELETE FROM outbox WHERE txn = ?", (txnID,))
+        self._db.commit()
+
+    def pending(self, account):
+        rows = self._db.execute("SELECT txn, account, room, type, payload FROM outbox WHERE account = ? ORDER BY seq", (account,))
+        return [OutboxEntry(txn, account, room, eventType, json.loads(payload)) for txn, account, room, eventType, payload in rows]
+
+    def close(self):
+        self._db.close()
+
+
+class _RoomLane:
+    __slots__ = ("queue", "task")
+
+    def __init__(self):
+        self.queue = deque()
+        self.task = None
+
+
+class Outbox:
+    """
+        Sends events through the store, so none are lost or duplicated across a restart
+
+        @param store OutboxStore where pending events are kept
+        @param pipelineDepth int OPTIONAL how many PUTs per room can be in flight at once
+        @param maxBackoff float OPTIONAL the longest wait between retries of a failed send, in seconds
+    """
+    def __init__(self, store, pipelineDepth=4, maxBackoff=60):
+        if pipelineDepth < 1:
+            raise ValueError("pipelineDepth must be at least 1")
+        self.store = store
+        self.pipelineDepth = pipelineDepth
+        self.maxBackoff = maxBackoff
+        self.runner = None
+        self.account = None
+        self._lanes = dict()
+        self._futures = dict()
+        self._stored = dict()
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="halcyon-outbox")
+
+    def _write(self, method, *args):
+        """Run a store method on the writer thread"""
+        return asyncio.get_running_loop().run_in_executor(self._writer, method, *args)
+
+    def bind(self, runner):
+        """
+            Send through this runner, and replay anything it left pending last time
+
+            @param runner halcyon.restrunner.Runner a logged in runner
+
+            @return int how many events were replayed
+        """
+        self.runner = runner
+        self.account = str(runner.USER_ID)
+
+        replayed = self.store.pending(self.account)
+        for entry in replayed:
+            #nobody is waiting on these any more, failures are logged
+            self._queue(entry, track=False)
+        if replayed:
+            logging.info("Replaying " + str(len(replayed)) + " unsent events from the outbox")
+        return len(replayed)
+
+    def enqueue(self, roomID, eventType, payload):
+        """
+            Store an event and queue it to be sent, without waiting for it
+
+            @param roomID String the room to send to
+            @param eventType String the event type, ie m.room.message
+            @param payload dict the event content
+
+            @return asyncio.Future resolved with the homeserver's response
+        """
+        if self.runner is None:
+            raise RuntimeError("Outbox is not bound to a runner yet")
+
+        entry = OutboxEntry("halcyon." + uuid.uuid4().hex, self.account, roomID, eventType, payload)
+        self._stored[entry.txnID] = self._write(self.store.add, entry)
+        return self._queue(entry)
+
+    async def send(self, roomID, eventType, payload):
+        """
+            Store an event, send it, and wait for the homeserver to accept it
+
+            @return dict contains 'event_id' of the new event
+        """
+        return await self.enqueue(roomID, eventType, payload)
+
+    def _queue(self, entry, track=True):
+        future = None
+        if track:
+            future = asyncio.get_running_loop().create_future()
+            self._futures[entry.txnID] = future
+
+        lane = self._lanes.get(entry.roomID)
+        if lane is None:
+            lane = self._lanes[entry.roomID] = _RoomLane()
+        lane.queue.append(entry)
+        if lane.task is None:
+            lane.task = asyncio.ensure_future(self._runLane(entry.roomID, lane))
+        return future
+
+    async def _runLane(self, roomID, lane):
+        inFlight = deque()
+        try:
+            while lane.queue or inFlight:
+                while lane.queue and len(inFlight) < self.pipelineDepth:
+                    entry = lane.queue.popleft()
+                    inFlight.append((entry, asyncio.ensure_future(self._deliver(entry))))
+                    #let the request go out before the next one, so they leave in order
+                    await asyncio.sleep(0)
+
+                entry, task = inFlight.popleft()
+                future = self._futures.pop(entry.txnID, None)
+                try:
+                    result = await task
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    if future is not None and not future.done():
+                        future.set_exception(e)
+                else:
+                    if future is not None and not future.done():
+                        future.set_result(result)
+        finally:
+            for entry, task in inFlight:
+                task.cancel()
+            if self._lanes.get(roomID) is lane and not lane.queue:
+                del self._lanes[roomID]
+            else:
+                lane.task = None
+
+    def _permanent(self, error):
+        """Errors that won't go away by retrying, ie M_FORBIDDEN"""
+        return isinstance(error, aiohttp.ClientResponseError) and 400 <= error.status < 500 and error.status != 429
+
+    async def _deliver(self, entry):
+        stored = self._stored.pop(entry.txnID, None)
+        if stored is not None:
+            #it only goes out once it would survive a crash
+            await stored
+
+        failures = 0
+        while True:
+            try:
+                result = await self.runner.sendEvent_async(entry.roomID, entry.eventType, entry.payload, txnID=entry.txnID)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self._permanent(e):
+                    logging.error("Homeserver refused outbox event, dropping it: " + str(e))
+                    await self._write(self.store.remove, entry.txnID)
+                    raise
+
+                failures += 1
+                backoff = min(2 ** failures, self.maxBackoff)
+                logging.warning("Outbox send failed, retrying in " + str(backoff) + "s: " + str(e))
+                await asyncio.sleep(backoff)
+                continue
+
+            await self._write(self.store.remove, entry.txnID)
+            return result
+
+    async def close(self):
+        """Stop sending. Anything unsent stays in the store for next time"""
+        tasks = [lane.task for lane in self._lanes.values() if lane.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._lanes.clear()
+
+        for future in self._futures.values():
+            if not future.done():
+                future.cancel()
+        self._futures.clear()
+        self._stored.clear()
+
+        #queued behind any writes still in flight
+        await self._write(self.store.close)
+        self._writer.shutdown(wait=False)
@@ -0,0 +1,97 @@
+"""
+    Effective power levels for a room, worked out once per m.room.power_levels event.
+
+    RoomPermissions keeps the raw power level dicts. PermissionIndex turns them into a user -> level and an
+    action/event type -> required level lookup with the spec defaults filled in, so room.can(user, "kick") or
+    room.can(user, "m.room.message") in a handler is two dict lookups. A new index is only built when a new
+    m.room.power_levels event replaces the RoomPermissions it belongs to.
+"""
+
+from halcyon.filters import ROOM_STATE_TYPES
+
+
+# Actions with their own power level, and what they default to when the power levels don't say
+ACTION_DEFAULTS = {"invite": 0, "kick": 50, "ban": 50, "redact": 50}
+NOTIFICATION_DEFAULTS = {"room": 50}
+
+# Event types taken as state when can() isn't told, for state_default vs events_default
+STATE_EVENT_TYPES = frozenset(ROOM_STATE_TYPES) | frozenset((
+    "m.room.third_party_invite", "m.room.pinned_events", "m.room.tombstone", "m.space.child", "m.space.parent",
+))
+
+
+def _level(value, default):
+    """Power levels can be strings in old rooms"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class PermissionIndex:
+    """
+        @param content dict the m.room.power_levels content, or None if the room has none
+        @param creator str OPTIONAL the room creator, who has level 100 when there are no power levels
+    """
+    __slots__ = ("users", "usersDefault", "required", "stateDefault", "eventsDefault")
+
+    def __init__(self, content=None, creator=None):
+        if content is None:
+            # No power levels at all: the creator has 100, everyone else 0, and state needs 0
+            self.users = {creator: 100} if creator else {}
+            self.usersDefault = 0
+            self.stateDefault = 0
+            self.eventsDefault = 0
+            content = {}
+        else:
+            self.usersDefault = _level(content.get("users_default"), 0)
+            self.users = {userID: _level(level, self.usersDefault) for userID, level in (content.get("users") or {}).items()}
+            self.stateDefault = _level(content.get("state_default"), 50)
+            self.eventsDefault = _level(content.get("events_default"), 0)
+
+        required = {action: _level(content.get(action), default) for action, default in ACTION_DEFAULTS.items()}
+        notifications = dict(NOTIFICATION_DEFAULTS)
+        notifications.update(content.get("notifications") or {})
+        for key, level in notifications.items():
+            required["notifications." + key] = _level(level, 50)
+        for eventType, level in (content.get("events") or {}).items():
+            required[eventType] = _level(level, self.eventsDefault)
+        self.required = required
+
+    def level(self, userID):
+        """
+            @return int the user's power level
+        """
+        return self.users.get(userID, self.usersDefault)
+
+    def requiredLevel(self, actionOrEventType, state=None):
+        """
+            @param actionOrEventType str "invite", "kick", "ban", "redact", "notifications.room", or an event type
+            @param state bool OPTIONAL whether the event type is a state event. Worked out from the type if not given
+
+            @return int the power level needed
+        """
+        required = self.required.get(actionOrEventType)
+        if required is not None:
+            return required
+        if state is None:
+            state = actionOrEventType in STATE_EVENT_TYPES
+        return self.stateDefault if state else self.eventsDefault
+
+    def can(self, userID, actionOrEventType, state=None, target=None):
+        """
+            @param target str OPTIONAL for kick and ban, the user on the receiving end, who has to be below userID
+
+            @return bool whether the user's power level allows it
+        """
+        level = self.users.get(userID, self.usersDefault)
+        if level < self.requiredLevel(actionOrEventType, state):
+            return False
+        return target is None or level > self.users.get(target, self.usersDefault)
+
+    def __eq__(self, other):
+        if not isinstance(other, PermissionIndex):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    __hash__ = None
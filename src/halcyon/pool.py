@@ -0,0 +1,111 @@
+"""
+    Shared aiohttp connection pools.
+
+    By default every Runner builds its own aiohttp session with default connector settings. A ConnectionPool
+    lets you tune the connector (limits, keepalive, DNS cache, TLS) and share the warm connections between
+    several Runner/Client instances. Media uploads and downloads get their own pool, so a big upload can't
+    tie up the connections that sends and syncs need.
+"""
+
+import asyncio
+
+import aiohttp
+
+
+class ConnectionPoolConfig:
+    """
+        Settings for a ConnectionPool. Apart from the media pool, the defaults match aiohttp's own
+
+        @param limit int OPTIONAL max open connections in total. 0 for no limit
+        @param limitPerHost int OPTIONAL max open connections to one host. 0 for no limit
+        @param keepaliveTimeout float OPTIONAL seconds an idle connection is kept open for reuse
+        @param dnsCacheTTL int OPTIONAL seconds to cache DNS lookups. None caches forever
+        @param useDnsCache bool OPTIONAL cache DNS lookups at all
+        @param sslContext ssl.SSLContext OPTIONAL bring your own context (custom CAs, client certs...). By default
+                                        aiohttp's shared context is used, which is built once at import and sets ALPN
+        @param requestTimeout float OPTIONAL default total timeout for a request, in seconds
+        @param separateMediaPool bool OPTIONAL give media its own connector
+        @param mediaLimit int OPTIONAL max open media connections
+        @param mediaLimitPerHost int OPTIONAL max open media connections to one host
+    """
+    def __init__(self, limit=100, limitPerHost=0, keepaliveTimeout=15, dnsCacheTTL=10, useDnsCache=True,
+                 sslContext=None, requestTimeout=120,
+                 separateMediaPool=True, mediaLimit=10, mediaLimitPerHost=0):
+        self.limit = limit
+        self.limitPerHost = limitPerHost
+        self.keepaliveTimeout = keepaliveTimeout
+        self.dnsCacheTTL = dnsCacheTTL
+        self.useDnsCache = useDnsCache
+        self.sslContext = sslContext
+        self.requestTimeout = requestTimeout
+        self.separateMediaPool = separateMediaPool
+        self.mediaLimit = mediaLimit
+        self.mediaLimitPerHost = mediaLimitPerHost
+
+
+class ConnectionPool:
+    """
+        Owns the aiohttp sessions used by one or more Runners. Pass the same pool to several Runner/Client
+        instances to share connections. The sessions are closed once the last Runner using the pool lets go.
+
+        @param config ConnectionPoolConfig OPTIONAL the pool settings
+    """
+    def __init__(self, config=None):
+        self.config = config or ConnectionPoolConfig()
+        self._sessions = dict()
+        self._users = 0
+        self._lock = None
+
+    def attach(self):
+        """Register another user of this pool"""
+        self._users += 1
+
+    async def detach(self):
+        """Let go of the pool, closing it if nobody else is using it"""
+        self._users = max(0, self._users - 1)
+        if self._users == 0:
+            await self.close()
+
+    def _connector(self, media):
+        config = self.config
+        return aiohttp.TCPConnector(
+            limit=config.mediaLimit if media else config.limit,
+            limit_per_host=config.mediaLimitPerHost if media else config.limitPerHost,
+            keepalive_timeout=config.keepaliveTimeout,
+            ttl_dns_cache=config.dnsCacheTTL,
+            use_dns_cache=config.useDnsCache,
+            ssl=config.sslContext if config.sslContext is not None else True,
+        )
+
+    async def session(self, media=False):
+        """
+            @param media bool OPTIONAL get the media session instead of the API one
+
+            @return aiohttp.ClientSession
+        """
+        kind = "media" if media and self.config.separateMediaPool else "api"
+
+        existing = self._sessions.get(kind)
+        if existing is not None and not existing.closed:
+            return existing
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            existing = self._sessions.get(kind)
+            if existing is None or existing.closed:
+                timeout = aiohttp.ClientTimeout(total=self.config.requestTimeout)
+                self._sessions[kind] = aiohttp.ClientSession(connector=self._connector(kind == "media"), timeout=timeout)
+            return self._sessions[kind]
+
+    async def close(self):
+        """Close every session in the pool"""
+        for kind in list(self._sessions):
+            session = self._sessions.pop(kind)
+            if not session.closed:
+                await session.close()
+
+    @property
+    def closed(self):
+        return not any(not session.closed for session in self._sessions.values())
@@ -0,0 +1,254 @@
+"""
+    Outbound rate limiting. https://spec.matrix.org/latest/client-server-api/#rate-limiting
+
+    Homeservers answer a burst of sends with 429 M_LIMIT_EXCEEDED and tell us how long to back off for in
+    retry_after_ms. OutboundScheduler honours retry_after_ms when we do get limited, and adapts how many sends
+    are in flight at once: it halves on every 429 and creeps back up while sends succeed. Sends that get limited
+    are queued and retried, never dropped. It can also keep sends under a known limit to begin with (a global and
+    a per room token bucket), that pacing is off unless you give it a rate.
+"""
+
+import asyncio
+import json
+import logging
+import time
+
+
+class RateLimited(Exception):
+    """
+        The homeserver said M_LIMIT_EXCEEDED
+
+        @param retryAfter float seconds the server asked us to wait, or None if it didn't say
+    """
+    def __init__(self, retryAfter=None):
+        super().__init__("Rate limited" + (", retry after " + str(retryAfter) + "s" if retryAfter is not None else ""))
+        self.retryAfter = retryAfter
+
+
+class TokenBucket:
+    """
+        Allows `rate` acquisitions per second on average, with bursts of up to `burst`.
+        Waiters are served in the order they arrived
+
+        @param rate float tokens added per second
+        @param burst int the most tokens the bucket can hold
+    """
+    def __init__(self, rate, burst):
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate must be above 0 and burst at least 1")
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._blockedUntil = 0.0
+        self._lock = None
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _wait(self, now):
+        """Seconds until a token is free, 0 if one is free now"""
+        if now < self._blockedUntil:
+            return self._blockedUntil - now
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            while True:
+                wait = self._wait(time.monotonic())
+                if wait <= 0:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        """Hand out nothing for the next few seconds, then start again from an empty bucket"""
+        until = time.monotonic() + seconds
+        if until > self._blockedUntil:
+            self._blockedUntil = until
+            self._tokens = 0.0
+            self._updated = until
+
+    @property
+    def idle(self):
+        """True if the bucket is full and nobody is waiting on it, so it can be thrown away"""
+        now = time.monotonic()
+        if now < self._blockedUntil or (self._lock is not None and self._lock.locked()):
+            return False
+        self._refill(now)
+        return self._tokens >= self.burst
+
+
+class AdaptiveLimit:
+    """
+        A concurrency limit that halves on every rate limit and grows by about one per limit's worth of successes
+        (AIMD, like TCP congestion control)
+
+        @param initial int the starting limit
+        @param minimum int never go below this
+        @param maximum int never go above this
+    """
+    def __init__(self, initial=8, minimum=1, maximum=32):
+        if not minimum <= initial <= maximum or minimum < 1:
+            raise ValueError("Need 1 <= minimum <= initial <= maximum")
+        self.minimum = minimum
+        self.maximum = maximum
+        self._limit = float(initial)
+        self.inFlight = 0
+        self._changed = None
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def _condition(self):
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        return self._changed
+
+    async def acquire(self):
+        changed = self._condition()
+        async with changed:
+            await changed.wait_for(lambda: self.inFlight < self.limit)
+            self.inFlight += 1
+
+    async def release(self):
+        changed = self._condition()
+        async with changed:
+            self.inFlight -= 1
+            changed.notify_all()
+
+    def onSuccess(self):
+        self._limit = min(self.maximum, self._limit + 1 / self._limit)
+
+    def onRateLimited(self):
+        self._limit = max(self.minimum, self._limit / 2)
+
+
+class OutboundScheduler:
+    """
+        Paces outbound requests and retries the ones that get rate limited
+
+        @param globalRate float OPTIONAL sends per second across every room. None for no limit
+        @param globalBurst int OPTIONAL how many sends can go out at once before globalRate kicks in
+        @param roomRate float OPTIONAL sends per second into any one room. None for no limit
+        @param roomBurst int OPTIONAL burst size per room
+        @param initialConcurrency int OPTIONAL how many sends can be in flight at once to start with
+        @param minConcurrency int OPTIONAL the in flight limit never shrinks below this
+        @param maxConcurrency int OPTIONAL the in flight limit never grows above this
+        @param maxRetries int OPTIONAL give up and re-raise after this many 429s for one send. None retries forever
+        @param defaultRetryAfter float OPTIONAL seconds to wait when a 429 doesn't say, doubled on every retry
+        @param maxRoomBuckets int OPTIONAL start throwing away idle room buckets past this many rooms
+    """
+    def __init__(self, globalRate=None, globalBurst=50, roomRate=None, roomBurst=10, initialConcurrency=8, minConcurrency=1,
+                 maxConcurrency=32, maxRetries=None, defaultRetryAfter=1.0, maxRoomBuckets=1024):
+        self.globalBucket = TokenBucket(globalRate, globalBurst) if globalRate else None
+        self.roomRate = roomRate
+        self.roomBurst = roomBurst
+        self.concurrency = AdaptiveLimit(initialConcurrency, minConcurrency, maxConcurrency)
+        self.maxRetries = maxRetries
+        self.defaultRetryAfter = defaultRetryAfter
+        self.maxRoomBuckets = maxRoomBuckets
+        self._roomBuckets = dict()
+        self._pausedUntil = 0.0
+
+        self.sent = 0
+        self.rateLimited = 0
+        self.queued = 0
+
+    def _roomBucket(self, roomID):
+        if not self.roomRate or roomID is None:
+            return None
+
+        bucket = self._roomBuckets.get(roomID)
+        if bucket is None:
+            if len(self._roomBuckets) >= self.maxRoomBuckets:
+                for key in [key for key, value in self._roomBuckets.items() if value.idle]:
+                    del self._roomBuckets[key]
+            bucket = self._roomBuckets[roomID] = TokenBucket(self.roomRate, self.roomBurst)
+        return bucket
+
+    async def run(self, roomID, send):
+        """
+            Send a request once there is room for it, retrying whenever it is rate limited
+
+            @param roomID String OPTIONAL the room the request is for, None if it isn't for a room
+            @param send coroutine function that makes the request. It's called again for every retry,
+                        so it must be safe to repeat (use the same txn ID)
+
+            @return whatever send returns
+        """
+        attempt = 0
+        self.queued += 1
+        try:
+            while True:
+                roomBucket = self._roomBucket(roomID)
+                if roomBucket is not None:
+                    await roomBucket.acquire()
+                if self.globalBucket is not None:
+                    await self.globalBucket.acquire()
+                paused = self._pausedUntil - time.monotonic()
+                if paused > 0:
+                    await asyncio.sleep(paused)
+
+                await self.concurrency.acquire()
+                try:
+                    result = await send()
+                except RateLimited as e:
+                    self.concurrency.onRateLimited()
+                    await self.concurrency.release()
+                    self.rateLimited += 1
+                    attempt += 1
+                    if self.maxRetries is not None and attempt > self.maxRetries:
+                        raise
+
+                    retryAfter = e.retryAfter if e.retryAfter is not None else self.defaultRetryAfter * 2 ** (attempt - 1)
+                    logging.warning("Rate limited, retrying in " + str(retryAfter) + "s")
+                    #the limit is on our user, not the room, so hold everything back
+                    self._pausedUntil = max(self._pausedUntil, time.monotonic() + retryAfter)
+                    if self.globalBucket is not None:
+                        self.globalBucket.pause(retryAfter)
+                    await asyncio.sleep(retryAfter)
+                    continue
+                except BaseException:
+                    await self.concurrency.release()
+                    raise
+
+                self.concurrency.onSuccess()
+                await self.concurrency.release()
+                self.sent += 1
+                return result
+        finally:
+            self.queued -= 1
+
+
+async def retryAfter(resp, loads=None):
+    """
+        Read how long a 429 response wants us to wait for
+
+        @param resp aiohttp.ClientResponse
+        @param loads function OPTIONAL decodes the body, ie a halcyon.codec loads. Defaults to json.loads
+
+        @return float seconds, or None if it doesn't say
+    """
+    try:
+        body = (loads or json.loads)(await resp.read())
+        if isinstance(body, dict) and body.get("retry_after_ms") is not None:
+            return body["retry_after_ms"] / 1000
+    except Exception:
+        pass
+
+    header = resp.headers.get("Retry-After")
+    if header:
+        try:
+            return float(header)
+        except ValueError:
+            pass
+    return None
@@ -5,9 +5,13 @@ import asyncio
 import logging
 import io
 from halcyon.enums import *
+from halcyon.syncstream import SyncStreamDecoder
+from halcyon.pool import ConnectionPool
+from halcyon.ratelimit import OutboundScheduler, RateLimited, retryAfter
+from halcyon.codec import getCodec
 
 class Runner:
-    def __init__(self, homeserver, user_id=None, access_token=None, device_id=None):
+    def __init__(self, homeserver, user_id=None, access_token=None, device_id=None, connectionPool=None, scheduler=None, codec="auto"):
         '''
             This class contains all the REST methods to talk to the homeserver
 
@@ -15,6 +19,9 @@ class Runner:
             @param user_id String OPTIONAL the username to use
             @param access_token String OPTIONAL this is a valid session token to use
             @param device_id String OPTIONAL this is the device randmo ID 
+            @param connectionPool ConnectionPool OPTIONAL share aiohttp connections with other Runners. See halcyon.pool
+            @param scheduler OutboundScheduler OPTIONAL retries sendEvent_async when rate limited, and paces it if given rates. See halcyon.ratelimit
+            @param codec String/object OPTIONAL the json codec for the async requests, "auto" picks the fastest installed. See halcyon.codec
         '''
         if "https://" not in homeserver and "http://" not in homeserver:
             homeserver = "https://" + homeserver
@@ -24,24 +31,27 @@ class Runner:
         self.access_token = access_token
         self.DEVICE_ID = device_id
         self.SESSION = requests.Session()  # Keep for backward compatibility
-        self._aio_session = None  # Will be created when needed
+        self.connectionPool = connectionPool or ConnectionPool()
+        self._poolAttached = False
+        self.scheduler = scheduler or OutboundScheduler()
+        self.codec = getCodec(codec)
         self.TXN_ID = int(str(time.time()).replace(".", ""))
 
         if homeserver:
             self.HOMESERVER = self._wellknownLookup(homeserver)["m.homeserver"]["base_url"]
 
-    async def _ensure_session(self):
-        """Ensure aiohttp session is created"""
-        if self._aio_session is None or self._aio_session.closed:
-            timeout = aiohttp.ClientTimeout(total=120)  # 2 minute default timeout
-            self._aio_session = aiohttp.ClientSession(timeout=timeout)
-        return self._aio_session
+    async def _ensure_session(self, media=False):
+        """Get a session from the connection pool, media requests get the media one"""
+        if not self._poolAttached:
+            self.connectionPool.attach()
+            self._poolAttached = True
+        return await self.connectionPool.session(media=media)
     
     async def _close_session(self):
-        """Close the aiohttp session"""
-        if self._aio_session and not self._aio_session.closed:
-            await self._aio_session.close()
-            self._aio_session = None
+        """Let go of the connection pool, it closes once no Runner is using it"""
+        if self._poolAttached:
+            self._poolAttached = False
+            await self.connectionPool.detach()
 
     def _request(self, method, endpoint, basepath=None, query=None, payload=None, returnRawContent=None, fileData=None, timeout=None, retryCount=1):
         """
@@ -87,7 +97,7 @@ class Runner:
             except:
                 return {} # on failure just default to nothing
 
-    async def _async_request(self, method, endpoint, basepath=None, query=None, payload=None, returnRawContent=None, fileData=None, timeout=None, retryCount=1):
+    async def _async_request(self, method, endpoint, basepath=None, query=None, payload=None, returnRawContent=None, fileData=None, timeout=None, retryCount=1, retryRateLimit=True):
         """
         Async version of the request method using aiohttp
         
@@ -100,6 +110,7 @@ class Runner:
         @param fileData OBJ OPTIONAL data payload to send
         @param timeout int() timeout for the http response
         @param retryCount int OPTIONAL downcount to retry the request until failure
+        @param retryRateLimit bool OPTIONAL wait out a 429 and retry. False raises RateLimited straight away, for the scheduler to handle
         """
         
         if not basepath:
@@ -111,7 +122,7 @@ class Runner:
             "Authorization": "Bearer " + self.access_token,
         }
 
-        session = await self._ensure_session()
+        session = await self._ensure_session(media=basepath == Basepath.MEDIA)
         
         try:
             # Prepare the request parameters
@@ -125,18 +136,29 @@ class Runner:
             if fileData is not None:
                 request_kwargs['data'] = fileData
             elif payload is not None:
-                request_kwargs['json'] = payload
+                request_kwargs['data'] = self.codec.dumps(payload)
+                headers["Content-Type"] = "application/json"
                 
             async with session.request(method, url, **request_kwargs) as resp:
+                if resp.status == 429:
+                    raise RateLimited(await retryAfter(resp, self.codec.loads))
                 resp.raise_for_status()
                 
                 if returnRawContent:
                     return await resp.read()
                 else:
                     try:
-                        return await resp.json()
+                        return self.codec.loads(await resp.read())
                     except:
                         return {}  # on failure just default to nothing
+
+        except RateLimited as e:
+            if retryRateLimit and retryCount > 0:
+                retryCount = retryCount - 1
+                await asyncio.sleep(e.retryAfter if e.retryAfter is not None else (2 ** (1 - retryCount)) + 0.1)
+                return await self._async_request(method, endpoint, basepath=basepath, query=query, payload=payload,
+                    returnRawContent=returnRawContent, fileData=fileData, timeout=timeout, retryCount=retryCount)
+            raise
                         
         except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             if retryCount > 0:
@@ -198,7 +220,7 @@ class Runner:
         """
         return await self._async_request(method="POST", endpoint=endpoint, basepath=basepath, query=query, payload=payload, fileData=fileData, timeout=timeout)
 
-    async def _async_put(self, endpoint, basepath=None, query=None, payload=None, timeout=None):
+    async def _async_put(self, endpoint, basepath=None, query=None, payload=None, timeout=None, retryRateLimit=True):
         """
         Async PUT request
         @param endpoint String rest of the https string
@@ -206,8 +228,9 @@ class Runner:
         @param query Dict OPTIONAL url query
         @param payload Dict/json OPTIONAL The json payload
         @param timeout int OPTIONAL set a timeout on the http request
+        @param retryRateLimit bool OPTIONAL wait out a 429 and retry, instead of raising RateLimited
         """
-        return await self._async_request(method="PUT", endpoint=endpoint, basepath=basepath, query=query, payload=payload, timeout=timeout)
+        return await self._async_request(method="PUT", endpoint=endpoint, basepath=basepath, query=query, payload=payload, timeout=timeout, retryRateLimit=retryRateLimit)
 
     def _wellknownLookup(self, homeserver):
         try:
@@ -262,6 +285,45 @@ class Runner:
         return loginResp
 
 
+    async def _passwordLogin_async(self, userID, password, deviceID=None, device="Halcyon Bot"):
+        '''
+            Login using a userID and password - Async version
+
+            @param userID String the username
+            @param password String the password
+            @param deviceID String OPTIONAL the device id to use
+            @param device String OPTIONAL the human readable device name
+            
+            @return json The resp object from the matrix server
+        '''
+        payload = {
+          "type": "m.login.password",
+          "identifier": {
+            "type": "m.id.user",
+            "user": userID
+          },
+          "password": password,
+          "initial_device_display_name": device
+        }
+
+        if deviceID:
+            payload["device_id"] = deviceID
+
+        url = self.HOMESERVER + "/"+ Basepath.CLIENT + "/login"
+        session = await self._ensure_session()
+        async with session.post(url, data=self.codec.dumps(payload), headers={"Content-Type": "application/json"}) as resp:
+            loginResp = self.codec.loads(await resp.read())
+
+        if "errcode" in loginResp:
+            logging.error("Password Login Error: " + loginResp["error"])
+        else:
+            self.USER_ID = loginResp["user_id"]
+            self.access_token = loginResp["access_token"]
+            self.DEVICE_ID = loginResp["device_id"]
+
+        return loginResp
+
+
     def revokeAccessToken(self, all=False):
         """
             This invalidates the current access token, or every access token
@@ -278,6 +340,22 @@ class Runner:
             return self._post("logout")
 
 
+    async def revokeAccessToken_async(self, all=False):
+        """
+            This invalidates the current access token, or every access token - Async version
+
+            @param all Bool revoke all access tokens
+
+            @return dict how the logout went
+        """
+        if all:
+            logging.info("Revoking all access tokens")
+            return await self._async_post("logout/all")
+        else:
+            logging.info("Revoking current access token")
+            return await self._async_post("logout")
+
+
     def whoami(self):
         '''
         A simple check to see who you are logged in as. Good for ensuring auth
@@ -287,6 +365,15 @@ class Runner:
         return self._get("account/whoami")
 
 
+    async def whoami_async(self):
+        '''
+        A simple check to see who you are logged in as - Async version
+
+        @return userid + deviceID
+        '''
+        return await self._async_get("account/whoami")
+
+
     def getUserPresence(self, userID=None):
         """
         Get the specified users current status / presence info
@@ -316,6 +403,22 @@ class Runner:
         return self._get(endpoint=endpoint)
 
 
+    async def getUserPresence_async(self, userID=None):
+        """
+        Get the specified users current status / presence info - Async version
+
+        @param userID String OPTIONAL the full @username:server.com address to fetch the status of
+
+        @return dict presence object
+        """
+        if not userID:
+            userID = self.USER_ID
+
+        endpoint = "presence/" + userID + "/status"
+
+        return await self._async_get(endpoint=endpoint)
+
+
     def setUserPresence(self, presence=None, statusMessage=None):
         """
         Set the current users presence/status info. You can only set your own
@@ -338,6 +441,29 @@ class Runner:
 
         return self._put(endpoint=endpoint,payload=payload)
 
+    async def setUserPresence_async(self, presence=None, statusMessage=None):
+        """
+        Set the current users presence/status info. You can only set your own - Async version
+
+        @param presence enum/string OPTIONAL The presence of the bot user
+        @param statusMessage String the string to set the current users status to
+        """
+
+        if not presence:
+            presence = Presence.ONLINE
+
+        payload = {
+            "presence" : presence
+        }
+
+        if statusMessage:
+            payload["status_msg"] = statusMessage
+
+        endpoint = "presence/" + self.USER_ID + "/status"
+
+        return await self._async_put(endpoint=endpoint, payload=payload)
+
+
     def joinedRooms(self):
         """
         Get a list of rooms the user is in
@@ -347,6 +473,16 @@ class Runner:
 
         return self._get("joined_rooms")["joined_rooms"]
 
+    async def joinedRooms_async(self):
+        """
+        Get a list of rooms the user is in - Async version
+
+        @return return list
+        """
+
+        return (await self._async_get("joined_rooms"))["joined_rooms"]
+
+
     def publicRooms(self, server=None, limit=50, since=None):
         """
         Get a list of the public rooms on a server
@@ -370,6 +506,30 @@ class Runner:
 
         return self._get("publicRooms", query=query)
 
+    async def publicRooms_async(self, server=None, limit=50, since=None):
+        """
+        Get a list of the public rooms on a server - Async version
+
+        @param server String OPTIONAL the server to list from. Default homeserver
+        @param limit int OPTIONAL Max number of rooms to fetch
+        @param since String OPTIONAL a pagnation token, recived as next_batch
+
+        @return dict list with total room count
+        """
+        if not server:
+            server = self.HOMESERVER.strip("https://").strip("http://")
+
+        query = {
+            "server" : server,
+            "limit" : limit
+        }
+
+        if since:
+            query["since"] = since
+
+        return await self._async_get("publicRooms", query=query)
+
+
     def getRoomVisibility(self, roomID):
         """
             Get info on if a room is visible or not
@@ -382,6 +542,18 @@ class Runner:
         return self._get(endpoint=endpoint)
 
 
+    async def getRoomVisibility_async(self, roomID):
+        """
+            Get info on if a room is visible or not - Async version
+
+            @param room String the room ID
+
+            @return dict the visibility 
+        """
+        endpoint = "directory/list/room/" + roomID
+        return await self._async_get(endpoint=endpoint)
+
+
     def getRoomState(self, roomID):
         """
             Get all info on a room. Name, alias, joins, leaves...
@@ -392,6 +564,17 @@ class Runner:
         endpoint = "rooms/" + roomID + "/state"
         return self._get(endpoint=endpoint)
 
+    async def getRoomState_async(self, roomID):
+        """
+            Get all info on a room. Name, alias, joins, leaves... - Async version
+
+            @param roomID String
+        """
+
+        endpoint = "rooms/" + roomID + "/state"
+        return await self._async_get(endpoint=endpoint)
+
+
     def getRoomMembers(self, roomID):
         """
             Get all member join/leaves
@@ -402,6 +585,16 @@ class Runner:
         return self._get(endpoint=endpoint)
 
 
+    async def getRoomMembers_async(self, roomID):
+        """
+            Get all member join/leaves - Async version
+
+            @param roomID String
+        """
+        endpoint = "rooms/" + roomID + "/members"
+        return await self._async_get(endpoint=endpoint)
+
+
     def joinRoom(self, roomID, serverToJoinThrough=None, thirdPartySigned=None):
         """
             Join a specific room
@@ -428,6 +621,30 @@ class Runner:
         return self._post(endpoint=endpoint, query=query)
 
 
+    async def joinRoom_async(self, roomID, serverToJoinThrough=None, thirdPartySigned=None):
+        """
+            Join a specific room - Async version
+
+            @param roomID String the room to join
+            @param serverToJoinThrough String OPTIONAL the server to attempt to join the room through.
+            @param thirdPartySigned String OPTIONAL A signature of an m.third_party_invite token
+
+            @return dict the room id joined
+        """
+        if thirdPartySigned:
+            logging.error("We don't support third party signed room joins yet")
+
+        query=None
+
+        if serverToJoinThrough:
+            query = {
+            "server_name" : serverToJoinThrough
+            }
+
+        endpoint = "join/" + roomID
+        return await self._async_post(endpoint=endpoint, query=query)
+
+
     def leaveRoom(self, roomID):
         """
             Leave a room. To stop getting info about the room, also call forgetRoom()
@@ -437,6 +654,15 @@ class Runner:
         return self._post(endpoint=endpoint)
 
 
+    async def leaveRoom_async(self, roomID):
+        """
+            Leave a room. To stop getting info about the room, also call forgetRoom_async() - Async version
+        """
+
+        endpoint = "rooms/" + roomID + "/leave"
+        return await self._async_post(endpoint=endpoint)
+
+
     def forgetRoom(self, roomID):
         """
             To stop getting any info about a room. Good practice to call, so the server can delete rooms no one is in.
@@ -446,6 +672,15 @@ class Runner:
         return self._post(endpoint=endpoint)
 
 
+    async def forgetRoom_async(self, roomID):
+        """
+            To stop getting any info about a room - Async version
+        """
+
+        endpoint = "rooms/" + roomID + "/forget"
+        return await self._async_post(endpoint=endpoint)
+
+
     def sendTyping(self, roomID, seconds=None, userID=None):
         """
             Send typing notifications to the specified room
@@ -478,6 +713,38 @@ class Runner:
         return self._put(endpoint=endpoint, payload=payload)
 
 
+    async def sendTyping_async(self, roomID, seconds=None, userID=None):
+        """
+            Send typing notifications to the specified room - Async version
+
+            @param roomID String the room ID
+            @param seconds int OPTIONAL How many seconds to type for. Set to 0 to stop typing. Defaults to 10 seconds
+            @param userID String OPTIONAL The userID of who is typing. Defaults to current user
+
+            @return dict empty on success
+        """
+
+        if not userID:
+            userID = self.USER_ID
+
+        if seconds is None:
+            seconds = 10
+
+        endpoint = "rooms/" + roomID + "/typing/" + userID
+
+        if seconds == 0:
+            payload = {
+                "typing": False
+            }
+        else:
+            payload = {
+                "typing": True,
+                "timeout": seconds * 1000
+            }
+
+        return await self._async_put(endpoint=endpoint, payload=payload)
+
+
     def sync(self, serverSideFilter=None, presence=None, since=None, timeout=None):
         """
             The big Sync call
@@ -507,15 +774,87 @@ class Runner:
         logging.debug("Starting new poll!")
         return self._get("sync", query=query, timeout=timeout)
 
-    async def sync_async(self, serverSideFilter=None, presence=None, since=None, timeout=None):
+    async def sync_async(self, serverSideFilter=None, presence=None, since=None, timeout=None, requestTimeout=None):
         """
             The big Sync call - Async version
             @param serverSideFilter string filter
             @param presence String presence for the user. Defaults online
             @param since String ask for every action since this specific pagination ID
             @param timeout int Ask the server to long poll. 
+            @param requestTimeout int OPTIONAL seconds to wait for the whole response, for big initial syncs
+        """
+        query, http_request_timeout = self._syncQuery(serverSideFilter=serverSideFilter, presence=presence, since=since, timeout=timeout)
+        http_request_timeout = requestTimeout or http_request_timeout
+
+        logging.debug("Starting new async poll!")
+        return await self._async_get("sync", query=query, timeout=http_request_timeout)
+
+    async def sync_stream_async(self, serverSideFilter=None, presence=None, since=None, timeout=None, chunkSize=65536, requestTimeout=None):
+        """
+            The big Sync call, decoded as it downloads. Joined rooms are yielded one at a time as soon as they are read,
+            so the whole response never sits in memory at once. See halcyon.syncstream
+
+            @param serverSideFilter string filter
+            @param presence String presence for the user. Defaults online
+            @param since String ask for every action since this specific pagination ID
+            @param timeout int Ask the server to long poll.
+            @param chunkSize int OPTIONAL how many bytes to read at a time
+            @param requestTimeout int OPTIONAL seconds to wait for the whole response, for big initial syncs
+
+            @return async generator of ("join", roomID, dict) for every joined room,
+                    then a final ("sync", None, dict) with the rest of the response (next_batch, invites, leaves...)
         """
+        query, http_request_timeout = self._syncQuery(serverSideFilter=serverSideFilter, presence=presence, since=since, timeout=timeout)
+        http_request_timeout = requestTimeout or http_request_timeout
 
+        url = self.HOMESERVER + "/" + Basepath.CLIENT + "/sync"
+        headers = {
+            "Authorization": "Bearer " + self.access_token,
+        }
+
+        session = await self._ensure_session()
+        requestTimeout = aiohttp.ClientTimeout(total=http_request_timeout) if http_request_timeout else aiohttp.ClientTimeout(total=30)
+
+        logging.debug("Starting new streamed poll!")
+        retryCount = 1
+        while True:
+            # Same retries as _async_request, but only until the first room is handed out. After that the
+            # caller has already dispatched part of the batch, so it has to decide what to do
+            started = False
+            try:
+                async with session.get(url, headers=headers, params=query, timeout=requestTimeout) as resp:
+                    if resp.status == 429:
+                        raise RateLimited(await retryAfter(resp, self.codec.loads))
+                    resp.raise_for_status()
+
+                    decoder = SyncStreamDecoder(loads=self.codec.loads)
+                    async for chunk in resp.content.iter_chunked(chunkSize):
+                        for roomID, joinedRoom in decoder.feed(chunk):
+                            started = True
+                            yield ("join", roomID, joinedRoom)
+                    rest = decoder.close()
+                break
+
+            except RateLimited as e:
+                if started or retryCount <= 0:
+                    raise
+                retryCount = retryCount - 1
+                await asyncio.sleep(e.retryAfter if e.retryAfter is not None else (2 ** (1 - retryCount)) + 0.1)
+
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if started or retryCount <= 0:
+                    raise
+                retryCount = retryCount - 1
+                await asyncio.sleep((2 ** (1 - retryCount)) + 0.1)
+
+        yield ("sync", None, rest)
+
+    def _syncQuery(self, serverSideFilter=None, presence=None, since=None, timeout=None):
+        """
+            Build the query for a sync call
+
+            @return (dict query, int http timeout or None)
+        """
         if not presence:
             presence = Presence.ONLINE
 
@@ -535,8 +874,37 @@ class Runner:
         else:
             http_request_timeout = None
 
-        logging.debug("Starting new async poll!")
-        return await self._async_get("sync", query=query, timeout=http_request_timeout)
+        return query, http_request_timeout
+
+    def createFilter(self, filterDefinition, userID=None):
+        """
+            Upload a filter definition for use with sync
+
+            @param filterDefinition dict the filter, see halcyon.filters.SyncFilter
+            @param userID String OPTIONAL the user to register the filter for. Defaults to current user
+
+            @return dict containing 'filter_id'
+        """
+        if not userID:
+            userID = self.USER_ID
+
+        endpoint = "user/" + userID + "/filter"
+        return self._post(endpoint=endpoint, payload=filterDefinition)
+
+    async def createFilter_async(self, filterDefinition, userID=None):
+        """
+            Upload a filter definition for use with sync - Async version
+
+            @param filterDefinition dict the filter, see halcyon.filters.SyncFilter
+            @param userID String OPTIONAL the user to register the filter for. Defaults to current user
+
+            @return dict containing 'filter_id'
+        """
+        if not userID:
+            userID = self.USER_ID
+
+        endpoint = "user/" + userID + "/filter"
+        return await self._async_post(endpoint=endpoint, payload=filterDefinition)
 
     def sendEvent(self, roomID, eventType, eventPayload):
         """
@@ -547,12 +915,21 @@ class Runner:
 
         return self._put(endpoint=endpoint, payload=eventPayload)
 
-    async def sendEvent_async(self, roomID, eventType, eventPayload):
+    async def sendEvent_async(self, roomID, eventType, eventPayload, txnID=None):
         """
             Send a matrix event - Async version
+
+            Sends go through the scheduler, so they are retried with the same txn ID if they get rate limited, and wait
+            their turn if the scheduler was given rates to keep to
+
+            @param txnID String OPTIONAL the transaction ID to send with. Resending with the same one is a no-op on the server
         """
-        endpoint = "rooms/" + roomID + "/send/" + eventType + "/" + self._getTXNID()
-        return await self._async_put(endpoint=endpoint, payload=eventPayload)
+        endpoint = "rooms/" + roomID + "/send/" + eventType + "/" + (txnID or self._getTXNID())
+
+        async def send():
+            return await self._async_put(endpoint=endpoint, payload=eventPayload, retryRateLimit=False)
+
+        return await self.scheduler.run(roomID, send)
 
     def sendState(self, roomID, eventType, eventPayload, stateKey=None):
         """
@@ -568,6 +945,18 @@ class Runner:
 
         return self._put(endpoint=endpoint, payload=eventPayload)
 
+    async def sendState_async(self, roomID, eventType, eventPayload, stateKey=None):
+        """
+            Send a matrix state event - Async version
+
+        """
+        endpoint = "rooms/" + roomID + "/state/" + eventType
+
+        if stateKey:
+            endpoint += "/" + stateKey
+
+        return await self._async_put(endpoint=endpoint, payload=eventPayload)
+
 
         """
 
@@ -23,12 +23,18 @@
         m.room.encrypted
 """
 
-from pydantic import BaseModel, Field, PrivateAttr
+from pydantic import PrivateAttr, PlainSerializer
 from typing import Optional, Dict, Any, List, Union
-from halcyon.security import get_nested_config, get_security_mode
+from typing_extensions import Annotated
+from halcyon.security import get_nested_config
+from halcyon.members import MemberTable
+from halcyon.permissions import PermissionIndex
+from halcyon.acl import ServerAclMatcher
+from halcyon.lazy import LazyFieldsMixin
+from halcyon.model import HalcyonModel
 
 
-class IdReturn(BaseModel):
+class IdReturn(HalcyonModel):
     """Helper class for Matrix ID references"""
     model_config = get_nested_config()
     
@@ -43,7 +49,7 @@ class IdReturn(BaseModel):
         return self.id is not None
 
 
-class RoomPredecessor(BaseModel):
+class RoomPredecessor(HalcyonModel):
     """Room predecessor information"""
     model_config = get_nested_config()
     
@@ -54,8 +60,8 @@ class RoomPredecessor(BaseModel):
     def __init__(self, raw_content: Optional[Dict[str, Any]] = None, **kwargs):
         if raw_content:
             super().__init__(
-                event=IdReturn(raw_content.get("event_id")),
-                room=IdReturn(raw_content.get("room_id")),
+                event=self._model(IdReturn)(raw_content.get("event_id")),
+                room=self._model(IdReturn)(raw_content.get("room_id")),
                 **kwargs
             )
             self._raw = raw_content
@@ -67,7 +73,7 @@ class RoomPredecessor(BaseModel):
         return self._raw is not None
 
 
-class RoomPermissions(BaseModel):
+class RoomPermissions(HalcyonModel):
     """Room power levels and permissions"""
     model_config = get_nested_config()
     
@@ -94,6 +100,7 @@ class RoomPermissions(BaseModel):
     notifications: Optional[Dict[str, int]] = None
     
     _raw: Optional[Dict[str, Any]] = PrivateAttr(default=None)
+    _index: Optional[PermissionIndex] = PrivateAttr(default=None)
     
     def __init__(self, raw_content: Optional[Dict[str, Any]] = None, **kwargs):
         if raw_content:
@@ -131,12 +138,35 @@ class RoomPermissions(BaseModel):
         else:
             super().__init__(**kwargs)
             self._raw = None
+        # Built once here, a power levels change builds a new RoomPermissions
+        self._index = PermissionIndex(self._power_levels())
+    
+    def _power_levels(self) -> Dict[str, Any]:
+        """The fields back in m.room.power_levels form"""
+        return {
+            "users": self.users, "users_default": self.user_value,
+            "events": self.m_event_values, "events_default": self.events_value, "state_default": self.state_value,
+            "invite": self.invite_value, "redact": self.redact_value, "ban": self.ban_value, "kick": self.kick_value,
+            "notifications": self.notifications,
+        }
+    
+    def level(self, user_id: str) -> int:
+        """The user's effective power level, users_default if they aren't listed"""
+        return self._index.level(user_id)
+    
+    def can(self, user_id: str, action_or_event_type: str, state: Optional[bool] = None, target: Optional[str] = None) -> bool:
+        """
+        Whether the user's power level allows an action ("invite", "kick", "ban", "redact", "notifications.room")
+        or sending an event type. state says whether the event type is a state event, it's guessed from the type
+        if not given. For kick and ban, target has to be below the user as well.
+        """
+        return self._index.can(user_id, action_or_event_type, state, target)
     
     def __bool__(self):
         return self._raw is not None
 
 
-class RoomServerAcl(BaseModel):
+class RoomServerAcl(HalcyonModel):
     """Room server access control list"""
     model_config = get_nested_config()
     
@@ -144,9 +174,11 @@ class RoomServerAcl(BaseModel):
     allow: List[str] = []
     deny: List[str] = []
     _raw: Optional[Dict[str, Any]] = PrivateAttr(default=None)
+    _matcher: Optional[ServerAclMatcher] = PrivateAttr(default=None)
     
     def __init__(self, raw_content: Optional[Dict[str, Any]] = None, **kwargs):
-        if raw_content:
+        # An ACL event with empty content is still an ACL, one with no allow list, which denies every server
+        if raw_content is not None:
             super().__init__(
                 allow_ip_literals=raw_content.get("allow_ip_literals"),
                 allow=raw_content.get("allow", []),
@@ -157,12 +189,22 @@ class RoomServerAcl(BaseModel):
         else:
             super().__init__(**kwargs)
             self._raw = None
+        # Compiled once per ACL event. Without one (and no allow list given) every server is allowed
+        if self._raw is not None or "allow" in self.model_fields_set:
+            self._matcher = ServerAclMatcher(self.allow, self.deny, self.allow_ip_literals)
+    
+    def is_server_allowed(self, server: str) -> bool:
+        """
+        Whether the ACL lets a server (with or without a port) take part in the room. Deny globs win over allow
+        globs, and a server that matches no allow glob is denied. Answers are cached per server name
+        """
+        return self._matcher is None or self._matcher.allowed(server)
     
     def __bool__(self):
         return self._raw is not None
 
 
-class RoomEncryption(BaseModel):
+class RoomEncryption(HalcyonModel):
     """Room encryption configuration"""
     model_config = get_nested_config()
     
@@ -188,7 +230,7 @@ class RoomEncryption(BaseModel):
         return self._raw is not None
 
 
-class RoomAvatar(BaseModel):
+class RoomAvatar(HalcyonModel):
     """Room avatar information"""
     model_config = get_nested_config()
     
@@ -224,7 +266,7 @@ class RoomAvatar(BaseModel):
         return self._raw is not None
 
 
-class RoomAlias(BaseModel):
+class RoomAlias(HalcyonModel):
     """Room alias information"""
     model_config = get_nested_config()
     
@@ -248,7 +290,7 @@ class RoomAlias(BaseModel):
         return self._raw is not None
 
 
-class RoomMember(BaseModel):
+class RoomMember(HalcyonModel):
     """Room member with profile information"""
     model_config = get_nested_config()
     
@@ -284,7 +326,15 @@ class RoomMember(BaseModel):
         return self._raw is not None
 
 
-class Room(BaseModel):
+# members, left and invited hold MemberTable views, and member_details a MemberDetails. Both dump like before
+_MemberIDs = Annotated[List[str], PlainSerializer(list, return_type=List[str])]
+_MemberDetails = Annotated[Dict[str, RoomMember], PlainSerializer(dict, return_type=Dict[str, RoomMember])]
+
+# Permissions in a room with neither power levels nor a creator
+_NO_POWER_LEVELS = PermissionIndex(None)
+
+
+class Room(HalcyonModel):
     """Matrix room state and events"""
     model_config = get_nested_config()
     
@@ -317,10 +367,10 @@ class Room(BaseModel):
     avatar: Optional[RoomAvatar] = None
     
     # m.room.member
-    members: List[str] = []  # Simple list for backward compatibility
-    left: List[str] = []
-    invited: List[str] = []
-    member_details: Dict[str, RoomMember] = {}  # Detailed member information
+    members: _MemberIDs = []  # Simple list for backward compatibility
+    left: _MemberIDs = []
+    invited: _MemberIDs = []
+    member_details: _MemberDetails = {}  # Detailed member information
     
     # m.room.power_levels
     permissions: Optional[RoomPermissions] = None
@@ -342,6 +392,10 @@ class Room(BaseModel):
     
     # Private attributes
     _rawEvents: Optional[List[Dict[str, Any]]] = PrivateAttr(default=None)
+    _stateIndex: Optional[Dict[Any, int]] = PrivateAttr(default=None)
+    _memberTable: Optional[MemberTable] = PrivateAttr(default=None)
+    # The PermissionIndex used while the room has no power levels event, built when m.room.create comes in
+    _defaultPermissions: Optional[PermissionIndex] = PrivateAttr(default=None)
     _hasData: bool = PrivateAttr(default=False)
     
     def __init__(self, rawEvents: Optional[List[Dict[str, Any]]] = None, roomID: Optional[str] = None, **kwargs):
@@ -356,97 +410,281 @@ class Room(BaseModel):
     
     def _process_events(self, rawEvents: List[Dict[str, Any]]):
         """Process Matrix room events and populate fields"""
-        members = []
-        left = []
-        invited = []
-        relatedGroups = []
-        member_details = {}
+        self.members = []
+        self.left = []
+        self.invited = []
+        self.relatedGroups = []
+        self.member_details = {}
         
+        lax = self.security().lax
         for event in rawEvents:
-            event_type = event.get("type")
-            content = event.get("content", {})
-            
-            if event_type == "m.room.create":
-                self.creator = content.get("creator")
-                self.version = content.get("room_version", 1)  # default to 1 per spec
-                self.federated = content.get("m.federate", True)  # default to true per spec
-                self.room_type = content.get("type")
-                self.additional_creators = content.get("additional_creators", [])
-                if content.get("predecessor"):
-                    self.predecessor = RoomPredecessor(content.get("predecessor"))
-            
-            elif event_type == "m.room.join_rules":
-                self.joinRule = content.get("join_rule")
-                self.join_rule_allow = content.get("allow")
-            
-            elif event_type == "m.room.name":
-                self.name = content.get("name")
-            
-            elif event_type == "m.room.topic":
-                self.topic = content.get("topic")
-                self.topic_content = content.get("m.topic")
-            
-            elif event_type == "m.room.canonical_alias":
-                self.alias = RoomAlias(content)
-            
-            elif event_type == "m.room.avatar":
-                self.avatar = RoomAvatar(content)
-            
-            elif event_type == "m.room.related_groups":
-                relatedGroups.extend(content.get("groups", []))
-            
-            elif event_type == "m.room.guest_access":
-                # This defaults to false, and is only true if can_join is explicitly set
-                self.guestAccess = (content.get("guest_access") == "can_join")
-            
-            elif event_type == "m.room.history_visibility":
-                self.historyVisibility = content.get("history_visibility")
-            
-            elif event_type == "m.room.member":
-                membership = content.get("membership")
-                user_id = event.get("user_id") or event.get("state_key")
-                
-                if user_id:
-                    # Create detailed member object
-                    member_obj = RoomMember(user_id, content)
-                    member_details[user_id] = member_obj
-                    
-                    # Maintain backward compatibility lists
-                    if membership == "join":
-                        members.append(user_id)
-                    elif membership == "leave":
-                        left.append(user_id)
-                    elif membership == "invite":
-                        invited.append(user_id)
-            
-            elif event_type == "m.room.power_levels":
-                self.permissions = RoomPermissions(content)
-            
-            elif event_type == "m.room.server_acl":
-                self.acl = RoomServerAcl(content)
+            self._apply_event(event, lax)
+    
+    def _apply_event(self, event: Dict[str, Any], lax: bool = False):
+        """Apply a single state event on top of the current state"""
+        event_type = event.get("type")
+        content = event.get("content", {})
+        
+        if event_type == "m.room.create":
+            self.creator = content.get("creator")
+            self._defaultPermissions = PermissionIndex(None, self.creator)
+            self.version = content.get("room_version", 1)  # default to 1 per spec
+            self.federated = content.get("m.federate", True)  # default to true per spec
+            self.room_type = content.get("type")
+            self.additional_creators = content.get("additional_creators", [])
+            if content.get("predecessor"):
+                self.predecessor = self._model(RoomPredecessor)(content.get("predecessor"))
+        
+        elif event_type == "m.room.join_rules":
+            self.joinRule = content.get("join_rule")
+            self.join_rule_allow = content.get("allow")
+        
+        elif event_type == "m.room.name":
+            self.name = content.get("name")
+        
+        elif event_type == "m.room.topic":
+            self.topic = content.get("topic")
+            self.topic_content = content.get("m.topic")
+        
+        elif event_type == "m.room.canonical_alias":
+            self.alias = self._model(RoomAlias)(content)
+        
+        elif event_type == "m.room.avatar":
+            self.avatar = self._model(RoomAvatar)(content)
+        
+        elif event_type == "m.room.related_groups":
+            # State, so a newer event replaces the groups instead of adding to them
+            self.relatedGroups = list(content.get("groups", []))
+        
+        elif event_type == "m.room.guest_access":
+            # This defaults to false, and is only true if can_join is explicitly set
+            self.guestAccess = (content.get("guest_access") == "can_join")
+        
+        elif event_type == "m.room.history_visibility":
+            self.historyVisibility = content.get("history_visibility")
+        
+        elif event_type == "m.room.member":
+            user_id = event.get("user_id") or event.get("state_key")
             
-            elif event_type == "m.room.encryption":
-                self.encryption = RoomEncryption(content)
+            if user_id:
+                # Moves the user between members, left and invited. The RoomMember is built when it's read
+                self._member_table().apply(user_id, content)
+        
+        elif event_type == "m.room.power_levels":
+            self.permissions = self._model(RoomPermissions)(content)
+        
+        elif event_type == "m.room.server_acl":
+            self.acl = self._model(RoomServerAcl)(content)
         
-        # Set the lists
-        self.members = members
-        self.left = left
-        self.invited = invited
-        self.relatedGroups = relatedGroups
-        self.member_details = member_details
+        elif event_type == "m.room.encryption":
+            self.encryption = self._model(RoomEncryption)(content)
         
         # Handle lax mode for extra fields
-        if get_security_mode() == 'lax':
-            for event in rawEvents:
-                content = event.get("content", {})
-                for key, value in content.items():
-                    if not hasattr(self, key) and key not in {'creator', 'room_version', 'm.federate', 'predecessor', 'join_rule', 'name', 'topic', 'alias', 'url', 'groups', 'guest_access', 'history_visibility', 'membership', 'users', 'allow_ip_literals', 'allow', 'deny', 'algorithm', 'rotation_period_ms', 'rotation_period_msgs'}:
-                        self.__dict__[key] = value
+        if lax:
+            for key, value in content.items():
+                if not hasattr(self, key) and key not in {'creator', 'room_version', 'm.federate', 'predecessor', 'join_rule', 'name', 'topic', 'alias', 'url', 'groups', 'guest_access', 'history_visibility', 'membership', 'users', 'allow_ip_literals', 'allow', 'deny', 'algorithm', 'rotation_period_ms', 'rotation_period_msgs'}:
+                    self.__dict__[key] = value
+    
+    def _member_table(self) -> MemberTable:
+        """The table behind members, left, invited and member_details, started again whenever those are reset"""
+        private = self.__pydantic_private__
+        table = private.get("_memberTable")
+        if table is None or self.__dict__.get("member_details") is not table.details:
+            table = private["_memberTable"] = MemberTable(self._model(RoomMember))
+            self.__dict__.update(members=table.joined, left=table.left, invited=table.invited, member_details=table.details)
+            self.__pydantic_fields_set__.update(("members", "left", "invited", "member_details"))
+        return table
+    
+    def _permission_index(self) -> PermissionIndex:
+        permissions = self.permissions
+        if permissions:
+            return permissions._index
+        # No power levels event, the creator has 100 and everyone else 0
+        creator = self.creator
+        if creator is None:
+            return _NO_POWER_LEVELS
+        index = self.__pydantic_private__.get("_defaultPermissions")
+        # Only missing when creator was set by hand instead of by an m.room.create event
+        return index if index is not None else PermissionIndex(None, creator)
+    
+    def power_level(self, user_id: str) -> int:
+        """The user's effective power level in the room"""
+        return self._permission_index().level(user_id)
+    
+    def can(self, user_id: str, action_or_event_type: str, state: Optional[bool] = None, target: Optional[str] = None) -> bool:
+        """
+        Whether the user may do an action ("invite", "kick", "ban", "redact", "notifications.room") or send an event
+        type in the room, see RoomPermissions.can. Worked out once per power levels event, so it's cheap to call
+        for every message
+        """
+        return self._permission_index().can(user_id, action_or_event_type, state, target)
+    
+    def is_server_allowed(self, server: str) -> bool:
+        """Whether the room's server ACL lets a server in, see RoomServerAcl.is_server_allowed. True without an ACL"""
+        acl = self.acl
+        return acl is None or acl.is_server_allowed(server)
+    
+    def membership(self, user_id: str) -> Optional[str]:
+        """The user's membership (join, leave, invite, ban, knock), or None. Doesn't build a RoomMember"""
+        details = self.member_details
+        table = self.__pydantic_private__.get("_memberTable")
+        if table is not None and details is table.details:
+            return table.membership(user_id)
+        member = details.get(user_id)
+        return member.membership if member is not None else None
+    
+    def apply_state_event(self, event: Dict[str, Any]):
+        """
+        Update the room with a new state event, ie one from the state or timeline section of /sync.
+        Events without a state_key are ignored.
+        """
+        self.apply_state_events([event])
+    
+    def apply_state_events(self, events: List[Dict[str, Any]]):
+        """Update the room with a list of state events, in order"""
+        lax = self.security().lax
+        for event in events:
+            if "state_key" not in event:
+                continue
+            
+            self._record_state(event)
+            self._apply_event(event, lax)
+            self._hasData = True
+    
+    def _record_state(self, event: Dict[str, Any]):
+        """Keep _rawEvents as the current state, replacing the old event with the same type and state key"""
+        if self._rawEvents is None:
+            self._rawEvents = []
+        
+        if self._stateIndex is None:
+            # Copy first, the list we were built from belongs to whoever fetched it
+            self._rawEvents = list(self._rawEvents)
+            self._stateIndex = {}
+            for position, old in enumerate(self._rawEvents):
+                self._stateIndex[(old.get("type"), old.get("state_key", ""))] = position
+        
+        key = (event.get("type"), event.get("state_key", ""))
+        position = self._stateIndex.get(key)
+        if position is None:
+            self._stateIndex[key] = len(self._rawEvents)
+            self._rawEvents.append(event)
+        else:
+            self._rawEvents[position] = event
     
     def __bool__(self):
         return self._hasData
 
 
+# The fields each state event type sets, for LazyRoom
+LAZY_FIELDS = {
+    "m.room.create": ("creator", "version", "federated", "predecessor", "room_type", "additional_creators"),
+    "m.room.join_rules": ("joinRule", "join_rule_allow"),
+    "m.room.name": ("name",),
+    "m.room.topic": ("topic", "topic_content"),
+    "m.room.canonical_alias": ("alias",),
+    "m.room.avatar": ("avatar",),
+    "m.room.member": ("members", "left", "invited", "member_details"),
+    "m.room.power_levels": ("permissions",),
+    "m.room.related_groups": ("relatedGroups",),
+    "m.room.guest_access": ("guestAccess",),
+    "m.room.history_visibility": ("historyVisibility",),
+    "m.room.server_acl": ("acl",),
+    "m.room.encryption": ("encryption",),
+}
+_LAZY_FIELD_TYPES = {field: eventType for eventType, fields in LAZY_FIELDS.items() for field in fields}
+
+
+def _index_state(stateEvents: Dict[Any, Dict[str, Any]], pending: set, event: Dict[str, Any]):
+    """Remember the latest event for its (type, state_key), and mark its type as unparsed"""
+    eventType = event.get("type")
+    if eventType not in LAZY_FIELDS:
+        return
+
+    stateKey = event.get("state_key", "")
+    if eventType == "m.room.member":
+        stateKey = event.get("user_id") or stateKey
+    # Re-inserting moves it to the end, the same place Room appends a member whose membership changed
+    stateEvents.pop((eventType, stateKey), None)
+    stateEvents[(eventType, stateKey)] = event
+    pending.add(eventType)
+
+
+class LazyRoom(LazyFieldsMixin, Room):
+    """
+    The "room minimal". Same attributes as Room, but the state events are only indexed by (type, state_key)
+    when the room is built. A field is parsed the first time it is read, so a handler that only looks at
+    room.name never pays for a RoomMember per member, or for the power levels and ACL models.
+
+    In lax mode the room is parsed up front like a Room, since the extra content keys aren't known until then.
+    """
+    _stateEvents: Optional[Dict[Any, Dict[str, Any]]] = PrivateAttr(default=None)
+    _pending: Optional[set] = PrivateAttr(default=None)
+
+    def __init__(self, rawEvents: Optional[List[Dict[str, Any]]] = None, roomID: Optional[str] = None, **kwargs):
+        super().__init__(roomID=roomID, **kwargs)
+        self._rawEvents = rawEvents
+        self._stateEvents = stateEvents = {}
+        self._pending = pending = set()
+
+        if not rawEvents:
+            return
+        self._hasData = True
+
+        if self.security().lax:
+            self._process_events(rawEvents)
+            return
+
+        for event in rawEvents:
+            _index_state(stateEvents, pending, event)
+        for eventType in pending:
+            for field in LAZY_FIELDS[eventType]:
+                self.__dict__.pop(field, None)
+
+    def _materialise(self, eventType: str):
+        """Parse every indexed event of one type into the room's fields"""
+        self._pending.discard(eventType)
+        for field in LAZY_FIELDS[eventType]:
+            self.__dict__[field] = type(self).model_fields[field].get_default(call_default_factory=True)
+        for (indexedType, _), event in list(self._stateEvents.items()):
+            if indexedType == eventType:
+                self._apply_event(event)
+        self.__pydantic_fields_set__.update(LAZY_FIELDS[eventType])
+
+    def _materialise_all(self):
+        for eventType in list(self._pending or ()):
+            self._materialise(eventType)
+
+    def __getattr__(self, name: str):
+        eventType = _LAZY_FIELD_TYPES.get(name)
+        if eventType is not None and eventType in (self.__pydantic_private__ or {}).get("_pending", ()):
+            self._materialise(eventType)
+            return self.__dict__[name]
+        return super().__getattr__(name)
+
+    def apply_state_events(self, events: List[Dict[str, Any]]):
+        lax = self.security().lax
+        for event in events:
+            if "state_key" not in event:
+                continue
+
+            self._record_state(event)
+            self._hasData = True
+            eventType = event.get("type")
+            if lax or eventType not in LAZY_FIELDS:
+                self._apply_event(event, lax)
+                continue
+
+            parsed = eventType not in self._pending
+            _index_state(self._stateEvents, self._pending, event)
+            if parsed:
+                # The fields are already current, keep them that way like Room does
+                self._pending.discard(eventType)
+                self._apply_event(event)
+            else:
+                for field in LAZY_FIELDS[eventType]:
+                    self.__dict__.pop(field, None)
+
+
 # Create compatibility aliases for the old nested class structure
 room = Room
 room.roomPredecessor = RoomPredecessor
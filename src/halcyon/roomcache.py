@@ -0,0 +1,294 @@
+"""
+    Bounded room cache.
+
+    Every cached room holds its full state, including a RoomMember per member, so a bot that sits in (or has
+    passed through) thousands of rooms keeps growing. RoomCache is a dict-like store for Client.roomCache["rooms"]
+    that can cap the number of rooms (least recently used goes first), expire rooms after a while, and keep an
+    approximate memory budget. Evicted rooms are simply fetched again the next time they're needed.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+
+# Rough cost of a cached room, used for the memory budget. A state event turns into its raw dict plus the
+# parsed model (a member table row for member events), which lands somewhere around 2KB on CPython
+ROOM_OVERHEAD_BYTES = 4096
+STATE_EVENT_BYTES = 2048
+
+
+def estimateRoomSize(cachedRoom):
+    """
+        @param cachedRoom room
+
+        @return int approximate bytes the room takes up in memory
+    """
+    rawEvents = getattr(cachedRoom, "_rawEvents", None) or []
+    return ROOM_OVERHEAD_BYTES + STATE_EVENT_BYTES * len(rawEvents)
+
+
+class _Entry:
+    __slots__ = ("room", "size", "added")
+
+    def __init__(self, room, size, added):
+        self.room = room
+        self.size = size
+        self.added = added
+
+
+class RoomCache(MutableMapping):
+    """
+        A dict of roomID -> room with limits. Every limit is optional, with none set it behaves like a plain dict
+
+        @param maxRooms int OPTIONAL keep at most this many rooms, evicting the least recently used
+        @param ttl float OPTIONAL seconds a room stays cached before it is fetched again
+        @param maxBytes int OPTIONAL approximate memory budget for every cached room together
+        @param sizeOf function OPTIONAL estimates the bytes one room takes, defaults to estimateRoomSize
+    """
+    def __init__(self, maxRooms=None, ttl=None, maxBytes=None, sizeOf=None):
+        self.maxRooms = maxRooms
+        self.ttl = ttl
+        self.maxBytes = maxBytes
+        self.sizeOf = sizeOf or estimateRoomSize
+        self._entries = OrderedDict()
+        self.bytes = 0
+        #rooms stored or changed since the last takeChanged(), so a snapshot only has to write those
+        self.changed = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.removals = 0
+
+    def _expired(self, entry, now=None):
+        return self.ttl is not None and (now or time.monotonic()) - entry.added > self.ttl
+
+    def _drop(self, roomID):
+        entry = self._entries.pop(roomID)
+        self.bytes -= entry.size
+        return entry
+
+    def _live(self, roomID):
+        """The entry for a room, or None if it isn't cached or has expired. Doesn't count as a use"""
+        entry = self._entries.get(roomID)
+        if entry is not None and self._expired(entry):
+            self._drop(roomID)
+            self.expirations += 1
+            return None
+        return entry
+
+    def __getitem__(self, roomID):
+        entry = self._live(roomID)
+        if entry is None:
+            raise KeyError(roomID)
+        self._entries.move_to_end(roomID)
+        return entry.room
+
+    def get(self, roomID, default=None):
+        """Look a room up, counting it as a hit or a miss"""
+        entry = self._live(roomID)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._entries.move_to_end(roomID)
+        return entry.room
+
+    def __contains__(self, roomID):
+        return self._live(roomID) is not None
+
+    def __setitem__(self, roomID, cachedRoom):
+        if roomID in self._entries:
+            self._drop(roomID)
+
+        size = self.sizeOf(cachedRoom)
+        self._entries[roomID] = _Entry(cachedRoom, size, time.monotonic())
+        self.bytes += size
+        self.changed.add(roomID)
+        self._evict(keep=roomID)
+
+    def __delitem__(self, roomID):
+        self._drop(roomID)
+
+    def __iter__(self):
+        self.purge()
+        return iter(list(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def discard(self, roomID):
+        """
+            Forget a room we're no longer in
+
+            @return bool True if it was cached
+        """
+        if roomID not in self._entries:
+            return False
+        self._drop(roomID)
+        self.removals += 1
+        return True
+
+    def resize(self, roomID):
+        """Re-estimate a room's size after its state changed, and mark it changed"""
+        entry = self._entries.get(roomID)
+        if entry is None:
+            return
+        size = self.sizeOf(entry.room)
+        self.bytes += size - entry.size
+        entry.size = size
+        self.changed.add(roomID)
+        self._evict(keep=roomID)
+
+    def takeChanged(self):
+        """
+            @return set of room IDs stored or changed since the last call, which starts a new set
+        """
+        changed, self.changed = self.changed, set()
+        return changed
+
+    def purge(self):
+        """
+            Drop every expired room
+
+            @return int how many were dropped
+        """
+        if self.ttl is None:
+            return 0
+        now = time.monotonic()
+        expired = [roomID for roomID, entry in self._entries.items() if self._expired(entry, now)]
+        for roomID in expired:
+            self._drop(roomID)
+        self.expirations += len(expired)
+        return len(expired)
+
+    def _overLimit(self):
+        return ((self.maxRooms is not None and len(self._entries) > self.maxRooms)
+                or (self.maxBytes is not None and self.bytes > self.maxBytes))
+
+    def _evict(self, keep=None):
+        if not self._overLimit():
+            return
+        #expired rooms go before ones that are merely old
+        self.purge()
+        while self._overLimit():
+            roomID = next(iter(self._entries))
+            if roomID == keep:
+                #a single room bigger than the whole budget still gets cached, on its own
+                if len(self._entries) == 1:
+                    return
+                self._entries.move_to_end(roomID)
+                continue
+            self._drop(roomID)
+            self.evictions += 1
+
+    @property
+    def full(self):
+        """True once adding another room would evict one"""
+        return self.maxRooms is not None and len(self._entries) >= self.maxRooms
+
+    def stats(self):
+        """
+            @return dict hit/miss/eviction counters, plus how many rooms and bytes are cached
+        """
+        return {
+            "rooms": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "removals": self.removals,
+        }
+
+
+class SingleFlight:
+    """
+        Coalesces concurrent calls for the same key into one. Everyone asking for a key while a call for it is
+        running waits on that call, instead of starting their own
+    """
+    def __init__(self):
+        self._calls = dict()
+
+    def inFlight(self, key):
+        return key in self._calls
+
+    async def do(self, key, fn):
+        """
+            @param key the thing being fetched, ie a room ID
+            @param fn coroutine function to call if nothing is in flight for key
+
+            @return whatever fn returns, or raises whatever it raised
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+
+        #one waiter giving up (timeout, cancel) mustn't cancel the call for everyone else
+        return await asyncio.shield(task)
+
+    def _finished(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # mark it retrieved, the waiters have already seen it
+
+
+class NegativeCache:
+    """
+        Remembers keys that recently failed, so they aren't retried on every use. The wait doubles on every
+        failure in a row, from baseTTL up to maxTTL. A key that hasn't failed again for maxTTL after its wait ran
+        out is forgotten, and starts over from baseTTL
+
+        @param baseTTL float OPTIONAL seconds to wait after the first failure
+        @param maxTTL float OPTIONAL the longest wait
+    """
+    def __init__(self, baseTTL=5, maxTTL=300):
+        self.baseTTL = baseTTL
+        self.maxTTL = maxTTL
+        self._failures = dict()  # key -> (retryAt, failures in a row)
+        self._pruneAt = 64  # sweep forgotten keys once there are this many
+
+    def blocked(self, key):
+        """
+            @return bool True if key failed recently and shouldn't be tried yet
+        """
+        failure = self._failures.get(key)
+        if failure is None:
+            return False
+        now = time.monotonic()
+        if now >= failure[0] + self.maxTTL:
+            del self._failures[key]
+            return False
+        return now < failure[0]
+
+    def failed(self, key):
+        """
+            @return float seconds until key can be tried again
+        """
+        now = time.monotonic()
+        failure = self._failures.get(key)
+        failures = failure[1] + 1 if failure is not None and now < failure[0] + self.maxTTL else 1
+        ttl = min(self.baseTTL * 2 ** (failures - 1), self.maxTTL)
+        self._failures[key] = (now + ttl, failures)
+        if len(self._failures) >= self._pruneAt:
+            self._prune(now)
+        return ttl
+
+    def succeeded(self, key):
+        self._failures.pop(key, None)
+
+    def _prune(self, now):
+        """
+            Drop every forgotten key. Runs when the dict doubles, so it stays amortised O(1) per failure
+        """
+        self._failures = {key: failure for key, failure in self._failures.items() if now < failure[0] + self.maxTTL}
+        self._pruneAt = max(64, 2 * len(self._failures))
+
+    def __len__(self):
+        return len(self._failures)
@@ -1,108 +1,161 @@
 """
 Security configuration for Pydantic model validation:
-- 'strict': Secure defaults (extra='ignore', arbitrary_types=False) 
+- 'strict': Secure defaults (extra='ignore', arbitrary_types=False)
 - 'lax': Backward compatible (extra='allow', arbitrary_types=True)
 - 'custom': User-defined settings
+
+Independently of the mode, trusted=True builds Message and Room models without validating them (see halcyon.model),
+for data that comes straight from our own homeserver.
+
+The configuration is an immutable SecuritySnapshot. Changing it builds a new snapshot and swaps it in with a single
+assignment, so reading it (which every model does) never takes a lock. A Client keeps the snapshot it was
+configured with, and builds its models from classes compiled for it (see HalcyonModel.variant).
 """
 
 import threading
-from typing import Literal, Optional, Dict, Any
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Literal, Optional, Dict, Any, Mapping
 from pydantic import ConfigDict
 
 
 SecurityMode = Literal['strict', 'lax', 'custom']
 
+_MODE_SETTINGS = {
+    'strict': {'extra': 'ignore', 'arbitrary_types_allowed': False},
+    'lax': {'extra': 'allow', 'arbitrary_types_allowed': True},
+}
+
+
+@dataclass(frozen=True, eq=False)
+class SecuritySnapshot:
+    """One security configuration. Never changes once built, configure_security swaps in a new one"""
+    mode: SecurityMode = 'strict'
+    custom_settings: Mapping[str, Any] = field(default_factory=lambda: MappingProxyType({}))
+    trusted: bool = False
+    # Model classes compiled for this snapshot, filled in by HalcyonModel.variant
+    variants: Dict[type, type] = field(default_factory=dict, repr=False)
+
+    @property
+    def lax(self) -> bool:
+        return self.mode == 'lax'
+
+    def config_dict(self, **overrides) -> ConfigDict:
+        """Get Pydantic ConfigDict for this snapshot"""
+        if self.mode == 'custom':
+            config = dict(self.custom_settings)
+        else:
+            config = dict(_MODE_SETTINGS.get(self.mode, _MODE_SETTINGS['strict']))
+
+        # Apply any overrides
+        config.update(overrides)
+
+        return ConfigDict(**config)
+
 
 class SecurityConfig:
-    """Thread-safe security configuration manager"""
-    
+    """
+    Thread-safe security configuration manager. Writers are serialised by a lock, readers just read the
+    current snapshot
+    """
+
     def __init__(self):
-        self._lock = threading.RLock()
-        self._mode: SecurityMode = 'strict'  # Default to secure mode
-        self._custom_settings: Dict[str, Any] = {}
-    
+        self._lock = threading.Lock()
+        self.snapshot = SecuritySnapshot()  # Default to secure mode
+
+    def _swap(self, **changes) -> SecuritySnapshot:
+        with self._lock:
+            current = self.snapshot
+            values = {'mode': current.mode, 'custom_settings': current.custom_settings, 'trusted': current.trusted}
+            values.update(changes)
+            self.snapshot = SecuritySnapshot(**values)
+            return self.snapshot
+
+    def configure(self, mode: SecurityMode, trusted: bool = False, custom: Optional[Dict[str, Any]] = None) -> SecuritySnapshot:
+        """Swap in a whole new configuration at once"""
+        if mode not in ('strict', 'lax', 'custom'):
+            raise ValueError(f"Invalid security mode: {mode}. Must be 'strict', 'lax', or 'custom'")
+        changes = {'mode': mode, 'trusted': bool(trusted)}
+        if custom is not None:
+            changes['custom_settings'] = MappingProxyType(dict(custom))
+        return self._swap(**changes)
+
     def set_mode(self, mode: SecurityMode) -> None:
         """Set the security mode for all models"""
-        with self._lock:
-            if mode not in ('strict', 'lax', 'custom'):
-                raise ValueError(f"Invalid security mode: {mode}. Must be 'strict', 'lax', or 'custom'")
-            self._mode = mode
-    
+        if mode not in ('strict', 'lax', 'custom'):
+            raise ValueError(f"Invalid security mode: {mode}. Must be 'strict', 'lax', or 'custom'")
+        self._swap(mode=mode)
+
     def set_custom(self, extra: Literal['allow', 'ignore', 'forbid'] = 'ignore',
                    arbitrary_types: bool = False, **kwargs) -> None:
         """Set custom security settings"""
-        with self._lock:
-            self._mode = 'custom'
-            self._custom_settings = {
-                'extra': extra,
-                'arbitrary_types_allowed': arbitrary_types,
-                **kwargs
-            }
-    
+        self._swap(mode='custom', custom_settings=MappingProxyType(_custom_settings(extra, arbitrary_types, **kwargs)))
+
+    def set_trusted(self, trusted: bool) -> None:
+        """Build models without validation"""
+        self._swap(trusted=bool(trusted))
+
+    def is_trusted(self) -> bool:
+        """Whether models are built without validation"""
+        return self.snapshot.trusted
+
     def get_config_dict(self, **overrides) -> ConfigDict:
         """Get Pydantic ConfigDict for current security mode"""
-        with self._lock:
-            if self._mode == 'strict':
-                config = {
-                    'extra': 'ignore',
-                    'arbitrary_types_allowed': False,
-                }
-            elif self._mode == 'lax':
-                config = {
-                    'extra': 'allow', 
-                    'arbitrary_types_allowed': True,
-                }
-            elif self._mode == 'custom':
-                config = self._custom_settings.copy()
-            else:
-                # Fallback to strict
-                config = {
-                    'extra': 'ignore',
-                    'arbitrary_types_allowed': False,
-                }
-            
-            # Apply any overrides
-            config.update(overrides)
-            
-            return ConfigDict(**config)
-    
+        return self.snapshot.config_dict(**overrides)
+
     def get_mode(self) -> SecurityMode:
         """Get current security mode"""
-        with self._lock:
-            return self._mode
-    
+        return self.snapshot.mode
+
     def get_custom_settings(self) -> Dict[str, Any]:
         """Get current custom settings"""
-        with self._lock:
-            return self._custom_settings.copy()
+        return dict(self.snapshot.custom_settings)
+
+
+def _custom_settings(extra: Literal['allow', 'ignore', 'forbid'] = 'ignore', arbitrary_types: bool = False, **kwargs) -> Dict[str, Any]:
+    return {
+        'extra': extra,
+        'arbitrary_types_allowed': arbitrary_types,
+        **kwargs
+    }
 
 
 # Global security configuration instance
 _security_config = SecurityConfig()
 
 
-def configure_security(mode: SecurityMode = 'strict', **kwargs) -> None:
+def configure_security(mode: SecurityMode = 'strict', trusted: bool = False, **kwargs) -> SecurityMode:
     """
     Configure security mode for all Halcyon models.
-    
+
     Args:
         mode: Security mode ('strict', 'lax', or 'custom')
+        trusted: Build Message/Room models without pydantic validation. Only for events from a homeserver you trust
         **kwargs: Custom settings when mode='custom' (extra, arbitrary_types, etc.)
-    
+
+    Returns:
+        The new security mode. get_security_snapshot() returns the whole new configuration
+
     Examples:
         # Use strict mode (default)
         configure_security('strict')
-        
+
         # Use lax mode for backward compatibility
         configure_security('lax')
-        
+
         # Use custom settings
         configure_security('custom', extra='forbid', arbitrary_types=False)
+
+        # Skip validation for events from our own homeserver
+        configure_security('strict', trusted=True)
     """
-    if mode == 'custom':
-        _security_config.set_custom(**kwargs)
-    else:
-        _security_config.set_mode(mode)
+    custom = _custom_settings(**kwargs) if mode == 'custom' else None
+    return _security_config.configure(mode, trusted=trusted, custom=custom).mode
+
+
+def get_security_snapshot() -> SecuritySnapshot:
+    """Get the current configuration. Lock free, and it won't change under you"""
+    return _security_config.snapshot
 
 
 def get_security_config() -> ConfigDict:
@@ -112,7 +165,12 @@ def get_security_config() -> ConfigDict:
 
 def get_security_mode() -> SecurityMode:
     """Get current security mode"""
-    return _security_config.get_mode()
+    return _security_config.snapshot.mode
+
+
+def is_trusted() -> bool:
+    """Whether models are built without validation"""
+    return _security_config.snapshot.trusted
 
 
 def get_custom_security_settings() -> Dict[str, Any]:
@@ -124,11 +182,10 @@ def get_custom_security_settings() -> Dict[str, Any]:
 def get_message_config(**overrides) -> ConfigDict:
     """Get config for Message models (may need arbitrary_types for room objects)"""
     # Message class needs arbitrary_types for room object compatibility
-    if get_security_mode() != 'lax':
-        overrides.setdefault('arbitrary_types_allowed', True)
+    overrides.setdefault('arbitrary_types_allowed', True)
     return _security_config.get_config_dict(**overrides)
 
 
 def get_nested_config(**overrides) -> ConfigDict:
     """Get config for nested models (MessageContent, FileInfo, etc.)"""
-    return _security_config.get_config_dict(**overrides)
\ No newline at end of file
+    return _security_config.get_config_dict(**overrides)
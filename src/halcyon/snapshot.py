@@ -0,0 +1,153 @@
+"""
+    Room cache snapshots. Keeps the state of every cached room on disk, together with the sync token that state is
+    current as of, so a restart can load the cache straight off disk instead of fetching every room again.
+
+    On the next start the snapshot is loaded, then a single state only /sync from its token brings every room up to
+    date (and picks up rooms joined or left while the bot was down). A room's state is stored as its raw state
+    events, json encoded with the client's codec and zlib compressed.
+"""
+
+import logging
+import sqlite3
+import time
+import zlib
+
+from halcyon.codec import getCodec
+from halcyon.storage import writeAtomic
+
+
+MAGIC = b"HRCS1\n"
+
+
+class RoomSnapshot:
+    """
+        The room cache at one point in time
+
+        @param token String the since token the room state is current as of
+        @param rooms dict roomID -> list of raw state events
+        @param saved int OPTIONAL nanoseconds since epoch when the snapshot was taken
+        @param changed set OPTIONAL room IDs whose state changed since the last save. None if that isn't known,
+                       in which case every room counts as changed
+    """
+    __slots__ = ("token", "rooms", "saved", "changed")
+
+    def __init__(self, token, rooms, saved=None, changed=None):
+        self.token = token
+        self.rooms = rooms
+        self.saved = saved if saved is not None else time.time_ns()
+        self.changed = changed
+
+    def __len__(self):
+        return len(self.rooms)
+
+
+class RoomSnapshotStore:
+    """
+        Base snapshot store. Subclass this to keep snapshots somewhere else
+    """
+    def load(self, key):
+        """
+            @param key String the account the snapshot belongs to
+
+            @return RoomSnapshot the last saved snapshot, or None
+        """
+        raise NotImplementedError
+
+    def save(self, key, snapshot):
+        """
+            Replace the saved snapshot. Called from a worker thread, so the event loop isn't held up by the write
+
+            @param key String the account the snapshot belongs to
+            @param snapshot RoomSnapshot
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class FileRoomSnapshotStore(RoomSnapshotStore):
+    """
+        Keeps the snapshot in a single compressed file, rewritten atomically on every save
+
+        @param path String the file to keep the snapshot in
+        @param codec OPTIONAL json codec, see halcyon.codec. Defaults to the fastest one installed
+    """
+    def __init__(self, path, codec=None):
+        self.path = path
+        self.codec = codec if codec is not None else getCodec()
+
+    def load(self, key):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logging.warning("Room cache snapshot unreadable, building the cache from scratch: " + str(e))
+            return None
+
+        try:
+            if not data.startswith(MAGIC):
+                raise ValueError("not a room cache snapshot")
+            record = self.codec.loads(zlib.decompress(data[len(MAGIC):]))
+        except (zlib.error, ValueError) as e:
+            logging.warning("Room cache snapshot unreadable, building the cache from scratch: " + str(e))
+            return None
+
+        if record.get("account") != key:
+            return None
+        return RoomSnapshot(record["token"], record["rooms"], record.get("saved"))
+
+    def save(self, key, snapshot):
+        record = {"account": key, "token": snapshot.token, "saved": snapshot.saved, "rooms": snapshot.rooms}
+        writeAtomic(self.path, MAGIC + zlib.compress(self.codec.dumps(record)))
+
+
+class SQLiteRoomSnapshotStore(RoomSnapshotStore):
+    """
+        Keeps the snapshot in an SQLite database, one compressed row per room. Only the rooms in snapshot.changed
+        (and any the database doesn't have yet) are written, the rest are left as they are
+
+        @param path String the database file, ":memory:" works for testing
+        @param codec OPTIONAL json codec, see halcyon.codec. Defaults to the fastest one installed
+    """
+    def __init__(self, path, codec=None):
+        self.path = path
+        self.codec = codec if codec is not None else getCodec()
+        #saves run on a worker thread
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS room_snapshot (account TEXT PRIMARY KEY, token TEXT NOT NULL, saved INTEGER NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS room_snapshot_state (account TEXT NOT NULL, room_id TEXT NOT NULL, state BLOB NOT NULL, PRIMARY KEY (account, room_id))")
+        self._db.commit()
+
+    def load(self, key):
+        row = self._db.execute("SELECT token, saved FROM room_snapshot WHERE account = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        rooms = dict()
+        for roomID, state in self._db.execute("SELECT room_id, state FROM room_snapshot_state WHERE account = ?", (key,)):
+            try:
+                rooms[roomID] = self.codec.loads(zlib.decompress(state))
+            except (zlib.error, ValueError) as e:
+                #the room is fetched on first use instead
+                logging.warning("Skipping unreadable snapshot of room " + roomID + ": " + str(e))
+        return RoomSnapshot(row[0], rooms, row[1])
+
+    def save(self, key, snapshot):
+        stored = {roomID for roomID, in self._db.execute("SELECT room_id FROM room_snapshot_state WHERE account = ?", (key,))}
+
+        changed = []
+        for roomID, events in snapshot.rooms.items():
+            if snapshot.changed is None or roomID in snapshot.changed or roomID not in stored:
+                changed.append((key, roomID, zlib.compress(self.codec.dumps(events))))
+        gone = stored.difference(snapshot.rooms)
+
+        with self._db:
+            self._db.executemany("DELETE FROM room_snapshot_state WHERE account = ? AND room_id = ?", [(key, roomID) for roomID in gone])
+            self._db.executemany("INSERT OR REPLACE INTO room_snapshot_state (account, room_id, state) VALUES (?, ?, ?)", changed)
+            self._db.execute("INSERT OR REPLACE INTO room_snapshot (account, token, saved) VALUES (?, ?, ?)", (key, snapshot.token, snapshot.saved))
+
+    def close(self):
+        self._db.close()
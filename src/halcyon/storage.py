@@ -0,0 +1,26 @@
+"""
+    File helpers shared by the on-disk stores (checkpoints, filter IDs, the outbox, room snapshots).
+"""
+
+import os
+
+
+def writeAtomic(path, data):
+    """
+        Replace the file at path with data, creating its directory if needed. The data is written to a temporary
+        file, synced to disk and renamed over the old file, so a crash leaves either the old file or the new one,
+        never half of one.
+
+        @param path str the file to write
+        @param data str or bytes the whole new contents
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    tmpPath = path + ".tmp"
+    with open(tmpPath, "wb" if isinstance(data, bytes) else "w") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpPath, path)
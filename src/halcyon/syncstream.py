@@ -0,0 +1,249 @@
+"""
+    Incremental /sync decoder.
+
+    resp.json() turns the whole /sync body into one dict, which for a big account is hundreds of MB at once.
+    SyncStreamDecoder is fed the body in chunks, and hands back each joined room (rooms.join.<roomID>) as soon as
+    its closing brace arrives. Only the room currently being read is held in memory, so peak memory scales with
+    the largest room instead of the whole response.
+
+    Everything that isn't a joined room (next_batch, invites, leaves, presence...) is decoded normally and
+    collected into a skeleton response, which has an empty rooms.join.
+
+    The scanner here only finds where each value ends. Inside a room one regex match skips over strings and
+    whole bracket groups, Python only steps through the few brackets nested too deep for it, and the room's
+    bytes are then handed to the codec in one call. Every room is still read twice, once to find its end and once to decode it, so this is a few times
+    slower than decoding the whole body at once. That's the price of never holding more than one room.
+"""
+
+import json
+import re
+
+
+# The objects we walk into instead of decoding whole
+_DESCEND = {(), ("rooms",), ("rooms", "join")}
+_JOINED_ROOM_DEPTH = 3
+
+_OUTSIDE_STRING = re.compile(rb'[{}\[\]",:]')
+_INSIDE_STRING = re.compile(rb'["\\]')
+
+# How deep a bracket group can nest and still be skipped by the regex in one go
+_SKIP_DEPTH = 4
+
+
+def _skipPattern(depth):
+    """
+        A regex that runs over the inside of a captured value: whole strings, and whole bracket groups nested up to
+        depth deep. It stops at a bracket it can't match whole (an unfinished or deeper group), at a string the
+        chunk cuts off, or at the end of the buffer. Written as unrolled loops, so a group that doesn't match
+        only costs a scan back over it instead of backtracking exponentially.
+    """
+    string = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+    plain = rb'[^"{}\[\]]*'
+    group = None
+    for _ in range(depth + 1):
+        item = string if group is None else rb'(?:' + string + rb'|' + group + rb')'
+        body = plain + rb'(?:' + item + plain + rb')*'
+        group = rb'[{\[]' + body + rb'[}\]]'
+    return re.compile(body, re.DOTALL)
+
+
+_SKIP_VALUE = _skipPattern(_SKIP_DEPTH)
+
+
+class SyncStreamDecoder:
+    """
+        Feed it the raw /sync body chunk by chunk
+
+        decoder = SyncStreamDecoder()
+        for chunk in body:
+            for roomID, joinedRoom in decoder.feed(chunk):
+                ...
+        resp = decoder.close()
+
+        @param loads function OPTIONAL decodes each captured value, ie a halcyon.codec loads. Defaults to json.loads
+    """
+    def __init__(self, loads=None):
+        self._loads = loads or json.loads
+        self._buf = bytearray()
+        self._pos = 0
+        self._depth = 0
+        self._paths = []  # the path of every object we walked into
+
+        self._inString = False
+        self._keyStart = None  # set while reading a key in an object we walked into
+        self._key = None
+        self._pendingPath = None  # path of a value we are about to walk into
+
+        self._capture = None  # (start, depth, path) of a value we are decoding whole
+
+        self.skeleton = dict()
+        self.roomCount = 0
+
+    def feed(self, chunk):
+        """
+            @param chunk bytes the next part of the body
+
+            @return list of (roomID, dict) for every joined room completed by this chunk
+        """
+        self._buf += chunk
+        rooms = []
+        self._scan(rooms)
+        self._compact()
+        return rooms
+
+    def close(self):
+        """
+            @return dict the sync response minus the joined rooms, which were handed out by feed()
+        """
+        if self._depth != 0 or self._inString or self._capture is not None:
+            raise ValueError("Sync body ended part way through")
+        return self.skeleton
+
+    def _scan(self, rooms):
+        buf = self._buf
+        while True:
+            if self._inString:
+                match = _INSIDE_STRING.search(buf, self._pos)
+                if match is None:
+                    self._pos = len(buf)
+                    return
+
+                pos = match.start()
+                if buf[pos] == 0x5c:  # backslash, skip whatever it escapes
+                    if pos + 1 >= len(buf):
+                        self._pos = pos
+                        return
+                    self._pos = pos + 2
+                    continue
+
+                self._inString = False
+                self._pos = pos + 1
+                if self._keyStart is not None:
+                    self._key = json.loads(b'"' + bytes(buf[self._keyStart:pos]) + b'"')
+                    self._keyStart = None
+                continue
+
+            if self._capture is not None and self._depth > self._capture[1]:
+                #inside a value we decode whole, only its brackets matter
+                pos = _SKIP_VALUE.match(buf, self._pos).end()
+                if pos == len(buf):
+                    self._pos = pos
+                    return
+                self._pos = pos + 1
+                if buf[pos] == 0x22:  # a string the next chunk finishes
+                    self._inString = True
+                else:
+                    self._scanCaptured(buf[pos], pos, rooms)
+                continue
+
+            match = _OUTSIDE_STRING.search(buf, self._pos)
+            if match is None:
+                self._pos = len(buf)
+                return
+
+            pos = match.start()
+            char = buf[pos]
+            self._pos = pos + 1
+
+            if self._capture is not None:
+                self._scanCaptured(char, pos, rooms)
+            else:
+                self._scanStructure(char, pos)
+
+    def _scanCaptured(self, char, pos, rooms):
+        start, depth, path = self._capture
+
+        if char == 0x22:  # "
+            self._inString = True
+        elif char == 0x7b or char == 0x5b:  # { [
+            self._depth += 1
+        elif char == 0x7d or char == 0x5d:  # } ]
+            if self._depth == depth:
+                #the object holding this value just closed, so the value is done
+                self._finishCapture(pos, rooms)
+                self._closeObject()
+            else:
+                self._depth -= 1
+        elif char == 0x2c and self._depth == depth:  # ,
+            self._finishCapture(pos, rooms)
+
+    def _scanStructure(self, char, pos):
+        if char == 0x22:  # " only keys show up here, every value is either walked into or captured
+            self._inString = True
+            self._keyStart = pos + 1
+        elif char == 0x3a:  # :
+            path = (self._paths[-1] if self._paths else ()) + (self._key,)
+            if path in _DESCEND:
+                self._pendingPath = path
+            else:
+                self._capture = (pos + 1, self._depth, path)
+        elif char == 0x7b:  # {
+            self._depth += 1
+            path = self._pendingPath if self._pendingPath is not None else ()
+            self._pendingPath = None
+            self._paths.append(path)
+            self._container(path)
+        elif char == 0x7d:  # }
+            self._closeObject()
+        elif char == 0x2c:  # ,
+            #a value we meant to walk into wasn't an object, ie "rooms": null
+            self._pendingPath = None
+        else:
+            raise ValueError("Unexpected array in sync structure")
+
+    def _closeObject(self):
+        self._depth -= 1
+        self._paths.pop()
+        self._pendingPath = None
+
+    def _container(self, path):
+        target = self.skeleton
+        for key in path:
+            target = target.setdefault(key, dict())
+        return target
+
+    def _finishCapture(self, pos, rooms):
+        start, depth, path = self._capture
+        self._capture = None
+        value = self._loads(bytes(self._buf[start:pos]))
+
+        if len(path) == _JOINED_ROOM_DEPTH and path[:2] == ("rooms", "join"):
+            self.roomCount += 1
+            rooms.append((path[2], value))
+        else:
+            self._container(path[:-1])[path[-1]] = value
+
+    def _compact(self):
+        """Throw away the bytes we are done with"""
+        keep = self._pos
+        if self._capture is not None:
+            keep = min(keep, self._capture[0])
+        if self._keyStart is not None:
+            keep = min(keep, self._keyStart)
+
+        if keep == 0:
+            return
+
+        del self._buf[:keep]
+        self._pos -= keep
+        if self._capture is not None:
+            start, depth, path = self._capture
+            self._capture = (start - keep, depth, path)
+        if self._keyStart is not None:
+            self._keyStart -= keep
+
+
+def decodeSyncStream(chunks, loads=None):
+    """
+        Decode a whole body from an iterable of chunks, mostly useful for testing
+
+        @param chunks iterable of bytes
+        @param loads function OPTIONAL decodes each captured value
+
+        @return (list of (roomID, dict), dict skeleton)
+    """
+    decoder = SyncStreamDecoder(loads)
+    rooms = []
+    for chunk in chunks:
+        rooms.extend(decoder.feed(chunk))
+    return rooms, decoder.close()
@@ -1,11 +1,42 @@
 import pytest
 import sys
+import time
 from pathlib import Path
+from unittest.mock import Mock, AsyncMock
 
 # Add src directory to path for imports
 sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
 
+from halcyon.halcyon import Client
+
+
 # Shared fixtures for all tests
+@pytest.fixture
+def mock_client():
+    """
+    Builds a Client whose restrunner is a Mock, so nothing goes to a homeserver
+
+    mock_client(runner={"sync_async": AsyncMock(...)}, rooms={}, stubRooms=False, **clientKwargs)
+        runner: attributes to set on the mock restrunner
+        rooms: start from a room cache holding these rooms
+        stubRooms: start from an empty room cache, with room fetches returning None
+    """
+    def make(runner=None, rooms=None, stubRooms=False, **kwargs):
+        client = Client(**kwargs)
+        client.restrunner = Mock()
+        client.restrunner.USER_ID = "@bot:matrix.org"
+        client.restrunner.HOMESERVER = "https://matrix.org"
+        for name, value in (runner or {}).items():
+            setattr(client.restrunner, name, value)
+
+        if stubRooms:
+            rooms = {}
+            client._getRoom_async = AsyncMock(return_value=None)
+        if rooms is not None:
+            client.roomCache = {"rooms": rooms, "cache_age": time.time_ns()}
+        return client
+    return make
+
 @pytest.fixture
 def sample_message_event():
     """Sample Matrix message event"""
@@ -0,0 +1,196 @@
+import pytest
+import asyncio
+import threading
+from unittest.mock import AsyncMock
+from halcyon.dispatch import ConcurrentDispatcher
+from halcyon.checkpoint import FileCheckpointStore, SQLiteCheckpointStore, BatchTracker
+from halcyon.room import room
+
+
+class TestCheckpointStores:
+    """Test the built in checkpoint stores"""
+
+    def test_file_store_round_trip(self, tmp_path):
+        """Test the file store keeps tokens per account"""
+        path = str(tmp_path / "state" / "checkpoint.json")
+        store = FileCheckpointStore(path)
+        assert store.load("@bot:matrix.org") is None
+
+        store.save("@bot:matrix.org", "s1")
+        store.save("@other:matrix.org", "s9")
+        store.save("@bot:matrix.org", "s2")
+
+        reopened = FileCheckpointStore(path)
+        assert reopened.load("@bot:matrix.org") == "s2"
+        assert reopened.load("@other:matrix.org") == "s9"
+
+    def test_file_store_corrupt(self, tmp_path):
+        """Test a corrupt file is treated as empty"""
+        path = tmp_path / "checkpoint.json"
+        path.write_text("garbage")
+        assert FileCheckpointStore(str(path)).load("@bot:matrix.org") is None
+
+    def test_sqlite_store_round_trip(self, tmp_path):
+        """Test the sqlite store keeps tokens across connections"""
+        path = str(tmp_path / "checkpoint.db")
+        store = SQLiteCheckpointStore(path)
+        store.save("@bot:matrix.org", "s1")
+        store.save("@bot:matrix.org", "s2")
+        store.close()
+
+        reopened = SQLiteCheckpointStore(path)
+        assert reopened.load("@bot:matrix.org") == "s2"
+        assert reopened.load("@nobody:matrix.org") is None
+        reopened.close()
+
+
+class TestBatchTracker:
+    """Test tokens are only committed after their batch is dispatched"""
+
+    @pytest.mark.asyncio
+    async def test_commit_after_handlers_finish(self):
+        """Test the token waits for every handler in the batch"""
+        store = SQLiteCheckpointStore(":memory:")
+        tracker = BatchTracker(store, "@bot:matrix.org")
+        release = asyncio.Event()
+
+        async def handler():
+            await release.wait()
+
+        batch = tracker.begin("s1")
+        task = asyncio.ensure_future(tracker.track(batch, handler)())
+        tracker.seal(batch)
+        await asyncio.sleep(0)
+        await tracker.flush()
+        assert store.load("@bot:matrix.org") is None
+
+        release.set()
+        await task
+        await tracker.flush()
+        assert store.load("@bot:matrix.org") == "s1"
+
+    @pytest.mark.asyncio
+    async def test_commits_in_order(self):
+        """Test a slow older batch holds back newer ones"""
+        store = SQLiteCheckpointStore(":memory:")
+        tracker = BatchTracker(store, "@bot:matrix.org")
+        release = asyncio.Event()
+
+        async def slow():
+            await release.wait()
+
+        async def fast():
+            pass
+
+        first = tracker.begin("s1")
+        slow_task = asyncio.ensure_future(tracker.track(first, slow)())
+        tracker.seal(first)
+
+        second = tracker.begin("s2")
+        await tracker.track(second, fast)()
+        tracker.seal(second)
+        await tracker.flush()
+        assert store.load("@bot:matrix.org") is None
+
+        release.set()
+        await slow_task
+        await tracker.flush()
+        assert store.load("@bot:matrix.org") == "s2"
+
+    @pytest.mark.asyncio
+    async def test_failed_handler_still_acknowledged(self):
+        """Test a handler that raises still counts as dispatched"""
+        store = SQLiteCheckpointStore(":memory:")
+        tracker = BatchTracker(store, "@bot:matrix.org")
+
+        async def bad():
+            raise RuntimeError("boom")
+
+        batch = tracker.begin("s1")
+        with pytest.raises(RuntimeError):
+            await tracker.track(batch, bad)()
+        tracker.seal(batch)
+
+        await tracker.flush()
+        assert store.load("@bot:matrix.org") == "s1"
+
+    @pytest.mark.asyncio
+    async def test_empty_batch_commits_on_seal(self):
+        """Test a batch with no events commits straight away"""
+        store = SQLiteCheckpointStore(":memory:")
+        tracker = BatchTracker(store, "@bot:matrix.org")
+        tracker.seal(tracker.begin("s1"))
+
+        await tracker.flush()
+        assert store.load("@bot:matrix.org") == "s1"
+
+    @pytest.mark.asyncio
+    async def test_saved_off_the_loop(self):
+        """Test tokens are written on the writer thread, and only the newest one when the disk falls behind"""
+        store = SQLiteCheckpointStore(":memory:")
+        saved = []
+        gate = threading.Event()
+
+        def slowSave(key, token):
+            gate.wait(1)
+            saved.append((token, threading.get_ident()))
+
+        store.save = slowSave
+        tracker = BatchTracker(store, "@bot:matrix.org")
+        for token in ("s1", "s2", "s3"):
+            tracker.seal(tracker.begin(token))
+        assert tracker.committed == "s3"
+
+        gate.set()
+        await tracker.close()
+        assert [token for token, thread in saved] in (["s3"], ["s1", "s3"])
+        assert threading.get_ident() not in [thread for token, thread in saved]
+
+
+class TestClientCheckpoint:
+    """Test the client resumes from and commits checkpoints"""
+
+    def test_resume_from_checkpoint(self, mock_client):
+        """Test a stored token is used for the first sync, which isn't ignored"""
+        store = SQLiteCheckpointStore(":memory:")
+        store.save("@bot:matrix.org", "s41")
+        client = mock_client(stubRooms=True, checkpointStore=store)
+
+        client._loadCheckpoint()
+
+        assert client.sinceToken == "s41"
+        assert client.firstSync is False
+
+    def test_no_checkpoint_keeps_defaults(self, mock_client):
+        """Test nothing changes when there is no stored token"""
+        client = mock_client(stubRooms=True, checkpointStore=SQLiteCheckpointStore(":memory:"))
+        client._loadCheckpoint()
+
+        assert client.sinceToken == ""
+        assert client.firstSync is True
+
+    @pytest.mark.asyncio
+    async def test_sync_commits_after_dispatch(self, mock_client, sample_message_event):
+        """Test the token is committed once the concurrent handlers finish"""
+        store = SQLiteCheckpointStore(":memory:")
+        dispatcher = ConcurrentDispatcher()
+        client = mock_client(rooms={"!room:matrix.org": room(roomID="!room:matrix.org")}, checkpointStore=store, dispatcher=dispatcher, ignoreFirstSync=False)
+        client._loadCheckpoint()
+        client.restrunner.sync_async = AsyncMock(return_value={
+            "next_batch": "s2",
+            "rooms": {"join": {"!room:matrix.org": {"timeline": {"events": [sample_message_event] * 3}}}}
+        })
+        release = asyncio.Event()
+
+        @client.event
+        async def on_message(message):
+            await release.wait()
+
+        await client._homeserverSync()
+        assert client.sinceToken == "s2"
+        assert store.load("@bot:matrix.org") is None
+
+        release.set()
+        await dispatcher.drain()
+        await client.checkpoint.flush()
+        assert store.load("@bot:matrix.org") == "s2"
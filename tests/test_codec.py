@@ -0,0 +1,92 @@
+import pytest
+import json
+from unittest.mock import Mock, AsyncMock, MagicMock, patch
+from halcyon.codec import getCodec, available, StdlibCodec
+from halcyon.halcyon import Client
+from halcyon.restrunner import Runner
+from halcyon.syncstream import decodeSyncStream
+
+
+SAMPLE = {"next_batch": "s1", "rooms": {"join": {"!a:matrix.org": {"body": "ünïcödé \" \\ ✨", "n": [1, 2.5, None, True]}}}}
+
+
+class TestCodecs:
+    """Test the json codecs"""
+
+    @pytest.mark.parametrize("name", available())
+    def test_round_trip(self, name):
+        """Test every installed codec agrees with the stdlib"""
+        codec = getCodec(name)
+        encoded = codec.dumps(SAMPLE)
+        assert isinstance(encoded, bytes)
+        assert json.loads(encoded) == SAMPLE
+        assert codec.loads(encoded) == SAMPLE
+        assert codec.loads(encoded.decode("utf-8")) == SAMPLE
+
+    def test_auto_picks_fastest(self):
+        """Test auto uses the first installed codec, and the stdlib is always there"""
+        assert getCodec("auto").name == available()[0]
+        assert available()[-1] == "json"
+
+    def test_custom_codec(self):
+        """Test a codec object is used as is"""
+        codec = StdlibCodec()
+        assert getCodec(codec) is codec
+
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            getCodec("yaml")
+
+    def test_missing(self):
+        """Test asking for a codec that isn't installed says so"""
+        with patch.dict("sys.modules", {"msgspec": None}):
+            with pytest.raises(ValueError):
+                getCodec("msgspec")
+
+    @pytest.mark.parametrize("name", available())
+    def test_stream_decoder(self, name):
+        """Test the streaming /sync decoder uses the codec for room bodies"""
+        body = json.dumps(SAMPLE).encode("utf-8")
+        rooms, skeleton = decodeSyncStream([body[i:i + 5] for i in range(0, len(body), 5)], getCodec(name).loads)
+        assert rooms == [("!a:matrix.org", SAMPLE["rooms"]["join"]["!a:matrix.org"])]
+        assert skeleton["next_batch"] == "s1"
+
+
+class TestCodecUse:
+    """Test the client and runner use the codec"""
+
+    @pytest.mark.parametrize("name", available())
+    def test_token_round_trip(self, name):
+        client = Client(codec=name)
+        token = {"typ": "engine", "hsvr": "matrix.org", "user": "@bot:matrix.org"}
+        assert client._decodeTokenDict(client._encodeTokenDict(token)) == token
+
+    def test_token_format_unchanged(self):
+        """Test tokens made before codecs still decode"""
+        client = Client(codec="json")
+        token = {"typ": "valid-token", "token": "abc", "device_id": "DEV"}
+        assert client._encodeTokenDict(token) == "eyJ0eXAiOiJ2YWxpZC10b2tlbiIsInRva2VuIjoiYWJjIiwiZGV2aWNlX2lkIjoiREVWIn0="
+        assert Client()._decodeTokenDict(client._encodeTokenDict(token)) == token
+
+    @pytest.mark.asyncio
+    async def test_request_encodes_and_decodes(self):
+        """Test payloads and responses go through the codec"""
+        with patch.object(Runner, "_wellknownLookup", return_value={"m.homeserver": {"base_url": "https://matrix.org"}}):
+            runner = Runner("matrix.org", access_token="token", codec="json")
+        runner.codec = Mock(wraps=runner.codec)
+
+        resp = MagicMock(status=200)
+        resp.read = AsyncMock(return_value=b'{"event_id": "$1"}')
+        resp.__aenter__ = AsyncMock(return_value=resp)
+        resp.__aexit__ = AsyncMock(return_value=False)
+        session = Mock()
+        session.request = Mock(return_value=resp)
+        runner._ensure_session = AsyncMock(return_value=session)
+
+        result = await runner._async_put("rooms/!a/send/m.room.message/1", payload={"body": "hi"})
+
+        assert result == {"event_id": "$1"}
+        kwargs = session.request.call_args.kwargs
+        assert json.loads(kwargs["data"]) == {"body": "hi"}
+        assert kwargs["headers"]["Content-Type"] == "application/json"
+        runner.codec.loads.assert_called_once_with(b'{"event_id": "$1"}')
@@ -0,0 +1,269 @@
+import pytest
+import asyncio
+from unittest.mock import AsyncMock
+from halcyon.room import room
+from halcyon.dispatch import SequentialDispatcher, ConcurrentDispatcher, RoomLaneDispatcher
+
+
+class TestSequentialDispatcher:
+    """Test the default in-order dispatcher"""
+
+    @pytest.mark.asyncio
+    async def test_runs_in_order(self):
+        """Test handlers run one after another"""
+        dispatcher = SequentialDispatcher()
+        seen = []
+
+        async def handler(value):
+            await asyncio.sleep(0)
+            seen.append(value)
+
+        for i in range(5):
+            await dispatcher.submit("!room:matrix.org", handler, i)
+
+        assert seen == [0, 1, 2, 3, 4]
+        assert dispatcher.dispatched == 5
+
+    @pytest.mark.asyncio
+    async def test_errors_propagate(self):
+        """Test handler errors reach the caller"""
+        dispatcher = SequentialDispatcher()
+
+        async def handler():
+            raise RuntimeError("boom")
+
+        with pytest.raises(RuntimeError):
+            await dispatcher.submit(None, handler)
+
+
+class TestConcurrentDispatcher:
+    """Test the bounded concurrent dispatcher"""
+
+    @pytest.mark.asyncio
+    async def test_concurrency_is_bounded(self):
+        """Test no more than maxConcurrency handlers run at once"""
+        dispatcher = ConcurrentDispatcher(maxConcurrency=3)
+        running = 0
+        peak = 0
+
+        async def handler():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        for _ in range(20):
+            await dispatcher.submit("!room:matrix.org", handler)
+        await dispatcher.drain()
+
+        assert peak == 3
+        assert dispatcher.dispatched == 20
+        assert dispatcher.inFlight == 0
+
+    @pytest.mark.asyncio
+    async def test_slow_handler_does_not_block(self):
+        """Test a slow handler doesn't hold up the rest"""
+        dispatcher = ConcurrentDispatcher(maxConcurrency=4)
+        release = asyncio.Event()
+        done = []
+
+        async def slow():
+            await release.wait()
+            done.append("slow")
+
+        async def fast(i):
+            done.append(i)
+
+        await dispatcher.submit("!a:matrix.org", slow)
+        for i in range(3):
+            await dispatcher.submit("!b:matrix.org", fast, i)
+        await asyncio.sleep(0)
+
+        assert done == [0, 1, 2]
+        release.set()
+        await dispatcher.drain()
+        assert done[-1] == "slow"
+
+    @pytest.mark.asyncio
+    async def test_log_policy_isolates_errors(self):
+        """Test a failing handler doesn't affect the others"""
+        dispatcher = ConcurrentDispatcher(maxConcurrency=2)
+        done = []
+
+        async def bad():
+            raise RuntimeError("boom")
+
+        async def good():
+            done.append(True)
+
+        await dispatcher.submit(None, bad)
+        await dispatcher.submit(None, good)
+        await dispatcher.drain()
+
+        assert done == [True]
+        assert dispatcher.failed == 1
+
+    @pytest.mark.asyncio
+    async def test_raise_policy(self):
+        """Test the raise policy surfaces the first error on drain"""
+        dispatcher = ConcurrentDispatcher(maxConcurrency=2, errorPolicy="raise")
+
+        async def bad():
+            raise RuntimeError("boom")
+
+        await dispatcher.submit(None, bad)
+        with pytest.raises(RuntimeError):
+            await dispatcher.drain()
+
+    @pytest.mark.asyncio
+    async def test_callable_policy(self):
+        """Test a callable error policy gets the exception"""
+        errors = []
+        dispatcher = ConcurrentDispatcher(errorPolicy=lambda e, handler, args: errors.append((e, args)))
+
+        async def bad(value):
+            raise ValueError(value)
+
+        await dispatcher.submit(None, bad, "x")
+        await dispatcher.drain()
+
+        assert len(errors) == 1
+        assert isinstance(errors[0][0], ValueError)
+        assert errors[0][1] == ("x",)
+
+    def test_invalid_settings(self):
+        """Test bad settings are rejected"""
+        with pytest.raises(ValueError):
+            ConcurrentDispatcher(maxConcurrency=0)
+        with pytest.raises(ValueError):
+            ConcurrentDispatcher(errorPolicy="ignore")
+
+
+class TestClientDispatch:
+    """Test the client routes sync events through its dispatcher"""
+
+    @pytest.mark.asyncio
+    async def test_sync_uses_dispatcher(self, mock_client, sample_message_event):
+        """Test timeline messages are submitted to the dispatcher"""
+        dispatcher = ConcurrentDispatcher(maxConcurrency=8)
+        client = mock_client(rooms={"!room:matrix.org": room(roomID="!room:matrix.org")}, ignoreFirstSync=False, dispatcher=dispatcher)
+        client.restrunner.sync_async = AsyncMock(return_value={
+            "next_batch": "s2",
+            "rooms": {"join": {"!room:matrix.org": {"timeline": {"events": [sample_message_event] * 5}}}}
+        })
+
+        seen = []
+
+        @client.event
+        async def on_message(message):
+            seen.append(message.content.body)
+
+        await client._homeserverSync()
+        await dispatcher.drain()
+
+        assert seen == ["Hello world"] * 5
+        assert dispatcher.dispatched == 5
+        assert client.sinceToken == "s2"
+
+
+class TestRoomLaneDispatcher:
+    """Test the per-room ordered dispatcher"""
+
+    @pytest.mark.asyncio
+    async def test_order_kept_inside_room(self):
+        """Test events in one room run in submit order"""
+        dispatcher = RoomLaneDispatcher(maxConcurrency=8)
+        seen = {"!a:matrix.org": [], "!b:matrix.org": []}
+
+        async def handler(roomID, value):
+            #later events finish faster, so only the lane keeps them in order
+            await asyncio.sleep(0.001 * (10 - value))
+            seen[roomID].append(value)
+
+        for i in range(10):
+            await dispatcher.submit("!a:matrix.org", handler, "!a:matrix.org", i)
+            await dispatcher.submit("!b:matrix.org", handler, "!b:matrix.org", i)
+        await dispatcher.drain()
+
+        assert seen["!a:matrix.org"] == list(range(10))
+        assert seen["!b:matrix.org"] == list(range(10))
+
+    @pytest.mark.asyncio
+    async def test_rooms_run_in_parallel(self):
+        """Test a stuck room doesn't starve another room"""
+        dispatcher = RoomLaneDispatcher(maxConcurrency=4)
+        release = asyncio.Event()
+        done = []
+
+        async def stuck():
+            await release.wait()
+            done.append("stuck")
+
+        async def quick(i):
+            done.append(i)
+
+        await dispatcher.submit("!busy:matrix.org", stuck)
+        for i in range(3):
+            await dispatcher.submit("!quiet:matrix.org", quick, i)
+        await asyncio.sleep(0.01)
+
+        assert done == [0, 1, 2]
+        release.set()
+        await dispatcher.drain()
+        assert done[-1] == "stuck"
+
+    @pytest.mark.asyncio
+    async def test_idle_lanes_are_collected(self):
+        """Test lanes go away once their room is idle"""
+        dispatcher = RoomLaneDispatcher()
+
+        async def handler():
+            pass
+
+        for i in range(50):
+            await dispatcher.submit("!room" + str(i) + ":matrix.org", handler)
+        assert dispatcher.laneCount > 0
+
+        await dispatcher.drain()
+        assert dispatcher.laneCount == 0
+        assert dispatcher.dispatched == 50
+
+    @pytest.mark.asyncio
+    async def test_backlog_applies_backpressure(self):
+        """Test submit waits once a lane's backlog is full"""
+        dispatcher = RoomLaneDispatcher(maxBacklog=2)
+        release = asyncio.Event()
+
+        async def handler():
+            await release.wait()
+
+        for _ in range(3):
+            await dispatcher.submit("!room:matrix.org", handler)
+
+        blocked = asyncio.ensure_future(dispatcher.submit("!room:matrix.org", handler))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+
+        release.set()
+        await blocked
+        await dispatcher.drain()
+        assert dispatcher.dispatched == 4
+
+    @pytest.mark.asyncio
+    async def test_error_does_not_stop_lane(self):
+        """Test a failing handler doesn't block the rest of its lane"""
+        dispatcher = RoomLaneDispatcher()
+        seen = []
+
+        async def handler(value):
+            if value == 1:
+                raise RuntimeError("boom")
+            seen.append(value)
+
+        for i in range(3):
+            await dispatcher.submit("!room:matrix.org", handler, i)
+        await dispatcher.drain()
+
+        assert seen == [0, 2]
+        assert dispatcher.failed == 1
@@ -0,0 +1,178 @@
+import pytest
+import json
+from unittest.mock import Mock, AsyncMock
+from halcyon.halcyon import Client
+from halcyon.filters import SyncFilter, FilterCache, filterHash, ROOM_STATE_TYPES
+
+
+class TestSyncFilter:
+    """Test building filter definitions"""
+
+    def test_default_filter_keeps_everything(self):
+        """Test an empty filter doesn't restrict any types"""
+        definition = SyncFilter().toDict()
+
+        assert "types" not in definition["room"]["timeline"]
+        assert "presence" not in definition
+        assert "ephemeral" not in definition["room"]
+
+    def test_disabled_sections(self):
+        """Test turning off sections drops every type in them"""
+        definition = SyncFilter(presence=False, accountData=False, ephemeral=False).toDict()
+
+        assert definition["presence"] == {"not_types": ["*"]}
+        assert definition["account_data"] == {"not_types": ["*"]}
+        assert definition["room"]["account_data"] == {"not_types": ["*"]}
+        assert definition["room"]["ephemeral"] == {"not_types": ["*"]}
+
+    def test_timeline_and_state(self):
+        """Test timeline and state settings"""
+        definition = SyncFilter(timelineTypes=["m.room.message"], timelineLimit=20,
+                                stateTypes=["m.room.name"], lazyLoadMembers=True).toDict()
+
+        assert definition["room"]["timeline"] == {"types": ["m.room.message"], "limit": 20}
+        assert definition["room"]["state"] == {"types": ["m.room.name"], "lazy_load_members": True}
+
+    def test_from_handlers(self):
+        """Test deriving a filter from the registered handlers"""
+        definition = SyncFilter.fromHandlers({"on_message", "on_ready"}).toDict()
+
+        assert "m.room.message" in definition["room"]["timeline"]["types"]
+        assert "m.room.member" in definition["room"]["timeline"]["types"]
+        assert definition["room"]["state"]["types"] == ROOM_STATE_TYPES
+        assert definition["room"]["include_leave"] is False
+        assert definition["presence"] == {"not_types": ["*"]}
+
+    def test_from_handlers_without_state(self):
+        """Test a handler derived filter can skip state"""
+        definition = SyncFilter.fromHandlers({"on_message", "on_room_leave"}, includeState=False).toDict()
+
+        assert definition["room"]["timeline"]["types"] == ["m.room.message"]
+        assert definition["room"]["state"]["types"] == []
+        assert definition["room"]["include_leave"] is True
+
+    def test_hash_is_stable(self):
+        """Test equal filters hash the same, and the user is part of the key"""
+        first = SyncFilter(timelineTypes=["m.room.message"])
+        second = SyncFilter(timelineTypes=["m.room.message"])
+
+        assert first.filterHash("@a:matrix.org") == second.filterHash("@a:matrix.org")
+        assert first.filterHash("@a:matrix.org") != first.filterHash("@b:matrix.org")
+        assert filterHash({"b": 1, "a": 2}) == filterHash({"a": 2, "b": 1})
+
+
+class TestFilterCache:
+    """Test the on disk filter ID cache"""
+
+    def test_round_trip(self, tmp_path):
+        """Test IDs survive a reload"""
+        path = str(tmp_path / "nested" / "filters.json")
+        cache = FilterCache(path)
+        cache.set("key", "filter123")
+
+        assert FilterCache(path).get("key") == "filter123"
+
+    def test_missing_and_corrupt(self, tmp_path):
+        """Test unreadable cache files are treated as empty"""
+        path = tmp_path / "filters.json"
+        assert FilterCache(str(path)).get("key") is None
+
+        path.write_text("{not json")
+        assert FilterCache(str(path)).get("key") is None
+
+    def test_forget(self, tmp_path):
+        """Test forgetting a filter ID"""
+        path = str(tmp_path / "filters.json")
+        cache = FilterCache(path)
+        cache.set("key", "filter123")
+        cache.forget("key")
+
+        assert FilterCache(path).get("key") is None
+
+
+def _registersFilters():
+    """Restrunner methods for a homeserver that hands out filter ID f1"""
+    return {"createFilter_async": AsyncMock(return_value={"filter_id": "f1"})}
+
+
+class TestClientSyncFilter:
+    """Test the client registers and uses filters"""
+
+    @pytest.mark.asyncio
+    async def test_no_filter_by_default(self, mock_client, tmp_path):
+        """Test nothing is registered without a filter"""
+        client = mock_client(runner=_registersFilters(), filterCachePath=str(tmp_path / "filters.json"))
+        await client._resolveSyncFilter()
+
+        assert client.syncFilterID is None
+        client.restrunner.createFilter_async.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_auto_filter_registered_and_cached(self, mock_client, tmp_path):
+        """Test the auto filter is registered once, then loaded from the cache"""
+        client = mock_client(runner=_registersFilters(), syncFilter="auto", filterCachePath=str(tmp_path / "filters.json"))
+
+        @client.event
+        async def on_message(message):
+            pass
+
+        await client._resolveSyncFilter()
+        assert client.syncFilterID == "f1"
+        definition = client.restrunner.createFilter_async.call_args[0][0]
+        assert "m.room.message" in definition["room"]["timeline"]["types"]
+
+        second = mock_client(runner=_registersFilters(), syncFilter="auto", filterCachePath=str(tmp_path / "filters.json"))
+        second.event(on_message)
+        await second._resolveSyncFilter()
+
+        assert second.syncFilterID == "f1"
+        second.restrunner.createFilter_async.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_registration_failure_syncs_everything(self, mock_client, tmp_path):
+        """Test a failed registration falls back to no filter"""
+        client = mock_client(runner=_registersFilters(), syncFilter=SyncFilter(presence=False), filterCachePath=str(tmp_path / "filters.json"))
+        client.restrunner.createFilter_async = AsyncMock(return_value={"errcode": "M_UNKNOWN"})
+
+        await client._resolveSyncFilter()
+        assert client.syncFilterID is None
+
+    @pytest.mark.asyncio
+    async def test_sync_passes_filter_id(self, mock_client, tmp_path):
+        """Test the filter ID is sent with every sync"""
+        client = mock_client(runner=_registersFilters(), filterCachePath=str(tmp_path / "filters.json"))
+        client.syncFilterID = "f1"
+        client.restrunner.sync_async = AsyncMock(return_value={"next_batch": "s1"})
+
+        await client._fetchSync()
+        assert client.restrunner.sync_async.call_args[1]["serverSideFilter"] == "f1"
+
+    def test_auto_filter_sees_overridden_handlers(self, tmp_path):
+        """Test handlers a Client subclass overrides get their events too"""
+        class Bot(Client):
+            async def on_message(self, message):
+                pass
+
+        client = Bot(syncFilter="auto", filterCachePath=str(tmp_path / "filters.json"))
+        definition = client._buildSyncFilter()
+        assert "m.room.message" in definition["room"]["timeline"]["types"]
+        assert "m.room.message" not in Client(syncFilter="auto")._buildSyncFilter()["room"]["timeline"]["types"]
+
+    @pytest.mark.asyncio
+    async def test_rejected_filter_registered_again(self, mock_client, tmp_path):
+        """Test a filter ID the homeserver no longer knows is forgotten and uploaded again"""
+        import aiohttp
+        client = mock_client(runner=_registersFilters(), syncFilter="auto", filterCachePath=str(tmp_path / "filters.json"))
+        await client._resolveSyncFilter()
+        client.filterCache.set(client._syncFilterKey, "f_old")
+        client.syncFilterID = "f_old"
+        client.restrunner.createFilter_async = AsyncMock(return_value={"filter_id": "f_new"})
+        client.restrunner.sync_async = AsyncMock(side_effect=aiohttp.ClientResponseError(Mock(), (), status=404))
+
+        assert await client._fetchSync() is None
+        assert client.syncFilterID == "f_new"
+        assert client.filterCache.get(client._syncFilterKey) == "f_new"
+
+        client.restrunner.sync_async = AsyncMock(side_effect=aiohttp.ClientResponseError(Mock(), (), status=500))
+        with pytest.raises(aiohttp.ClientResponseError):
+            await client._fetchSync()
@@ -1,10 +1,14 @@
 import pytest
+import asyncio
 import json
 import base64
-from unittest.mock import Mock, patch, MagicMock
+import time
+from collections.abc import MutableMapping
+from unittest.mock import Mock, AsyncMock, patch, MagicMock
 from halcyon.halcyon import Client
-from halcyon.message import message
-from halcyon.room import room
+from halcyon.checkpoint import SQLiteCheckpointStore
+from halcyon.message import message, LazyMessage
+from halcyon.room import room, LazyRoom
 
 
 class TestClient:
@@ -94,7 +98,7 @@ class TestRoomCache:
         
         assert "cache_age" in client.roomCache
         assert "rooms" in client.roomCache
-        assert isinstance(client.roomCache["rooms"], dict)
+        assert isinstance(client.roomCache["rooms"], MutableMapping)
         
         # Should have called getRoomState for each room
         assert client.restrunner.getRoomState.call_count == 2
@@ -169,6 +173,304 @@ class TestRoomCache:
             assert retrieved_room.id is None
 
 
+def _roomsRunner(getRoomState, rooms):
+    """Restrunner methods for an account joined to rooms"""
+    return {"joinedRooms_async": AsyncMock(return_value=rooms), "getRoomState_async": getRoomState}
+
+
+class TestAsyncRoomCache:
+    """Test the room cache only uses the async runner endpoints"""
+    
+    @pytest.mark.asyncio
+    async def test_get_room_async_fetches_and_caches(self, mock_client):
+        """Test a cache miss is fetched with getRoomState_async"""
+        client = mock_client(rooms={}, runner={"getRoomState_async": AsyncMock(return_value=[
+            {"type": "m.room.name", "content": {"name": "Async room"}}
+        ])})
+        
+        retrieved_room = await client._getRoom_async("!test:matrix.org")
+        
+        assert retrieved_room.name == "Async room"
+        assert client.roomCache["rooms"]["!test:matrix.org"] is retrieved_room
+        client.restrunner.getRoomState.assert_not_called()
+        
+    @pytest.mark.asyncio
+    async def test_get_room_async_failure(self, mock_client):
+        """Test a failed fetch returns an empty room"""
+        client = mock_client(rooms={}, runner={"getRoomState_async": AsyncMock(side_effect=RuntimeError("down"))})
+        
+        retrieved_room = await client._getRoom_async("!test:matrix.org")
+        
+        assert retrieved_room.id is None
+        assert "!test:matrix.org" not in client.roomCache["rooms"]
+        
+    @pytest.mark.asyncio
+    async def test_empty_room_uses_client_room_class(self, mock_client):
+        """Test the empty room handed back on a failed or backed off fetch is the kind the client builds"""
+        client = mock_client(rooms={}, runner={"getRoomState_async": AsyncMock(side_effect=RuntimeError("down"))}, lazyRooms=True)
+
+        failed = await client._getRoom_async("!test:matrix.org")
+        backedOff = await client._getRoom_async("!test:matrix.org")
+
+        assert type(failed) is client._roomClass
+        assert type(backedOff) is client._roomClass
+        assert isinstance(failed, LazyRoom)
+        assert client.restrunner.getRoomState_async.await_count == 1
+
+    @pytest.mark.asyncio
+    async def test_roomcacheinit_async(self, mock_client):
+        """Test the async cache build uses the async endpoints"""
+        client = mock_client(runner=_roomsRunner(AsyncMock(return_value=[]), ["!room1:matrix.org", "!room2:matrix.org"]))
+        
+        await client._roomcacheinit_async()
+        
+        assert set(client.roomCache["rooms"]) == {"!room1:matrix.org", "!room2:matrix.org"}
+        client.restrunner.joinedRooms.assert_not_called()
+        client.restrunner.getRoomState.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_lazy_rooms(self, mock_client, sample_room_create_events):
+        """Test lazyRooms caches LazyRoom objects"""
+        client = mock_client(runner=_roomsRunner(AsyncMock(return_value=sample_room_create_events), ["!room1:matrix.org"]), lazyRooms=True)
+
+        await client._roomcacheinit_async()
+
+        cachedRoom = client.roomCache["rooms"]["!room1:matrix.org"]
+        assert isinstance(cachedRoom, LazyRoom)
+        assert cachedRoom.name == "Test Room"
+
+
+class TestRoomCacheWarmup:
+    """Test the parallel room cache warm up"""
+
+    @pytest.mark.asyncio
+    async def test_bounded_parallelism(self, mock_client):
+        """Test at most roomCacheConcurrency fetches run at once, and they do overlap"""
+        running = []
+        peak = []
+
+        async def getRoomState(roomID):
+            running.append(roomID)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(roomID)
+            return []
+
+        rooms = ["!room" + str(n) + ":matrix.org" for n in range(20)]
+        client = mock_client(runner=_roomsRunner(getRoomState, rooms), roomCacheConcurrency=4)
+
+        await client._roomcacheinit_async()
+
+        assert max(peak) == 4
+        assert set(client.roomCache["rooms"]) == set(rooms)
+
+    @pytest.mark.asyncio
+    async def test_failures_and_timeouts_isolated(self, mock_client):
+        """Test a broken or slow room is skipped without holding up the rest"""
+        async def getRoomState(roomID):
+            if roomID == "!broken:matrix.org":
+                raise RuntimeError("down")
+            if roomID == "!slow:matrix.org":
+                await asyncio.sleep(10)
+            return []
+
+        rooms = ["!ok:matrix.org", "!broken:matrix.org", "!slow:matrix.org", "!fine:matrix.org"]
+        client = mock_client(runner=_roomsRunner(getRoomState, rooms), roomCacheTimeout=0.05)
+        reports = []
+
+        @client.event
+        async def on_room_cache_progress(loaded, failed, total):
+            reports.append((loaded, failed, total))
+
+        start = time.monotonic()
+        await client._roomcacheinit_async()
+
+        assert time.monotonic() - start < 1
+        assert set(client.roomCache["rooms"]) == {"!ok:matrix.org", "!fine:matrix.org"}
+        assert len(reports) == 4
+        assert reports[-1] == (2, 2, 4)
+
+    @pytest.mark.asyncio
+    async def test_no_rooms(self, mock_client):
+        """Test an account with no rooms warms instantly"""
+        client = mock_client(runner=_roomsRunner(AsyncMock(return_value=[]), []))
+        await client._roomcacheinit_async()
+        assert client.roomCache["rooms"] == {}
+
+
+def _stateSync():
+    def name(roomID, value):
+        return {"type": "m.room.name", "state_key": "", "sender": "@a:matrix.org", "event_id": "$" + value,
+                "room_id": roomID, "origin_server_ts": 1, "content": {"name": value}}
+
+    return {
+        "next_batch": "s_state",
+        "rooms": {"join": {
+            "!a:matrix.org": {"state": {"events": [name("!a:matrix.org", "Old A")]},
+                              "timeline": {"events": [name("!a:matrix.org", "Room A")]}},
+            "!b:matrix.org": {"state": {"events": [name("!b:matrix.org", "Room B")]}},
+        }},
+    }
+
+
+class TestRoomCacheFromSync:
+    """Test building the room cache from one state only sync"""
+
+    @pytest.mark.asyncio
+    async def test_builds_rooms_from_sync(self, mock_client):
+        """Test rooms come from the sync, with timeline state applied on top, and no per room requests"""
+        client = mock_client(runner={"sync_async": AsyncMock(return_value=_stateSync())}, roomCacheMode="sync")
+
+        await client._roomcacheinit_async()
+
+        assert client.roomCache["rooms"]["!a:matrix.org"].name == "Room A"
+        assert client.roomCache["rooms"]["!b:matrix.org"].name == "Room B"
+        client.restrunner.getRoomState_async.assert_not_called()
+        client.restrunner.joinedRooms_async.assert_not_called()
+
+        filterParam = json.loads(client.restrunner.sync_async.call_args.kwargs["serverSideFilter"])
+        assert filterParam["room"]["timeline"]["limit"] == 0
+        assert "m.room.member" in filterParam["room"]["state"]["types"]
+        assert filterParam["presence"] == {"not_types": ["*"]}
+
+    @pytest.mark.asyncio
+    async def test_carries_on_from_state_sync(self, mock_client):
+        """Test the main loop resumes from the state sync instead of doing a second initial sync"""
+        client = mock_client(runner={"sync_async": AsyncMock(return_value=_stateSync())}, roomCacheMode="sync")
+        await client._roomcacheinit_async()
+        assert client.sinceToken == "s_state"
+        assert client.firstSync is False
+
+    @pytest.mark.asyncio
+    async def test_keeps_backlog_when_not_ignoring_first_sync(self, mock_client):
+        """Test the backlog still gets dispatched when ignoreFirstSync is off"""
+        client = mock_client(runner={"sync_async": AsyncMock(return_value=_stateSync())}, roomCacheMode="sync", ignoreFirstSync=False)
+        await client._roomcacheinit_async()
+        assert client.sinceToken == ""
+        assert client.firstSync is True
+
+    @pytest.mark.asyncio
+    async def test_streamed(self, mock_client):
+        """Test the state sync is streamed when streamSync is on"""
+        client = mock_client(runner={"sync_async": AsyncMock(return_value=_stateSync())}, roomCacheMode="sync", streamSync=True)
+        resp = _stateSync()
+
+        async def stream(**kwargs):
+            for roomID, joinedRoom in resp["rooms"]["join"].items():
+                yield ("join", roomID, joinedRoom)
+            yield ("sync", None, {"next_batch": resp["next_batch"], "rooms": {"join": {}}})
+
+        client.restrunner.sync_stream_async = stream
+        await client._roomcacheinit_async()
+
+        assert set(client.roomCache["rooms"]) == {"!a:matrix.org", "!b:matrix.org"}
+        assert client.sinceToken == "s_state"
+        client.restrunner.sync_async.assert_not_called()
+
+    def test_bad_mode(self):
+        with pytest.raises(ValueError):
+            Client(roomCacheMode="psychic")
+
+
+class TestLazyRoomCache:
+    """Test the lazy, activity ordered room cache"""
+
+    @pytest.mark.asyncio
+    async def test_starts_empty_and_warms_busiest_first(self, mock_client):
+        """Test startup doesn't wait for any room, and the background warm up goes by activity"""
+        fetched = []
+
+        async def getRoomState(roomID):
+            fetched.append(roomID)
+            return []
+
+        rooms = ["!quiet:matrix.org", "!busy:matrix.org", "!medium:matrix.org"]
+        client = mock_client(runner=_roomsRunner(getRoomState, rooms), roomCacheMode="lazy")
+
+        await client._roomcacheinit_async()
+        assert client.roomCache["rooms"] == {}
+        assert fetched == []
+
+        client._noteRoomActivity("!busy:matrix.org", 50)
+        client._noteRoomActivity("!medium:matrix.org", 5)
+        await client._warmTask
+
+        assert fetched == ["!busy:matrix.org", "!medium:matrix.org", "!quiet:matrix.org"]
+        assert set(client.roomCache["rooms"]) == set(rooms)
+
+    @pytest.mark.asyncio
+    async def test_skips_rooms_fetched_on_first_use(self, mock_client):
+        """Test the warm up doesn't fetch a room again once it has been used"""
+        getRoomState = AsyncMock(return_value=[])
+        client = mock_client(runner=_roomsRunner(getRoomState, ["!a:matrix.org", "!b:matrix.org"]), roomCacheMode="lazy")
+
+        await client._roomcacheinit_async()
+        await client._getRoom_async("!a:matrix.org")
+        await client._warmTask
+
+        assert [call.args[0] for call in getRoomState.call_args_list] == ["!a:matrix.org", "!b:matrix.org"]
+
+    @pytest.mark.asyncio
+    async def test_uncached_room_does_not_block_dispatch(self, mock_client, sample_message_event):
+        """Test the sync loop doesn't wait on an uncached room's fetch, even with the default sequential dispatcher"""
+        release = asyncio.Event()
+
+        async def getRoomState(roomID):
+            await release.wait()
+            return []
+
+        client = mock_client(runner=_roomsRunner(getRoomState, []), rooms={}, roomCacheMode="lazy")
+        received = []
+
+        @client.event
+        async def on_message(message):
+            received.append(message)
+
+        roomID = "!lazy:matrix.org"
+        joinedRoom = {"timeline": {"events": [sample_message_event]}}
+        await asyncio.wait_for(client._dispatchJoinedRoom(roomID, joinedRoom, None), 0.5)
+        await asyncio.wait_for(client._dispatchJoinedRoom(roomID, joinedRoom, None), 0.5)
+        assert received == []
+
+        release.set()
+        await asyncio.wait(list(client._roomWaits))
+        assert len(received) == 2
+        assert received[0].room.id == roomID
+        assert client._roomActivity[roomID] == 2
+        assert client._awaitingRoom == {}
+
+    @pytest.mark.asyncio
+    async def test_uncached_room_holds_checkpoint(self, mock_client, sample_message_event):
+        """Test a batch isn't committed while a message in it waits on its room, and later messages go out after it"""
+        release = asyncio.Event()
+
+        async def getRoomState(roomID):
+            await release.wait()
+            return []
+
+        client = mock_client(runner=_roomsRunner(getRoomState, []), rooms={}, ignoreFirstSync=False,
+                             checkpointStore=SQLiteCheckpointStore(":memory:"))
+        received = []
+
+        @client.event
+        async def on_message(message):
+            received.append(message.event.id)
+
+        roomID = "!lazy:matrix.org"
+        client.restrunner.sync_async = AsyncMock(return_value={"next_batch": "s1", "rooms": {"join": {roomID: {"timeline": {"events": [sample_message_event]}}}}})
+        await client._homeserverSync()
+        assert client.checkpoint.committed is None
+
+        release.set()
+        await asyncio.wait(list(client._roomWaits))
+        assert client.checkpoint.committed == "s1"
+
+        #the room is in now, so the next message skips the queue
+        later = dict(sample_message_event, event_id="$later:matrix.org")
+        await client._dispatchJoinedRoom(roomID, {"timeline": {"events": [later]}}, None)
+        assert received == [sample_message_event["event_id"], "$later:matrix.org"]
+
+
 class TestEventStubs:
     """Test event handler stubs"""
     
@@ -235,12 +537,12 @@ class TestMessageSending:
         """Test basic message sending"""
         client = Client()
         client.restrunner = Mock()
-        client.restrunner.sendEvent.return_value = {"event_id": "$sent:matrix.org"}
+        client.restrunner.sendEvent_async = AsyncMock(return_value={"event_id": "$sent:matrix.org"})
         
         result = await client.send_message("!room:matrix.org", "Hello world")
         
-        client.restrunner.sendEvent.assert_called_once()
-        call_args = client.restrunner.sendEvent.call_args
+        client.restrunner.sendEvent_async.assert_called_once()
+        call_args = client.restrunner.sendEvent_async.call_args
         
         assert call_args[1]["roomID"] == "!room:matrix.org"
         assert call_args[1]["eventType"] == "m.room.message"
@@ -252,11 +554,11 @@ class TestMessageSending:
         """Test sending notice message"""
         client = Client()
         client.restrunner = Mock()
-        client.restrunner.sendEvent.return_value = {"event_id": "$sent:matrix.org"}
+        client.restrunner.sendEvent_async = AsyncMock(return_value={"event_id": "$sent:matrix.org"})
         
         await client.send_message("!room:matrix.org", "Notice", isNotice=True)
         
-        call_args = client.restrunner.sendEvent.call_args
+        call_args = client.restrunner.sendEvent_async.call_args
         assert call_args[1]["eventPayload"]["msgtype"] == "m.notice"
         
     @pytest.mark.asyncio
@@ -264,11 +566,11 @@ class TestMessageSending:
         """Test sending markdown message"""
         client = Client()
         client.restrunner = Mock()
-        client.restrunner.sendEvent.return_value = {"event_id": "$sent:matrix.org"}
+        client.restrunner.sendEvent_async = AsyncMock(return_value={"event_id": "$sent:matrix.org"})
         
         await client.send_message("!room:matrix.org", "**Bold text**", textFormat="markdown")
         
-        call_args = client.restrunner.sendEvent.call_args
+        call_args = client.restrunner.sendEvent_async.call_args
         payload = call_args[1]["eventPayload"]
         
         assert payload["format"] == "org.matrix.custom.html"
@@ -280,12 +582,12 @@ class TestMessageSending:
         """Test sending HTML message"""
         client = Client()
         client.restrunner = Mock()
-        client.restrunner.sendEvent.return_value = {"event_id": "$sent:matrix.org"}
+        client.restrunner.sendEvent_async = AsyncMock(return_value={"event_id": "$sent:matrix.org"})
         
         html_content = "<p><strong>Bold text</strong></p>"
         await client.send_message("!room:matrix.org", html_content, textFormat="html")
         
-        call_args = client.restrunner.sendEvent.call_args
+        call_args = client.restrunner.sendEvent_async.call_args
         payload = call_args[1]["eventPayload"]
         
         assert payload["format"] == "org.matrix.custom.html"
@@ -298,11 +600,11 @@ class TestMessageSending:
         """Test sending reply message"""
         client = Client()
         client.restrunner = Mock()
-        client.restrunner.sendEvent.return_value = {"event_id": "$sent:matrix.org"}
+        client.restrunner.sendEvent_async = AsyncMock(return_value={"event_id": "$sent:matrix.org"})
         
         await client.send_message("!room:matrix.org", "Reply text", replyTo="$original:matrix.org")
         
-        call_args = client.restrunner.sendEvent.call_args
+        call_args = client.restrunner.sendEvent_async.call_args
         payload = call_args[1]["eventPayload"]
         
         assert "m.relates_to" in payload
@@ -317,20 +619,22 @@ class TestTyping:
         """Test sending typing indicator"""
         client = Client()
         client.restrunner = Mock()
+        client.restrunner.sendTyping_async = AsyncMock(return_value={})
         
         await client.send_typing("!room:matrix.org", 30)
         
-        client.restrunner.sendTyping.assert_called_once_with("!room:matrix.org", 30)
+        client.restrunner.sendTyping_async.assert_called_once_with("!room:matrix.org", 30)
         
     @pytest.mark.asyncio
     async def test_send_typing_default(self):
         """Test sending typing with default duration"""
         client = Client()
         client.restrunner = Mock()
+        client.restrunner.sendTyping_async = AsyncMock(return_value={})
         
         await client.send_typing("!room:matrix.org")
         
-        client.restrunner.sendTyping.assert_called_once_with("!room:matrix.org", None)
+        client.restrunner.sendTyping_async.assert_called_once_with("!room:matrix.org", None)
 
 
 class TestRoomOperations:
@@ -341,13 +645,13 @@ class TestRoomOperations:
         """Test joining a room"""
         client = Client()
         client.restrunner = Mock()
-        client.restrunner.joinRoom.return_value = {"room_id": "!room:matrix.org"}
+        client.restrunner.joinRoom_async = AsyncMock(return_value={"room_id": "!room:matrix.org"})
         client.roomCache = {"rooms": {}}
         
-        with patch.object(client, '_addRoomToCache') as mock_add:
+        with patch.object(client, '_addRoomToCache_async', new_callable=AsyncMock) as mock_add:
             result = await client.join_room("!room:matrix.org")
             
-            client.restrunner.joinRoom.assert_called_once_with("!room:matrix.org")
+            client.restrunner.joinRoom_async.assert_called_once_with("!room:matrix.org")
             mock_add.assert_called_once_with("!room:matrix.org")
 
 
@@ -359,11 +663,11 @@ class TestPresence:
         """Test changing presence"""
         client = Client()
         client.restrunner = Mock()
-        client.restrunner.setUserPresence.return_value = {}
+        client.restrunner.setUserPresence_async = AsyncMock(return_value={})
         
         await client.change_presence(presence="online", statusMessage="Working on code")
         
-        client.restrunner.setUserPresence.assert_called_once_with(
+        client.restrunner.setUserPresence_async.assert_called_once_with(
             presence="online", 
             statusMessage="Working on code"
         )
@@ -373,10 +677,10 @@ class TestPresence:
         """Test presence change with error"""
         client = Client()
         client.restrunner = Mock()
-        client.restrunner.setUserPresence.return_value = {
+        client.restrunner.setUserPresence_async = AsyncMock(return_value={
             "errcode": "M_FORBIDDEN",
             "error": "Not allowed"
-        }
+        })
         
         with patch('logging.error') as mock_log:
             await client.change_presence(presence="away")
@@ -391,11 +695,11 @@ class TestMediaOperations:
         """Test downloading media"""
         client = Client()
         client.restrunner = Mock()
-        client.restrunner.getMediaFromMXC.return_value = b"fake_image_data"
+        client.restrunner.getMediaFromMXC_async = AsyncMock(return_value=b"fake_image_data")
         
         result = await client.download_media("mxc://matrix.org/abc123")
         
-        client.restrunner.getMediaFromMXC.assert_called_once_with("mxc://matrix.org/abc123")
+        client.restrunner.getMediaFromMXC_async.assert_called_once_with("mxc://matrix.org/abc123")
         assert result == b"fake_image_data"
         
     @pytest.mark.asyncio
@@ -403,14 +707,14 @@ class TestMediaOperations:
         """Test uploading media"""
         client = Client()
         client.restrunner = Mock()
-        client.restrunner.uploadMedia.return_value = {"content_uri": "mxc://matrix.org/uploaded123"}
+        client.restrunner.uploadMedia_async = AsyncMock(return_value={"content_uri": "mxc://matrix.org/uploaded123"})
         
         import io
         fake_buffer = io.BytesIO(b"fake_file_data")
         
         result = await client.upload_media(fake_buffer, "test.txt")
         
-        client.restrunner.uploadMedia.assert_called_once_with(
+        client.restrunner.uploadMedia_async.assert_called_once_with(
             fileData=fake_buffer, 
             fileName="test.txt"
         )
@@ -425,7 +729,7 @@ class TestFileSending:
         """Test basic file sending"""
         client = Client()
         client.restrunner = Mock()
-        client.restrunner.sendEvent.return_value = {"event_id": "$file:matrix.org"}
+        client.restrunner.sendEvent_async = AsyncMock(return_value={"event_id": "$file:matrix.org"})
         
         result = await client._send_file(
             roomID="!room:matrix.org",
@@ -433,7 +737,7 @@ class TestFileSending:
             fileURL="mxc://matrix.org/file123"
         )
         
-        call_args = client.restrunner.sendEvent.call_args
+        call_args = client.restrunner.sendEvent_async.call_args
         payload = call_args[1]["eventPayload"]
         
         assert payload["msgtype"] == "m.file"  # Default type
@@ -447,7 +751,7 @@ class TestFileSending:
         
         client = Client()
         client.restrunner = Mock()
-        client.restrunner.sendEvent.return_value = {"event_id": "$file:matrix.org"}
+        client.restrunner.sendEvent_async = AsyncMock(return_value={"event_id": "$file:matrix.org"})
         
         file_info = {
             "size": 1024,
@@ -463,9 +767,194 @@ class TestFileSending:
             fileName="actual_file.txt"
         )
         
-        call_args = client.restrunner.sendEvent.call_args
+        call_args = client.restrunner.sendEvent_async.call_args
         payload = call_args[1]["eventPayload"]
         
         assert payload["msgtype"] == msgType.IMAGE
         assert payload["info"] == file_info
-        assert payload["filename"] == "actual_file.txt"
\ No newline at end of file
+        assert payload["filename"] == "actual_file.txt"
+
+
+def _countingSync(event):
+    """A sync_async that hands out one message per batch, from a room the cache picks up, and records the since token of every poll"""
+    calls = []
+
+    async def fake_sync(since=None, timeout=None, **kwargs):
+        calls.append(since)
+        await asyncio.sleep(0)
+        return {
+            "next_batch": "s" + str(len(calls)),
+            "rooms": {"join": {"!room:matrix.org": {"timeline": {"events": [event]}}}}
+        }
+
+    return {"sync_async": fake_sync, "joinedRooms_async": AsyncMock(return_value=["!room:matrix.org"]),
+            "getRoomState_async": AsyncMock(return_value=[])}, calls
+
+
+class TestPipelinedSync:
+    """Test overlapping the next /sync with dispatch"""
+
+    @pytest.mark.asyncio
+    async def test_next_sync_starts_during_dispatch(self, mock_client, sample_message_event):
+        """Test the next poll is sent while a handler is still running"""
+        import asyncio
+        runner, calls = _countingSync(sample_message_event)
+        client = mock_client(runner=runner, stubRooms=True, ignoreFirstSync=False, pipelineSync=True)
+        release = asyncio.Event()
+
+        @client.event
+        async def on_message(message):
+            await release.wait()
+
+        loop_task = asyncio.ensure_future(client._halcyonMainLoop())
+        await asyncio.sleep(0.05)
+
+        #first batch is stuck in the handler, but later polls already went out using the newer token
+        assert len(calls) >= 2
+        assert calls[0] == ""
+        assert calls[1] == "s1"
+
+        loop_task.cancel()
+        release.set()
+
+    @pytest.mark.asyncio
+    async def test_backpressure_limits_pending_batches(self, mock_client, sample_message_event):
+        """Test polling stops once maxPendingBatches are waiting"""
+        import asyncio
+        runner, calls = _countingSync(sample_message_event)
+        client = mock_client(runner=runner, ignoreFirstSync=False, pipelineSync=True, maxPendingBatches=2)
+        release = asyncio.Event()
+
+        @client.event
+        async def on_message(message):
+            await release.wait()
+
+        loop_task = asyncio.ensure_future(client._halcyonMainLoop())
+        await asyncio.sleep(0.05)
+
+        #one batch in the handler and two fetched behind it, no poll for a third
+        assert len(calls) == 3
+
+        loop_task.cancel()
+        release.set()
+
+    @pytest.mark.asyncio
+    async def test_fetched_batches_stay_within_bound(self, mock_client, sample_message_event):
+        """Test fetched but unhandled batches never go over maxPendingBatches, while handlers keep finishing"""
+        import asyncio
+        runner, calls = _countingSync(sample_message_event)
+        client = mock_client(runner=runner, ignoreFirstSync=False, pipelineSync=True, maxPendingBatches=1)
+        started = []
+        finished = []
+        overshoot = []
+
+        @client.event
+        async def on_message(message):
+            started.append(message)
+            overshoot.append(len(calls) - len(started))
+            await asyncio.sleep(0.01)
+            finished.append(message)
+
+        loop_task = asyncio.ensure_future(client._halcyonMainLoop())
+        await asyncio.sleep(0.1)
+        loop_task.cancel()
+
+        assert len(finished) >= 3
+        assert max(overshoot) <= 1
+        assert len(calls) - len(started) <= 1
+
+    def test_invalid_pending_batches(self):
+        """Test maxPendingBatches must be positive"""
+        with pytest.raises(ValueError):
+            Client(maxPendingBatches=0)
+
+
+class TestIncrementalRoomState:
+    """Test the room cache is kept current from sync"""
+
+    @pytest.mark.asyncio
+    async def test_sync_applies_state(self, mock_client, sample_room_create_events, sample_message_event):
+        """Test state and timeline state events update the cached room"""
+        cached = room(sample_room_create_events, "!room:matrix.org")
+        client = mock_client(rooms={"!room:matrix.org": cached}, ignoreFirstSync=False)
+        client.restrunner.sync_async = AsyncMock(return_value={
+            "next_batch": "s2",
+            "rooms": {"join": {"!room:matrix.org": {
+                "state": {"events": [
+                    {"type": "m.room.topic", "state_key": "", "content": {"topic": "From state"}}
+                ]},
+                "timeline": {"events": [
+                    {"type": "m.room.name", "state_key": "", "content": {"name": "From timeline"}},
+                    sample_message_event
+                ]}
+            }}}
+        })
+        seen = []
+
+        @client.event
+        async def on_message(message):
+            seen.append(message.room.name)
+
+        await client._homeserverSync()
+
+        assert cached.topic == "From state"
+        assert cached.name == "From timeline"
+        assert seen == ["From timeline"]
+        client.restrunner.getRoomState.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_lazy_messages(self, mock_client, sample_message_event):
+        """Test lazyMessages hands handlers LazyMessage objects"""
+        client = mock_client(rooms={"!room:matrix.org": room(roomID="!room:matrix.org")}, ignoreFirstSync=False, lazyMessages=True)
+        client.restrunner.sync_async = AsyncMock(return_value={
+            "next_batch": "s2",
+            "rooms": {"join": {"!room:matrix.org": {"timeline": {"events": [sample_message_event]}}}}
+        })
+        seen = []
+
+        @client.event
+        async def on_message(message):
+            seen.append(message)
+
+        await client._homeserverSync()
+
+        assert isinstance(seen[0], LazyMessage)
+        assert seen[0].content.body == "Hello world"
+
+    @pytest.mark.asyncio
+    async def test_refresh_can_be_disabled(self):
+        """Test the full refresh is skipped when the interval is off"""
+        client = Client(roomCacheRefreshInterval=None)
+        client.roomCache = {"rooms": {}, "cache_age": 0}
+        client._refreshRoomCache = Mock()
+
+        await client._maybeRefreshRoomCache()
+        client._refreshRoomCache.assert_not_called()
+
+    def test_refresh_off_by_default(self):
+        """Test the full refresh is opt in"""
+        assert Client().roomCacheRefreshInterval is None
+
+    @pytest.mark.asyncio
+    async def test_refresh_runs_in_background(self, mock_client):
+        """Test a due refresh doesn't hold up the caller, and only one runs at a time"""
+        release = asyncio.Event()
+        fetched = []
+
+        async def getRoomState(roomID):
+            fetched.append(roomID)
+            await release.wait()
+            return []
+
+        client = mock_client(runner=_roomsRunner(getRoomState, []), roomCacheRefreshInterval=60)
+        client.roomCache = {"rooms": {"!a:matrix.org": room(roomID="!a:matrix.org")}, "cache_age": 0}
+
+        await asyncio.wait_for(client._maybeRefreshRoomCache(), 0.5)
+        refresh = client._refreshTask
+        client.roomCache["cache_age"] = 0
+        await client._maybeRefreshRoomCache()
+        assert client._refreshTask is refresh
+
+        release.set()
+        await refresh
+        assert fetched == ["!a:matrix.org"]
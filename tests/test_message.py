@@ -1,6 +1,7 @@
 import pytest
-from halcyon.message import message, MessageContent, Message
+from halcyon.message import message, MessageContent, Message, LazyMessage, LazyMessageContent
 from halcyon.enums import msgType
+from pydantic import ValidationError
 
 
 class TestMessage:
@@ -480,4 +481,47 @@ class TestBackwardCompatibility:
         assert content.geo_uri is None
         assert content.server_notice_type is None
         assert content.from_device is None
-        assert content.methods is None
\ No newline at end of file
+        assert content.methods is None
+
+class TestLazyMessage:
+    """Test the lazily built message matches the eager one"""
+    
+    @pytest.mark.parametrize("fixture", ["sample_message_event", "sample_image_event", "sample_edit_event"])
+    def test_same_as_message(self, fixture, request):
+        """Test every field comes out the same as a Message built from the same event"""
+        event = request.getfixturevalue(fixture)
+        eager = message(event)
+        lazy = LazyMessage(event)
+        
+        assert lazy.model_dump() == eager.model_dump()
+        assert lazy.model_dump(exclude_unset=True) == eager.model_dump(exclude_unset=True)
+        assert bool(lazy) is True
+    
+    def test_only_builds_what_is_read(self, sample_image_event):
+        """Test reading the body doesn't build the event ID or file info"""
+        msg = LazyMessage(sample_image_event)
+        
+        assert msg.content.body == "image.jpg"
+        assert isinstance(msg.content, LazyMessageContent)
+        assert "event" not in msg.__dict__
+        assert "info" not in msg.content.__dict__
+        
+        assert msg.content.info.thumbnail.url == "mxc://matrix.org/thumbnail123"
+        assert msg.content.type == msgType.IMAGE
+    
+    def test_edit_and_relates(self, sample_edit_event):
+        msg = LazyMessage(sample_edit_event)
+        assert msg.edit.body == "edited message"
+        assert msg.relates.type == "m.replace"
+        assert msg.relates.eventID == "$originalEvent:matrix.org"
+    
+    def test_invalid_field_raises_on_access(self):
+        """Test validation still happens, when the field is read"""
+        msg = LazyMessage({"type": "m.room.message", "content": {"body": 5}})
+        with pytest.raises(ValidationError):
+            msg.content.body
+    
+    def test_empty(self):
+        msg = LazyMessage()
+        assert bool(msg) is False
+        assert msg.content is None
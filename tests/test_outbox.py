@@ -0,0 +1,239 @@
+import pytest
+import asyncio
+import threading
+import time
+import aiohttp
+from unittest.mock import Mock, AsyncMock
+from halcyon.halcyon import Client
+from halcyon.outbox import Outbox, OutboxEntry, FileOutboxStore, SQLiteOutboxStore
+
+
+def _runner(sendEvent):
+    runner = Mock()
+    runner.USER_ID = "@bot:matrix.org"
+    runner.sendEvent_async = sendEvent
+    return runner
+
+
+@pytest.fixture(params=["file", "sqlite"])
+def storeFactory(request, tmp_path):
+    if request.param == "file":
+        return lambda: FileOutboxStore(str(tmp_path / "outbox" / "log.jsonl"))
+    return lambda: SQLiteOutboxStore(str(tmp_path / "outbox.db"))
+
+
+class TestOutboxStore:
+    """Test both outbox stores"""
+
+    def test_pending_survives_reopen(self, storeFactory):
+        """Test added events are still pending after a restart, in order, and removed ones are gone"""
+        store = storeFactory()
+        for n in range(3):
+            store.add(OutboxEntry("txn" + str(n), "@bot:matrix.org", "!room:matrix.org", "m.room.message", {"body": str(n)}))
+        store.add(OutboxEntry("other", "@someone:matrix.org", "!room:matrix.org", "m.room.message", {}))
+        store.remove("txn1")
+        store.close()
+
+        store = storeFactory()
+        pending = store.pending("@bot:matrix.org")
+        assert [entry.txnID for entry in pending] == ["txn0", "txn2"]
+        assert pending[1].payload == {"body": "2"}
+        store.close()
+
+    def test_file_log_compacted(self, tmp_path):
+        """Test finished events are dropped from the log when it's reopened"""
+        path = str(tmp_path / "log.jsonl")
+        store = FileOutboxStore(path)
+        store.add(OutboxEntry("a", "@bot:matrix.org", "!room:matrix.org", "m.room.message", {}))
+        store.add(OutboxEntry("b", "@bot:matrix.org", "!room:matrix.org", "m.room.message", {}))
+        store.remove("a")
+        store.close()
+
+        FileOutboxStore(path).close()
+        with open(path) as f:
+            assert len(f.readlines()) == 1
+
+    def test_file_torn_write(self, tmp_path):
+        """Test a half written last line doesn't stop the log loading"""
+        path = str(tmp_path / "log.jsonl")
+        store = FileOutboxStore(path)
+        store.add(OutboxEntry("a", "@bot:matrix.org", "!room:matrix.org", "m.room.message", {}))
+        store.close()
+        with open(path, "a") as f:
+            f.write('{"op": "add", "txn": "b", "acc')
+
+        store = FileOutboxStore(path)
+        assert [entry.txnID for entry in store.pending("@bot:matrix.org")] == ["a"]
+        store.close()
+
+
+class TestOutbox:
+    """Test sending through the outbox"""
+
+    @pytest.mark.asyncio
+    async def test_send_removes_on_success(self, storeFactory):
+        """Test a sent event is stored with its txn ID, then forgotten once accepted"""
+        store = storeFactory()
+        sendEvent = AsyncMock(return_value={"event_id": "$1"})
+        outbox = Outbox(store)
+        outbox.bind(_runner(sendEvent))
+
+        result = await outbox.send("!room:matrix.org", "m.room.message", {"body": "hi"})
+
+        assert result == {"event_id": "$1"}
+        txnID = sendEvent.call_args.kwargs["txnID"]
+        assert txnID.startswith("halcyon.")
+        assert store.pending("@bot:matrix.org") == []
+        await outbox.close()
+
+    @pytest.mark.asyncio
+    async def test_replay_uses_same_txn_id(self, storeFactory):
+        """Test events left over from a crash are resent with their original txn ID"""
+        store = storeFactory()
+        hang = asyncio.Event()
+        attempts = []
+
+        async def stuck(*args, **kwargs):
+            attempts.append(kwargs["txnID"])
+            await hang.wait()
+
+        outbox = Outbox(store)
+        outbox.bind(_runner(stuck))
+        outbox.enqueue("!room:matrix.org", "m.room.message", {"body": "one"})
+        outbox.enqueue("!room:matrix.org", "m.room.message", {"body": "two"})
+        while len(attempts) < 2:
+            await asyncio.sleep(0.001)
+        txnIDs = [entry.txnID for entry in store.pending("@bot:matrix.org")]
+        assert txnIDs == attempts
+        await outbox.close()  # crash, nothing acknowledged
+
+        store = storeFactory()
+        sent = []
+        done = asyncio.Event()
+
+        async def sendEvent(roomID, eventType, payload, txnID=None):
+            sent.append((txnID, payload["body"]))
+            if len(sent) == 2:
+                done.set()
+            return {"event_id": "$" + txnID}
+
+        outbox = Outbox(store)
+        assert outbox.bind(_runner(sendEvent)) == 2
+        await asyncio.wait_for(done.wait(), 1)
+        while outbox._lanes:
+            await asyncio.sleep(0.001)
+
+        assert sent == [(txnIDs[0], "one"), (txnIDs[1], "two")]
+        assert store.pending("@bot:matrix.org") == []
+        await outbox.close()
+
+    @pytest.mark.asyncio
+    async def test_pipelined_in_order(self, tmp_path):
+        """Test several PUTs per room are in flight at once, started and answered in order"""
+        started = []
+        release = asyncio.Event()
+
+        async def sendEvent(roomID, eventType, payload, txnID=None):
+            started.append(payload["n"])
+            await release.wait()
+            #finish in reverse, results should still come back in order
+            await asyncio.sleep(0.001 * (10 - payload["n"]))
+            return {"n": payload["n"]}
+
+        outbox = Outbox(SQLiteOutboxStore(":memory:"), pipelineDepth=3)
+        outbox.bind(_runner(sendEvent))
+        futures = [outbox.enqueue("!room:matrix.org", "m.room.message", {"n": n}) for n in range(5)]
+        while len(started) < 3:
+            await asyncio.sleep(0.001)
+        await asyncio.sleep(0.01)
+
+        assert started == [0, 1, 2]
+        completed = []
+        for future in futures:
+            future.add_done_callback(lambda f: completed.append(f.result()["n"]))
+
+        release.set()
+        await asyncio.gather(*futures)
+        assert started == [0, 1, 2, 3, 4]
+        assert completed == [0, 1, 2, 3, 4]
+        await outbox.close()
+
+    @pytest.mark.asyncio
+    async def test_transient_error_retried(self):
+        """Test a network error is retried with the same txn ID"""
+        sendEvent = AsyncMock(side_effect=[aiohttp.ClientConnectionError(), {"event_id": "$1"}])
+        outbox = Outbox(SQLiteOutboxStore(":memory:"), maxBackoff=0)
+        outbox.bind(_runner(sendEvent))
+
+        assert await outbox.send("!room:matrix.org", "m.room.message", {}) == {"event_id": "$1"}
+        first, second = sendEvent.call_args_list
+        assert first.kwargs["txnID"] == second.kwargs["txnID"]
+        await outbox.close()
+
+    @pytest.mark.asyncio
+    async def test_permanent_error_dropped(self):
+        """Test a 403 fails the send and doesn't leave it in the store"""
+        store = SQLiteOutboxStore(":memory:")
+        error = aiohttp.ClientResponseError(Mock(real_url="https://matrix.org"), (), status=403)
+        outbox = Outbox(store)
+        outbox.bind(_runner(AsyncMock(side_effect=error)))
+
+        with pytest.raises(aiohttp.ClientResponseError):
+            await outbox.send("!room:matrix.org", "m.room.message", {})
+        assert store.pending("@bot:matrix.org") == []
+        await outbox.close()
+
+    @pytest.mark.asyncio
+    async def test_store_writes_off_the_loop(self, storeFactory):
+        """Test store writes run on the writer thread, and the send waits for the event to be stored"""
+        store = storeFactory()
+        loopThread = threading.get_ident()
+        threads = []
+        add, remove = store.add, store.remove
+
+        def slowAdd(entry):
+            threads.append(threading.get_ident())
+            time.sleep(0.02)
+            add(entry)
+
+        def trackedRemove(txnID):
+            threads.append(threading.get_ident())
+            remove(txnID)
+
+        store.add, store.remove = slowAdd, trackedRemove
+
+        async def sendEvent(roomID, eventType, payload, txnID=None):
+            assert [entry.txnID for entry in store.pending("@bot:matrix.org")] == [txnID]
+            return {"event_id": "$1"}
+
+        outbox = Outbox(store)
+        outbox.bind(_runner(sendEvent))
+        assert await outbox.send("!room:matrix.org", "m.room.message", {}) == {"event_id": "$1"}
+
+        assert len(threads) == 2
+        assert loopThread not in threads
+        assert store.pending("@bot:matrix.org") == []
+        await outbox.close()
+
+    def test_unbound(self):
+        """Test sending before the client has logged in is refused"""
+        with pytest.raises(RuntimeError):
+            Outbox(SQLiteOutboxStore(":memory:")).enqueue("!room:matrix.org", "m.room.message", {})
+
+
+class TestClientOutbox:
+    """Test the client sends through the outbox"""
+
+    @pytest.mark.asyncio
+    async def test_send_message_uses_outbox(self):
+        client = Client(outboxStore=SQLiteOutboxStore(":memory:"))
+        client.restrunner = _runner(AsyncMock(return_value={"event_id": "$1"}))
+        client.outbox.bind(client.restrunner)
+
+        result = await client.send_message("!room:matrix.org", "hello")
+
+        assert result == {"event_id": "$1"}
+        call = client.restrunner.sendEvent_async.call_args
+        assert call.args[2]["body"] == "hello"
+        assert call.kwargs["txnID"] is not None
+        await client.outbox.close()
@@ -0,0 +1,93 @@
+import pytest
+import ssl
+from unittest.mock import patch
+from halcyon.pool import ConnectionPool, ConnectionPoolConfig
+from halcyon.restrunner import Runner
+from halcyon.enums import Basepath
+
+
+def _runner(pool=None):
+    with patch.object(Runner, "_wellknownLookup", return_value={"m.homeserver": {"base_url": "https://matrix.org"}}):
+        return Runner("matrix.org", user_id="@bot:matrix.org", access_token="token", connectionPool=pool)
+
+
+class TestConnectionPool:
+    """Test the shared aiohttp connection pool"""
+
+    @pytest.mark.asyncio
+    async def test_connector_settings(self):
+        """Test the config ends up on the connectors"""
+        pool = ConnectionPool(ConnectionPoolConfig(limit=50, limitPerHost=5, keepaliveTimeout=30, mediaLimit=3))
+        api = await pool.session()
+        media = await pool.session(media=True)
+
+        assert api is not media
+        assert api.connector.limit == 50
+        assert api.connector.limit_per_host == 5
+        assert media.connector.limit == 3
+        await pool.close()
+        assert pool.closed
+
+    @pytest.mark.asyncio
+    async def test_tls_context(self):
+        """Test aiohttp's own SSL context is used unless one is passed in"""
+        pool = ConnectionPool()
+        assert (await pool.session()).connector._ssl is True
+        await pool.close()
+
+        context = ssl.create_default_context()
+        pool = ConnectionPool(ConnectionPoolConfig(sslContext=context))
+        assert (await pool.session()).connector._ssl is context
+        assert (await pool.session(media=True)).connector._ssl is context
+        await pool.close()
+
+    @pytest.mark.asyncio
+    async def test_single_pool_without_media_split(self):
+        """Test media shares the API session when the media pool is turned off"""
+        pool = ConnectionPool(ConnectionPoolConfig(separateMediaPool=False))
+        assert await pool.session(media=True) is await pool.session()
+        await pool.close()
+
+    @pytest.mark.asyncio
+    async def test_shared_between_runners(self):
+        """Test closing one runner leaves the pool open for the other"""
+        pool = ConnectionPool()
+        first = _runner(pool)
+        second = _runner(pool)
+
+        session = await first._ensure_session()
+        assert await second._ensure_session() is session
+
+        await first._close_session()
+        assert not session.closed
+
+        await second._close_session()
+        assert session.closed
+
+    @pytest.mark.asyncio
+    async def test_runner_reopens_after_close(self):
+        """Test a runner with its own pool can be used again after closing"""
+        runner = _runner()
+        session = await runner._ensure_session()
+        await runner._close_session()
+        await runner._close_session()  # closing twice is fine
+        assert session.closed
+
+        reopened = await runner._ensure_session()
+        assert not reopened.closed
+        await runner._close_session()
+        assert reopened.closed
+
+    @pytest.mark.asyncio
+    async def test_media_requests_use_media_session(self):
+        """Test media endpoints are sent on the media session"""
+        pool = ConnectionPool()
+        runner = _runner(pool)
+        media = await pool.session(media=True)
+
+        with patch.object(media, "request", side_effect=RuntimeError("sent")) as request:
+            with pytest.raises(RuntimeError):
+                await runner._async_request("GET", "download/matrix.org/abc", basepath=Basepath.MEDIA, retryCount=0)
+        assert request.called
+
+        await runner._close_session()
@@ -0,0 +1,221 @@
+import pytest
+import asyncio
+import time
+from unittest.mock import Mock, AsyncMock, patch
+from halcyon.ratelimit import TokenBucket, AdaptiveLimit, OutboundScheduler, RateLimited, retryAfter
+from halcyon.restrunner import Runner
+
+
+def _runner(scheduler=None):
+    with patch.object(Runner, "_wellknownLookup", return_value={"m.homeserver": {"base_url": "https://matrix.org"}}):
+        return Runner("matrix.org", user_id="@bot:matrix.org", access_token="token", scheduler=scheduler)
+
+
+class TestTokenBucket:
+    """Test the token bucket"""
+
+    @pytest.mark.asyncio
+    async def test_burst_then_rate(self):
+        """Test the burst goes out at once and the rest is paced"""
+        bucket = TokenBucket(rate=50, burst=3)
+        start = time.monotonic()
+        for _ in range(3):
+            await bucket.acquire()
+        assert time.monotonic() - start < 0.02
+
+        for _ in range(3):
+            await bucket.acquire()
+        assert time.monotonic() - start >= 0.05
+
+    @pytest.mark.asyncio
+    async def test_pause(self):
+        """Test nothing is handed out while paused"""
+        bucket = TokenBucket(rate=1000, burst=5)
+        bucket.pause(0.05)
+        start = time.monotonic()
+        await bucket.acquire()
+        assert time.monotonic() - start >= 0.04
+        assert not bucket.idle
+
+    def test_invalid(self):
+        """Test bad settings are refused"""
+        with pytest.raises(ValueError):
+            TokenBucket(rate=0, burst=1)
+
+
+class TestAdaptiveLimit:
+    """Test the AIMD concurrency limit"""
+
+    def test_halves_and_grows_back(self):
+        """Test a 429 halves the limit and successes grow it again"""
+        limit = AdaptiveLimit(initial=8, minimum=1, maximum=10)
+        limit.onRateLimited()
+        assert limit.limit == 4
+        for _ in range(5):
+            limit.onSuccess()
+        assert limit.limit == 5
+
+        for _ in range(10):
+            limit.onRateLimited()
+        assert limit.limit == 1
+
+        for _ in range(500):
+            limit.onSuccess()
+        assert limit.limit == 10
+
+    @pytest.mark.asyncio
+    async def test_bounds_in_flight(self):
+        """Test no more than the limit run at once"""
+        limit = AdaptiveLimit(initial=2, minimum=1, maximum=2)
+        running = []
+        peak = []
+
+        async def work():
+            await limit.acquire()
+            running.append(1)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+            await limit.release()
+
+        await asyncio.gather(*[work() for _ in range(6)])
+        assert max(peak) == 2
+        assert limit.inFlight == 0
+
+
+class TestOutboundScheduler:
+    """Test the outbound scheduler"""
+
+    @pytest.mark.asyncio
+    async def test_retries_after_server_delay(self):
+        """Test a limited send is retried after retry_after_ms, not dropped"""
+        scheduler = OutboundScheduler(globalRate=None, roomRate=None)
+        send = AsyncMock(side_effect=[RateLimited(0.05), {"event_id": "$1"}])
+
+        start = time.monotonic()
+        result = await scheduler.run("!room:matrix.org", send)
+
+        assert result == {"event_id": "$1"}
+        assert send.call_count == 2
+        assert time.monotonic() - start >= 0.05
+        assert scheduler.rateLimited == 1
+        assert scheduler.sent == 1
+        assert scheduler.concurrency.limit == 4
+
+    @pytest.mark.asyncio
+    async def test_max_retries(self):
+        """Test the send gives up after maxRetries"""
+        scheduler = OutboundScheduler(globalRate=None, roomRate=None, maxRetries=1)
+        send = AsyncMock(side_effect=RateLimited(0))
+
+        with pytest.raises(RateLimited):
+            await scheduler.run("!room:matrix.org", send)
+        assert send.call_count == 2
+        assert scheduler.queued == 0
+
+    @pytest.mark.asyncio
+    async def test_other_errors_raise(self):
+        """Test errors that aren't rate limits aren't retried, and don't shrink the limit"""
+        scheduler = OutboundScheduler(globalRate=None, roomRate=None)
+        send = AsyncMock(side_effect=ValueError("boom"))
+
+        with pytest.raises(ValueError):
+            await scheduler.run("!room:matrix.org", send)
+        assert send.call_count == 1
+        assert scheduler.concurrency.limit == 8
+        assert scheduler.concurrency.inFlight == 0
+
+    @pytest.mark.asyncio
+    async def test_room_bucket_paces_one_room(self):
+        """Test the per room bucket only slows the busy room"""
+        scheduler = OutboundScheduler(globalRate=None, roomRate=20, roomBurst=1)
+        send = AsyncMock(return_value={})
+
+        start = time.monotonic()
+        await asyncio.gather(*[scheduler.run("!a:matrix.org", send) for _ in range(3)])
+        assert time.monotonic() - start >= 0.09
+
+        start = time.monotonic()
+        await scheduler.run("!b:matrix.org", send)
+        assert time.monotonic() - start < 0.04
+
+    @pytest.mark.asyncio
+    async def test_no_pacing_by_default(self):
+        """Test the default scheduler sends straight away and only backs off once limited"""
+        scheduler = OutboundScheduler()
+        assert scheduler.globalBucket is None
+        assert scheduler._roomBucket("!a:matrix.org") is None
+
+        send = AsyncMock(return_value={})
+        start = time.monotonic()
+        await asyncio.gather(*[scheduler.run("!a:matrix.org", send) for _ in range(100)])
+        assert time.monotonic() - start < 0.05
+
+    @pytest.mark.asyncio
+    async def test_rate_limit_holds_back_other_rooms(self):
+        """Test a 429 in one room delays sends to every room, even without a global bucket"""
+        scheduler = OutboundScheduler()
+        limited = AsyncMock(side_effect=[RateLimited(0.05), {}])
+        first = asyncio.ensure_future(scheduler.run("!a:matrix.org", limited))
+        await asyncio.sleep(0)
+
+        start = time.monotonic()
+        await scheduler.run("!b:matrix.org", AsyncMock(return_value={}))
+        assert time.monotonic() - start >= 0.04
+        await first
+
+    def test_idle_room_buckets_dropped(self):
+        """Test room buckets don't pile up forever"""
+        scheduler = OutboundScheduler(roomRate=5, maxRoomBuckets=2)
+        scheduler._roomBucket("!a:matrix.org")
+        scheduler._roomBucket("!b:matrix.org")
+        scheduler._roomBucket("!c:matrix.org")
+        assert set(scheduler._roomBuckets) == {"!c:matrix.org"}
+
+
+class TestRetryAfter:
+    """Test reading the delay out of a 429"""
+
+    @pytest.mark.asyncio
+    async def test_body(self):
+        resp = Mock(headers={})
+        resp.read = AsyncMock(return_value=b'{"errcode": "M_LIMIT_EXCEEDED", "retry_after_ms": 2500}')
+        assert await retryAfter(resp) == 2.5
+
+    @pytest.mark.asyncio
+    async def test_header_fallback(self):
+        resp = Mock(headers={"Retry-After": "3"})
+        resp.read = AsyncMock(return_value=b"<html>Too many requests</html>")
+        assert await retryAfter(resp) == 3.0
+
+    @pytest.mark.asyncio
+    async def test_missing(self):
+        resp = Mock(headers={})
+        resp.read = AsyncMock(return_value=b'{"errcode": "M_LIMIT_EXCEEDED"}')
+        assert await retryAfter(resp) is None
+
+    @pytest.mark.asyncio
+    async def test_uses_given_codec(self):
+        """Test the body is decoded with the runner's codec"""
+        resp = Mock(headers={})
+        resp.read = AsyncMock(return_value=b"raw")
+        loads = Mock(return_value={"retry_after_ms": 500})
+        assert await retryAfter(resp, loads) == 0.5
+        loads.assert_called_once_with(b"raw")
+
+
+class TestScheduledSend:
+    """Test sendEvent_async goes through the scheduler"""
+
+    @pytest.mark.asyncio
+    async def test_retry_reuses_txn_id(self):
+        """Test a limited send is retried on the same endpoint, so the server can dedupe it"""
+        runner = _runner(OutboundScheduler(globalRate=None, roomRate=None))
+        runner._async_put = AsyncMock(side_effect=[RateLimited(0), {"event_id": "$1"}])
+
+        result = await runner.sendEvent_async("!room:matrix.org", "m.room.message", {"body": "hi"})
+
+        assert result == {"event_id": "$1"}
+        first, second = runner._async_put.call_args_list
+        assert first.kwargs["endpoint"] == second.kwargs["endpoint"]
+        assert first.kwargs["retryRateLimit"] is False
@@ -1,5 +1,5 @@
 import pytest
-from halcyon.room import room
+from halcyon.room import room, LazyRoom
 
 
 class TestRoom:
@@ -182,6 +182,58 @@ class TestRoomPermissions:
         """Test empty permissions"""
         perms = room.roomPermissions(None)
         assert bool(perms) is False
+    
+    def test_permission_checks(self):
+        """Test can() and level() fill in the spec defaults for anything the power levels leave out"""
+        perms = room.roomPermissions({
+            "users": {"@admin:matrix.org": 100, "@mod:matrix.org": "50"},
+            "users_default": 10,
+            "events": {"m.room.topic": 10, "m.reaction": 20},
+            "kick": 40,
+        })
+        assert perms.level("@mod:matrix.org") == 50
+        assert perms.level("@nobody:matrix.org") == 10
+        
+        assert perms.can("@nobody:matrix.org", "m.room.message")
+        assert perms.can("@nobody:matrix.org", "m.room.topic")
+        assert not perms.can("@nobody:matrix.org", "m.reaction")
+        assert not perms.can("@nobody:matrix.org", "m.room.name")
+        assert not perms.can("@nobody:matrix.org", "com.example.custom", state=True)
+        assert perms.can("@nobody:matrix.org", "invite")
+        
+        assert perms.can("@mod:matrix.org", "kick")
+        assert perms.can("@mod:matrix.org", "ban")
+        assert not perms.can("@nobody:matrix.org", "ban")
+        assert not perms.can("@mod:matrix.org", "kick", target="@admin:matrix.org")
+        assert perms.can("@admin:matrix.org", "ban", target="@mod:matrix.org")
+        assert perms.can("@mod:matrix.org", "notifications.room")
+    
+    def test_room_permission_checks(self):
+        """Test Room.can follows power level changes, and falls back to the creator without any"""
+        test_room = room([{"type": "m.room.create", "state_key": "", "content": {"creator": "@creator:matrix.org"}}])
+        assert test_room.power_level("@creator:matrix.org") == 100
+        assert test_room.can("@someone:matrix.org", "m.room.name")
+        assert not test_room.can("@someone:matrix.org", "kick")
+        
+        test_room.apply_state_event({"type": "m.room.power_levels", "state_key": "",
+                                     "content": {"users": {"@someone:matrix.org": 50}}})
+        assert test_room.power_level("@creator:matrix.org") == 0
+        assert test_room.can("@someone:matrix.org", "kick")
+        assert not LazyRoom(test_room._rawEvents).can("@creator:matrix.org", "m.room.name")
+    
+    def test_fallback_permissions_built_once(self):
+        """Test a room without power levels reuses one index until its create event changes"""
+        create = {"type": "m.room.create", "state_key": "", "content": {"creator": "@creator:matrix.org"}}
+        test_room = room([create])
+        index = test_room._permission_index()
+        assert test_room._permission_index() is index
+        assert test_room == room([create])
+        assert LazyRoom([create]).power_level("@creator:matrix.org") == 100
+        
+        test_room.apply_state_event(dict(create, content={"creator": "@other:matrix.org"}))
+        assert test_room._permission_index() is not index
+        assert test_room.power_level("@other:matrix.org") == 100
+        assert room().power_level("@anyone:matrix.org") == 0
 
 
 class TestRoomServerAcl:
@@ -217,6 +269,47 @@ class TestRoomServerAcl:
         """Test empty ACL"""
         acl = room.room_server_acl(None)
         assert bool(acl) is False
+        assert acl.is_server_allowed("anything.org")
+    
+    def test_acl_empty_content(self):
+        """Test an ACL event with empty content has no allow list, so it denies every server"""
+        acl = room.room_server_acl({})
+        assert bool(acl) is True
+        assert not acl.is_server_allowed("matrix.org")
+        
+        test_room = room([{"type": "m.room.server_acl", "state_key": "", "content": {}}])
+        assert not test_room.is_server_allowed("matrix.org")
+    
+    def test_acl_matching(self):
+        """Test servers are matched with deny first, ports ignored and IP literals refused"""
+        acl = room.room_server_acl({
+            "allow_ip_literals": False,
+            "allow": ["*.trusted.org", "matrix.org", "server?.net"],
+            "deny": ["evil.trusted.org"],
+        })
+        assert acl.is_server_allowed("matrix.org")
+        assert acl.is_server_allowed("MATRIX.org:8448")
+        assert acl.is_server_allowed("chat.trusted.org")
+        assert acl.is_server_allowed("server1.net")
+        assert not acl.is_server_allowed("server10.net")
+        assert not acl.is_server_allowed("trusted.org")
+        assert not acl.is_server_allowed("evil.trusted.org")
+        assert not acl.is_server_allowed("matrix.org.evil.com")
+        assert not acl.is_server_allowed("1.2.3.4")
+        assert not acl.is_server_allowed("[::1]:8448")
+        # The second answer comes from the cache
+        assert not acl.is_server_allowed("evil.trusted.org")
+        
+        assert room.room_server_acl({"allow": ["*"]}).is_server_allowed("[::1]")
+        assert not room.room_server_acl({"deny": ["*"]}).is_server_allowed("matrix.org")
+    
+    def test_room_acl_matching(self):
+        """Test Room.is_server_allowed follows the room's ACL, and allows everyone without one"""
+        test_room = room([{"type": "m.room.name", "state_key": "", "content": {"name": "Room"}}])
+        assert test_room.is_server_allowed("evil.org")
+        test_room.apply_state_event({"type": "m.room.server_acl", "state_key": "", "content": {"allow": ["*"], "deny": ["evil.org"]}})
+        assert not test_room.is_server_allowed("evil.org")
+        assert test_room.is_server_allowed("matrix.org")
 
 
 class TestRoomEncryption:
@@ -644,4 +737,241 @@ class TestBackwardCompatibilityNewFields:
         assert member.user_id == "@simple:matrix.org"
         assert member.membership == "join"
         assert member.avatar_url is None
-        assert member.displayname is None
\ No newline at end of file
+        assert member.displayname is None
+
+class TestRoomStateUpdates:
+    """Test applying state events on top of an existing room"""
+    
+    def test_apply_name_change(self, sample_room_create_events):
+        """Test a new name replaces the old one"""
+        test_room = room(sample_room_create_events, "!test:matrix.org")
+        test_room.apply_state_event({
+            "type": "m.room.name",
+            "state_key": "",
+            "content": {"name": "Renamed"}
+        })
+        
+        assert test_room.name == "Renamed"
+        assert test_room.topic == "A test room for unit tests"
+    
+    def test_related_groups_replaced(self, sample_room_create_events):
+        """Test a new related groups event replaces the groups instead of adding to them"""
+        test_room = room(sample_room_create_events, "!test:matrix.org")
+        event = {"type": "m.room.related_groups", "state_key": "", "content": {"groups": ["+a:matrix.org"]}}
+        test_room.apply_state_event(event)
+        test_room.apply_state_event(event)
+        assert test_room.relatedGroups == ["+a:matrix.org"]
+        
+        test_room.apply_state_event({"type": "m.room.related_groups", "state_key": "", "content": {"groups": ["+b:matrix.org"]}})
+        assert test_room.relatedGroups == ["+b:matrix.org"]
+    
+    def test_membership_moves_between_lists(self, sample_room_create_events):
+        """Test a membership change moves the user to the right list"""
+        test_room = room(sample_room_create_events, "!test:matrix.org")
+        test_room.apply_state_events([
+            {"type": "m.room.member", "state_key": "@invited:matrix.org", "content": {"membership": "join"}},
+            {"type": "m.room.member", "state_key": "@user1:matrix.org", "content": {"membership": "leave"}},
+        ])
+        
+        assert test_room.members == ["@invited:matrix.org"]
+        assert test_room.invited == []
+        assert test_room.left == ["@user1:matrix.org"]
+        assert test_room.member_details["@user1:matrix.org"].membership == "leave"
+    
+    def test_non_state_events_ignored(self, sample_room_create_events):
+        """Test timeline events without a state key don't touch the room"""
+        test_room = room(sample_room_create_events, "!test:matrix.org")
+        test_room.apply_state_event({"type": "m.room.name", "content": {"name": "Not state"}})
+        
+        assert test_room.name == "Test Room"
+    
+    def test_raw_events_track_current_state(self, sample_room_create_events):
+        """Test _rawEvents is updated in place, without touching the caller's list"""
+        original = list(sample_room_create_events)
+        test_room = room(sample_room_create_events, "!test:matrix.org")
+        test_room.apply_state_event({"type": "m.room.topic", "state_key": "", "content": {"topic": "New"}})
+        test_room.apply_state_event({"type": "m.room.member", "state_key": "@new:matrix.org", "content": {"membership": "join"}})
+        
+        assert sample_room_create_events == original
+        topics = [e for e in test_room._rawEvents if e["type"] == "m.room.topic"]
+        assert len(topics) == 1
+        assert topics[0]["content"]["topic"] == "New"
+        assert len(test_room._rawEvents) == len(original) + 1
+        
+        # Rebuilding from the raw events gives the same room
+        rebuilt = room(test_room._rawEvents, "!test:matrix.org")
+        assert rebuilt.topic == "New"
+        assert "@new:matrix.org" in rebuilt.members
+    
+    def test_empty_room_gets_data(self):
+        """Test an empty room becomes truthy once state arrives"""
+        test_room = room(roomID="!test:matrix.org")
+        test_room.apply_state_event({"type": "m.room.name", "state_key": "", "content": {"name": "Hello"}})
+        
+        assert bool(test_room) is True
+        assert test_room.name == "Hello"
+
+
+class TestLazyRoom:
+    """Test the lazily parsed room matches the full one"""
+    
+    def test_same_as_room(self, sample_room_create_events):
+        """Test every field comes out the same as a Room built from the same events"""
+        full = room(sample_room_create_events, "!test:matrix.org")
+        lazy = LazyRoom(sample_room_create_events, "!test:matrix.org")
+        
+        assert lazy.model_dump() == full.model_dump()
+        assert lazy.permissions.moderators == {"@moderator:matrix.org": 50}
+        assert bool(lazy) is True
+    
+    def test_only_parses_what_is_read(self, sample_room_create_events):
+        """Test reading the name doesn't build the members or power levels"""
+        lazy = LazyRoom(sample_room_create_events, "!test:matrix.org")
+        
+        assert lazy.name == "Test Room"
+        assert "member_details" not in lazy.__dict__
+        assert "permissions" not in lazy.__dict__
+        
+        assert lazy.members == ["@user1:matrix.org"]
+        assert "member_details" in lazy.__dict__
+    
+    def test_missing_state_uses_defaults(self):
+        """Test fields without any state event keep their defaults"""
+        lazy = LazyRoom([{"type": "m.room.name", "state_key": "", "content": {"name": "Hi"}}], "!test:matrix.org")
+        
+        assert lazy.acl is None
+        assert lazy.members == []
+        assert lazy.guestAccess is False
+    
+    def test_state_updates(self, sample_room_create_events):
+        """Test state changes land whether or not the field was parsed yet"""
+        full = room(sample_room_create_events, "!test:matrix.org")
+        lazy = LazyRoom(sample_room_create_events, "!test:matrix.org")
+        assert lazy.members == ["@user1:matrix.org"]
+        
+        updates = [
+            {"type": "m.room.member", "state_key": "@invited:matrix.org", "content": {"membership": "join"}},
+            {"type": "m.room.member", "state_key": "@user1:matrix.org", "content": {"membership": "leave"}},
+            {"type": "m.room.name", "state_key": "", "content": {"name": "Renamed"}},
+            {"type": "m.room.power_levels", "state_key": "", "content": {"users": {"@invited:matrix.org": 100}}},
+        ]
+        full.apply_state_events(updates)
+        lazy.apply_state_events(updates)
+        
+        assert lazy.members == ["@invited:matrix.org"]
+        assert lazy.left == ["@user1:matrix.org"]
+        assert lazy.name == "Renamed"
+        assert lazy.permissions.administrators == {"@invited:matrix.org": 100}
+        assert lazy.model_dump() == full.model_dump()
+        assert len(lazy._rawEvents) == len(full._rawEvents)
+    
+    def test_membership_order_matches_room(self):
+        """Test a member whose membership changed in the initial state ends up where Room puts them"""
+        events = [
+            {"type": "m.room.member", "state_key": "@a:matrix.org", "content": {"membership": "join"}},
+            {"type": "m.room.member", "state_key": "@b:matrix.org", "content": {"membership": "join"}},
+            {"type": "m.room.member", "state_key": "@a:matrix.org", "content": {"membership": "join", "displayname": "A"}},
+        ]
+        
+        assert LazyRoom(events).members == room(events).members == ["@b:matrix.org", "@a:matrix.org"]
+    
+    def test_empty(self):
+        lazy = LazyRoom(roomID="!test:matrix.org")
+        assert bool(lazy) is False
+        assert lazy.name is None
+        assert lazy.id == "!test:matrix.org"
+
+
+class TestMemberTable:
+    """Test the compact member store behind members, left, invited and member_details"""
+    
+    def _events(self):
+        return [
+            {"type": "m.room.member", "state_key": "@a:matrix.org", "content": {"membership": "join", "displayname": "A"}},
+            {"type": "m.room.member", "state_key": "@b:matrix.org", "content": {"membership": "invite"}},
+            {"type": "m.room.member", "state_key": "@c:matrix.org", "content": {"membership": "ban"}},
+        ]
+    
+    def test_views_read_like_lists(self):
+        """Test the views compare, index and dump like the lists they replace"""
+        test_room = room(self._events(), "!test:matrix.org")
+        assert test_room.members == ["@a:matrix.org"]
+        assert test_room.invited[0] == "@b:matrix.org"
+        assert "@b:matrix.org" not in test_room.members
+        assert list(test_room.member_details) == ["@a:matrix.org", "@b:matrix.org", "@c:matrix.org"]
+        dumped = test_room.model_dump()
+        assert dumped["members"] == ["@a:matrix.org"] and type(dumped["members"]) is list
+        assert dumped["member_details"]["@a:matrix.org"]["displayname"] == "A"
+    
+    def test_views_are_lists(self):
+        """Test the views take list operations, and edits made through them still answer membership checks"""
+        test_room = room(self._events() + [
+            {"type": "m.room.member", "state_key": "@d:matrix.org", "content": {"membership": "join"}},
+        ], "!test:matrix.org")
+        members = test_room.members
+        assert isinstance(members, list)
+        assert members + ["@e:matrix.org"] == ["@a:matrix.org", "@d:matrix.org", "@e:matrix.org"]
+        assert members.index("@d:matrix.org", 1, 2) == 1
+        
+        members.sort(reverse=True)
+        assert members == ["@d:matrix.org", "@a:matrix.org"]
+        members.insert(0, "@e:matrix.org")
+        assert "@e:matrix.org" in members
+        del members[0]
+        assert "@e:matrix.org" not in members
+        members.append("@f:matrix.org")
+        members.remove("@a:matrix.org")
+        assert "@f:matrix.org" in members and "@a:matrix.org" not in members
+        
+        test_room.apply_state_event({"type": "m.room.member", "state_key": "@d:matrix.org", "content": {"membership": "leave"}})
+        assert test_room.members == ["@f:matrix.org"]
+        assert "@d:matrix.org" in test_room.left
+    
+    def test_leaving_moves_last_member_in(self):
+        """Test a user leaving is taken out without shifting the list, and lookups stay right afterwards"""
+        events = [{"type": "m.room.member", "state_key": "@u" + str(i) + ":matrix.org", "content": {"membership": "join"}} for i in range(5)]
+        test_room = room(events, "!test:matrix.org")
+        test_room.apply_state_events([
+            {"type": "m.room.member", "state_key": "@u1:matrix.org", "content": {"membership": "leave"}},
+            {"type": "m.room.member", "state_key": "@u4:matrix.org", "content": {"membership": "leave"}},
+            {"type": "m.room.member", "state_key": "@u1:matrix.org", "content": {"membership": "join"}},
+        ])
+        
+        assert test_room.members == ["@u0:matrix.org", "@u3:matrix.org", "@u2:matrix.org", "@u1:matrix.org"]
+        assert test_room.left == ["@u4:matrix.org"]
+        assert all(userID in test_room.members for userID in test_room.members)
+        assert "@u4:matrix.org" not in test_room.members
+        
+        test_room.members.sort()
+        test_room.apply_state_event({"type": "m.room.member", "state_key": "@u2:matrix.org", "content": {"membership": "ban"}})
+        assert test_room.members == ["@u0:matrix.org", "@u1:matrix.org", "@u3:matrix.org"]
+    
+    def test_members_built_on_demand(self):
+        """Test no RoomMember is built until its details are read, and membership() never builds one"""
+        test_room = room(self._events(), "!test:matrix.org")
+        table = test_room._memberTable
+        assert table._built == {}
+        assert test_room.membership("@c:matrix.org") == "ban"
+        assert test_room.membership("@nobody:matrix.org") is None
+        assert table._built == {}
+        
+        member = test_room.member_details["@a:matrix.org"]
+        assert member.displayname == "A"
+        assert test_room.member_details["@a:matrix.org"] is member
+        
+        test_room.apply_state_event({"type": "m.room.member", "state_key": "@a:matrix.org", "content": {"membership": "leave"}})
+        assert test_room.member_details["@a:matrix.org"].membership == "leave"
+        assert test_room.left == ["@a:matrix.org"]
+    
+    def test_copies_and_pickles(self):
+        """Test deep copies get their own table, and pickled rooms still compare equal"""
+        import copy
+        import pickle
+        test_room = room(self._events(), "!test:matrix.org")
+        assert pickle.loads(pickle.dumps(test_room)) == test_room
+        
+        copied = copy.deepcopy(test_room)
+        copied.apply_state_event({"type": "m.room.member", "state_key": "@b:matrix.org", "content": {"membership": "join"}})
+        assert copied.members == ["@a:matrix.org", "@b:matrix.org"]
+        assert test_room.members == ["@a:matrix.org"]
+        assert copied != test_room
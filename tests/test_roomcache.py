@@ -0,0 +1,257 @@
+import pytest
+import asyncio
+from unittest.mock import AsyncMock, patch
+from halcyon.halcyon import Client
+from halcyon.room import room
+from halcyon.roomcache import RoomCache, SingleFlight, NegativeCache, estimateRoomSize, ROOM_OVERHEAD_BYTES, STATE_EVENT_BYTES
+
+
+def _room(roomID, events=0):
+    return room(rawEvents=[{"type": "m.room.topic", "state_key": str(n), "content": {"topic": "t"}} for n in range(events)], roomID=roomID)
+
+
+class TestRoomCache:
+    """Test the bounded room cache"""
+
+    def test_plain_dict_without_limits(self):
+        """Test it behaves like a dict when nothing is limited"""
+        cache = RoomCache()
+        cache["!a:matrix.org"] = _room("!a:matrix.org")
+        cache["!b:matrix.org"] = _room("!b:matrix.org")
+
+        assert set(cache) == {"!a:matrix.org", "!b:matrix.org"}
+        assert "!a:matrix.org" in cache
+        assert cache["!a:matrix.org"].id == "!a:matrix.org"
+        del cache["!a:matrix.org"]
+        assert len(cache) == 1
+
+    def test_lru(self):
+        """Test the least recently used room goes first"""
+        cache = RoomCache(maxRooms=2)
+        cache["!a:matrix.org"] = _room("!a:matrix.org")
+        cache["!b:matrix.org"] = _room("!b:matrix.org")
+        cache.get("!a:matrix.org")
+        cache["!c:matrix.org"] = _room("!c:matrix.org")
+
+        assert set(cache) == {"!a:matrix.org", "!c:matrix.org"}
+        assert cache.evictions == 1
+        assert cache.full
+
+    def test_ttl(self):
+        """Test rooms expire after the ttl"""
+        cache = RoomCache(ttl=60)
+        with patch("halcyon.roomcache.time.monotonic", return_value=1000):
+            cache["!a:matrix.org"] = _room("!a:matrix.org")
+        with patch("halcyon.roomcache.time.monotonic", return_value=1030):
+            assert cache.get("!a:matrix.org") is not None
+        with patch("halcyon.roomcache.time.monotonic", return_value=1061):
+            assert cache.get("!a:matrix.org") is None
+        assert cache.expirations == 1
+        assert len(cache) == 0
+
+    def test_memory_budget(self):
+        """Test big rooms push out old ones to stay under the byte budget"""
+        small = ROOM_OVERHEAD_BYTES + STATE_EVENT_BYTES
+        cache = RoomCache(maxBytes=small * 3)
+        for name in ["!a", "!b", "!c"]:
+            cache[name + ":matrix.org"] = _room(name, events=1)
+        assert cache.bytes == small * 3
+
+        cache["!big:matrix.org"] = _room("!big", events=2)
+        assert set(cache) == {"!c:matrix.org", "!big:matrix.org"}
+        assert cache.bytes <= small * 3
+
+    def test_oversized_room_still_cached(self):
+        """Test a room bigger than the whole budget is kept on its own"""
+        cache = RoomCache(maxBytes=10)
+        cache["!a:matrix.org"] = _room("!a")
+        cache["!b:matrix.org"] = _room("!b")
+        assert list(cache) == ["!b:matrix.org"]
+
+    def test_resize(self):
+        """Test a room that grew is re-measured"""
+        cache = RoomCache()
+        cachedRoom = _room("!a", events=1)
+        cache["!a:matrix.org"] = cachedRoom
+        cachedRoom.apply_state_event({"type": "m.room.topic", "state_key": "new", "content": {"topic": "t"}})
+        cache.resize("!a:matrix.org")
+        assert cache.bytes == estimateRoomSize(cachedRoom) == ROOM_OVERHEAD_BYTES + 2 * STATE_EVENT_BYTES
+
+    def test_changed_rooms(self):
+        """Test stored and resized rooms are marked changed until they're taken"""
+        cache = RoomCache()
+        cache["!a:matrix.org"] = _room("!a")
+        cache["!b:matrix.org"] = _room("!b")
+        assert cache.takeChanged() == {"!a:matrix.org", "!b:matrix.org"}
+        assert cache.takeChanged() == set()
+
+        cache.resize("!b:matrix.org")
+        cache.resize("!nope:matrix.org")
+        assert cache.takeChanged() == {"!b:matrix.org"}
+
+    def test_counters(self):
+        """Test hits, misses and removals are counted"""
+        cache = RoomCache()
+        cache["!a:matrix.org"] = _room("!a")
+        cache.get("!a:matrix.org")
+        cache.get("!nope:matrix.org")
+        assert "!nope:matrix.org" not in cache  # membership checks don't count
+        assert cache.discard("!a:matrix.org")
+        assert not cache.discard("!a:matrix.org")
+
+        stats = cache.stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["removals"] == 1
+        assert stats["rooms"] == 0
+        assert stats["bytes"] == 0
+
+
+class TestClientRoomCache:
+    """Test the client uses the bounded cache"""
+
+    @pytest.mark.asyncio
+    async def test_limits_passed_through(self, mock_client):
+        client = mock_client(runner={"joinedRooms_async": AsyncMock(return_value=["!a:matrix.org", "!b:matrix.org"]),
+                                     "getRoomState_async": AsyncMock(return_value=[])}, roomCacheMaxRooms=1)
+
+        await client._roomcacheinit_async()
+
+        assert isinstance(client.roomCache["rooms"], RoomCache)
+        assert len(client.roomCache["rooms"]) == 1
+
+    @pytest.mark.asyncio
+    async def test_evicted_on_leave(self):
+        """Test leaving a room drops it from the cache"""
+        client = Client()
+        client.roomCache = {"rooms": client._newRoomCache()}
+        client.roomCache["rooms"]["!a:matrix.org"] = _room("!a:matrix.org")
+        client.firstSync = False
+
+        await client._dispatchSync({"next_batch": "s1", "rooms": {"leave": {"!a:matrix.org": {}}}}, None)
+
+        assert "!a:matrix.org" not in client.roomCache["rooms"]
+        assert client.roomCache["rooms"].removals == 1
+
+
+class TestSingleFlight:
+    """Test coalesced calls"""
+
+    @pytest.mark.asyncio
+    async def test_concurrent_calls_share_one(self):
+        flight = SingleFlight()
+        release = asyncio.Event()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await release.wait()
+            return "state"
+
+        waiters = [asyncio.ensure_future(flight.do("!a", fetch)) for _ in range(5)]
+        await asyncio.sleep(0)
+        assert flight.inFlight("!a")
+        release.set()
+
+        assert await asyncio.gather(*waiters) == ["state"] * 5
+        assert len(calls) == 1
+        assert not flight.inFlight("!a")
+
+    @pytest.mark.asyncio
+    async def test_errors_shared(self):
+        flight = SingleFlight()
+
+        async def fetch():
+            await asyncio.sleep(0)
+            raise RuntimeError("down")
+
+        results = await asyncio.gather(flight.do("!a", fetch), flight.do("!a", fetch), return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+
+    @pytest.mark.asyncio
+    async def test_waiter_timeout_keeps_call_running(self):
+        """Test one waiter timing out doesn't cancel the fetch for the others"""
+        flight = SingleFlight()
+
+        async def fetch():
+            await asyncio.sleep(0.05)
+            return "state"
+
+        other = asyncio.ensure_future(flight.do("!a", fetch))
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(flight.do("!a", fetch), 0.01)
+        assert await other == "state"
+
+
+class TestNegativeCache:
+    """Test failure backoff"""
+
+    def test_backoff_doubles(self):
+        failures = NegativeCache(baseTTL=5, maxTTL=12)
+        with patch("halcyon.roomcache.time.monotonic", return_value=100):
+            assert failures.failed("!a") == 5
+            assert failures.blocked("!a")
+            assert failures.failed("!a") == 10
+            assert failures.failed("!a") == 12
+        with patch("halcyon.roomcache.time.monotonic", return_value=113):
+            assert not failures.blocked("!a")
+
+        failures.succeeded("!a")
+        assert len(failures) == 0
+
+    def test_stale_failures_forgotten(self):
+        failures = NegativeCache(baseTTL=5, maxTTL=12)
+        with patch("halcyon.roomcache.time.monotonic", return_value=100):
+            failures.failed("!a")
+            failures.failed("!a")
+        with patch("halcyon.roomcache.time.monotonic", return_value=200):
+            assert failures.failed("!a") == 5
+            assert not failures.blocked("!b")
+            for n in range(100):
+                failures.failed("!room" + str(n))
+        with patch("halcyon.roomcache.time.monotonic", return_value=300):
+            assert not failures.blocked("!a")
+            assert len(failures) == 100
+            failures.failed("!new")
+            for n in range(27):
+                failures.failed("!more" + str(n))
+        assert len(failures) == 28
+
+
+class TestCoalescedFills:
+    """Test the client shares room fetches and backs off broken rooms"""
+
+    @pytest.mark.asyncio
+    async def test_concurrent_misses_one_fetch(self, mock_client):
+        release = asyncio.Event()
+
+        async def getRoomState(roomID):
+            await release.wait()
+            return []
+
+        getRoomState = AsyncMock(side_effect=getRoomState)
+        client = mock_client(rooms=RoomCache(), runner={"getRoomState_async": getRoomState})
+
+        waiters = [asyncio.ensure_future(client._getRoom_async("!a:matrix.org")) for _ in range(10)]
+        await asyncio.sleep(0)
+        release.set()
+        rooms = await asyncio.gather(*waiters)
+
+        assert getRoomState.call_count == 1
+        assert all(r.id == "!a:matrix.org" for r in rooms)
+
+    @pytest.mark.asyncio
+    async def test_failure_negatively_cached(self, mock_client):
+        getRoomState = AsyncMock(side_effect=RuntimeError("down"))
+        client = mock_client(rooms=RoomCache(), runner={"getRoomState_async": getRoomState})
+
+        for _ in range(5):
+            assert (await client._getRoom_async("!broken:matrix.org")).id is None
+        assert getRoomState.call_count == 1
+
+        #once the backoff is up it's tried again, and success clears it
+        client.roomFailures._failures["!broken:matrix.org"] = (0, 1)
+        getRoomState.side_effect = None
+        getRoomState.return_value = []
+        assert (await client._getRoom_async("!broken:matrix.org")).id == "!broken:matrix.org"
+        assert len(client.roomFailures) == 0
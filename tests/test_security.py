@@ -1,6 +1,7 @@
 import pytest
 import halcyon
-from halcyon.security import configure_security, get_security_mode, get_custom_security_settings
+from halcyon.security import configure_security, get_security_mode, get_custom_security_settings, is_trusted, get_security_snapshot
+from halcyon.enums import msgType
 from halcyon.message import MessageContent, Message
 
 
@@ -239,4 +240,125 @@ class TestSecurityModeTransitions:
         
         # Verify lax mode is active
         content = MessageContent({'msgtype': 'm.text', 'body': 'Hello', 'extra': 'stored'})
-        assert content.extra == 'stored'
\ No newline at end of file
+        assert content.extra == 'stored'
+
+class TestTrustedModels:
+    """Test building models without validation"""
+    
+    def setup_method(self):
+        configure_security('strict')
+    
+    def teardown_method(self):
+        configure_security('strict')
+    
+    def test_same_models_as_validated(self, sample_image_event, sample_room_create_events):
+        """Test trusted construction gives the same Message and Room trees"""
+        from halcyon.room import room
+        validatedMessage = Message(sample_image_event).model_dump()
+        validatedRoom = room(sample_room_create_events, "!test:matrix.org").model_dump()
+        
+        configure_security('strict', trusted=True)
+        assert is_trusted() is True
+        msg = Message(sample_image_event)
+        assert msg.model_dump() == validatedMessage
+        assert msg.content.type == msgType.IMAGE
+        assert room(sample_room_create_events, "!test:matrix.org").model_dump() == validatedRoom
+    
+    def test_skips_validation(self):
+        """Test bad data goes through as is instead of raising"""
+        configure_security('strict', trusted=True)
+        content = MessageContent({'msgtype': 'm.text', 'body': 5, 'extra': 'ignored'})
+        assert content.body == 5
+        assert not hasattr(content, 'extra')
+    
+    def test_lax_extras(self):
+        """Test unknown fields are still kept in lax mode"""
+        configure_security('lax', trusted=True)
+        content = MessageContent({'msgtype': 'm.text', 'body': 'Hello', 'extra': 'stored'})
+        assert content.extra == 'stored'
+    
+    def test_client_option(self):
+        """Test the client turns it on, and reconfiguring turns it off again"""
+        halcyon.Client(trusted_models=True)
+        assert is_trusted() is True
+        configure_security('strict')
+        assert is_trusted() is False
+
+
+class TestSecuritySnapshot:
+    """Test the immutable security snapshot and the model variants compiled for it"""
+    
+    def setup_method(self):
+        configure_security('strict')
+    
+    def teardown_method(self):
+        configure_security('strict')
+    
+    def test_snapshot_is_swapped(self):
+        """Test reconfiguring builds a new snapshot and leaves the old one alone"""
+        import dataclasses
+        assert configure_security('strict') == 'strict'
+        old = get_security_snapshot()
+        assert configure_security('lax', trusted=True) == 'lax'
+        new = get_security_snapshot()
+        assert (old.mode, old.trusted) == ('strict', False)
+        assert (new.mode, new.trusted, new.lax) == ('lax', True, True)
+        with pytest.raises(dataclasses.FrozenInstanceError):
+            new.mode = 'strict'
+    
+    def test_variants_are_cached(self):
+        """Test a class is compiled once per snapshot"""
+        configure_security('lax')
+        snapshot = get_security_snapshot()
+        variant = Message.variant(snapshot)
+        assert variant is Message.variant(snapshot)
+        assert variant.variant(snapshot) is variant
+        assert issubclass(variant, Message)
+        assert variant.model_config['extra'] == 'allow'
+        assert variant.model_config['arbitrary_types_allowed'] is True
+        configure_security('strict')
+        assert Message.variant(get_security_snapshot()) is not variant
+    
+    def test_variant_ignores_global_mode(self):
+        """Test variants, and the models nested in them, keep their snapshot's mode after reconfiguring"""
+        configure_security('lax')
+        lax = get_security_snapshot()
+        configure_security('strict')
+        strict = get_security_snapshot()
+        event = {'type': 'm.room.message', 'content': {'msgtype': 'm.text', 'body': 'Hello', 'extra': 'stored'}}
+        
+        assert Message.variant(lax)(event).content.extra == 'stored'
+        configure_security('lax')
+        assert not hasattr(Message.variant(strict)(event).content, 'extra')
+    
+    def test_client_builds_from_its_snapshot(self):
+        """Test a client keeps building with its own mode when the global one changes"""
+        client = halcyon.Client(security_mode='lax', lazyMessages=True)
+        configure_security('strict')
+        msg = client._messageClass({'type': 'm.room.message', 'content': {'msgtype': 'm.text', 'body': 'Hi', 'extra': 1}})
+        assert client.security.lax
+        assert msg.content.extra == 1
+    
+    def test_no_lock_when_building(self, monkeypatch, sample_image_event):
+        """Test building models only reads the snapshot"""
+        from halcyon import security
+        from halcyon.room import room
+        
+        class NoLock:
+            def __enter__(self):
+                raise AssertionError("lock taken")
+            
+            def __exit__(self, *args):
+                return False
+        
+        monkeypatch.setattr(security._security_config, '_lock', NoLock())
+        assert Message(sample_image_event).content.body
+        assert room([{'type': 'm.room.name', 'state_key': '', 'content': {'name': 'Room'}}]).name == 'Room'
+    
+    def test_pickle_variant(self, sample_image_event):
+        """Test a variant pickles, and comes back as the class itself"""
+        import pickle
+        msg = Message.variant(get_security_snapshot())(sample_image_event)
+        loaded = pickle.loads(pickle.dumps(msg))
+        assert type(loaded) is Message
+        assert loaded.model_dump() == msg.model_dump()
@@ -0,0 +1,209 @@
+import pytest
+import asyncio
+import threading
+from unittest.mock import Mock, AsyncMock
+from halcyon.room import room
+from halcyon.roomcache import RoomCache
+from halcyon.snapshot import RoomSnapshot, FileRoomSnapshotStore, SQLiteRoomSnapshotStore
+
+
+def _state(name):
+    return [
+        {"type": "m.room.create", "state_key": "", "content": {"creator": "@admin:matrix.org"}},
+        {"type": "m.room.name", "state_key": "", "content": {"name": name}},
+    ]
+
+
+def _snapshot():
+    return RoomSnapshot("s_old", {"!a:matrix.org": _state("Room A"), "!b:matrix.org": _state("Room B")})
+
+
+class TestSnapshotStores:
+    """Test the built in room snapshot stores"""
+
+    def test_file_store_round_trip(self, tmp_path):
+        """Test the file store keeps the token and every room, for one account"""
+        path = str(tmp_path / "state" / "rooms.snapshot")
+        store = FileRoomSnapshotStore(path)
+        assert store.load("@bot:matrix.org") is None
+
+        store.save("@bot:matrix.org", _snapshot())
+
+        loaded = FileRoomSnapshotStore(path).load("@bot:matrix.org")
+        assert loaded.token == "s_old"
+        assert loaded.rooms == _snapshot().rooms
+        assert FileRoomSnapshotStore(path).load("@other:matrix.org") is None
+
+    def test_file_store_corrupt(self, tmp_path):
+        """Test a corrupt file is treated as no snapshot"""
+        path = tmp_path / "rooms.snapshot"
+        path.write_bytes(b"garbage")
+        assert FileRoomSnapshotStore(str(path)).load("@bot:matrix.org") is None
+
+    def test_sqlite_store_round_trip(self, tmp_path):
+        """Test the sqlite store keeps snapshots across connections, dropping rooms that are no longer cached"""
+        path = str(tmp_path / "state.db")
+        store = SQLiteRoomSnapshotStore(path)
+        store.save("@bot:matrix.org", _snapshot())
+        store.save("@bot:matrix.org", RoomSnapshot("s_new", {"!a:matrix.org": _state("Renamed")}))
+        store.close()
+
+        reopened = SQLiteRoomSnapshotStore(path)
+        loaded = reopened.load("@bot:matrix.org")
+        assert loaded.token == "s_new"
+        assert loaded.rooms == {"!a:matrix.org": _state("Renamed")}
+        assert reopened.load("@nobody:matrix.org") is None
+        reopened.close()
+
+    def test_sqlite_store_writes_changed_rooms(self):
+        """Test only changed rooms, and rooms it doesn't have yet, are written"""
+        store = SQLiteRoomSnapshotStore(":memory:")
+        store.save("@bot:matrix.org", RoomSnapshot("s1", {"!a:matrix.org": _state("Room A")}))
+
+        rooms = {"!a:matrix.org": _state("Unsaved"), "!b:matrix.org": _state("Room B"), "!c:matrix.org": _state("Room C")}
+        store.save("@bot:matrix.org", RoomSnapshot("s2", rooms, changed={"!c:matrix.org"}))
+
+        loaded = store.load("@bot:matrix.org")
+        assert loaded.token == "s2"
+        assert loaded.rooms == {"!a:matrix.org": _state("Room A"), "!b:matrix.org": _state("Room B"), "!c:matrix.org": _state("Room C")}
+        store.close()
+
+
+class TestClientSnapshot:
+    """Test loading and saving the room cache snapshot"""
+
+    @pytest.mark.asyncio
+    async def test_loads_and_catches_up(self, mock_client):
+        """Test rooms come from the snapshot, then the catch up sync applies changes, joins and leaves"""
+        store = SQLiteRoomSnapshotStore(":memory:")
+        store.save("@bot:matrix.org", _snapshot())
+        resp = {
+            "next_batch": "s_now",
+            "rooms": {
+                "join": {
+                    "!a:matrix.org": {"state": {"events": [{"type": "m.room.name", "state_key": "", "content": {"name": "Renamed"}}]}},
+                    "!c:matrix.org": {"state": {"events": _state("Room C")}},
+                },
+                "leave": {"!b:matrix.org": {}},
+            },
+        }
+        client = mock_client(runner={"sync_async": AsyncMock(return_value=resp)}, roomCacheSnapshot=store)
+
+        await client._roomcacheinit_async()
+
+        assert client.roomCache["rooms"]["!a:matrix.org"].name == "Renamed"
+        assert client.roomCache["rooms"]["!c:matrix.org"].name == "Room C"
+        assert "!b:matrix.org" not in client.roomCache["rooms"]
+        assert client.restrunner.sync_async.call_args.kwargs["since"] == "s_old"
+        client.restrunner.getRoomState_async.assert_not_called()
+        client.restrunner.joinedRooms_async.assert_not_called()
+        assert client.sinceToken == "s_now"
+        assert client.firstSync is False
+
+    @pytest.mark.asyncio
+    async def test_falls_back_when_catch_up_fails(self, mock_client):
+        """Test a snapshot the server can't sync from is thrown away, and the cache is fetched as usual"""
+        store = SQLiteRoomSnapshotStore(":memory:")
+        store.save("@bot:matrix.org", _snapshot())
+        client = mock_client(runner={"sync_async": AsyncMock(return_value={"errcode": "M_UNKNOWN"})}, roomCacheSnapshot=store)
+        client.restrunner.joinedRooms_async = AsyncMock(return_value=["!c:matrix.org"])
+        client.restrunner.getRoomState_async = AsyncMock(return_value=_state("Room C"))
+
+        await client._roomcacheinit_async()
+
+        assert set(client.roomCache["rooms"]) == {"!c:matrix.org"}
+        assert client.sinceToken == ""
+
+    @pytest.mark.asyncio
+    async def test_saves_cache_with_token(self, mock_client, tmp_path):
+        """Test the saved snapshot has every cached room and the token of the last processed sync"""
+        store = FileRoomSnapshotStore(str(tmp_path / "rooms.snapshot"))
+        client = mock_client(roomCacheSnapshot=store)
+        client.roomCache["rooms"] = RoomCache()
+        client.roomCache["rooms"]["!a:matrix.org"] = room(rawEvents=_state("Room A"), roomID="!a:matrix.org")
+        client.firstSync = False
+
+        await client._processSync({"next_batch": "s_2", "rooms": {"join": {"!a:matrix.org": {
+            "timeline": {"events": [{"type": "m.room.name", "state_key": "", "content": {"name": "Renamed"}}]}}}}})
+        await client._saveRoomCacheSnapshot()
+
+        loaded = store.load("@bot:matrix.org")
+        assert loaded.token == "s_2"
+        assert room(rawEvents=loaded.rooms["!a:matrix.org"]).name == "Renamed"
+
+    @pytest.mark.asyncio
+    async def test_nothing_saved_before_first_sync(self, mock_client):
+        """Test there's no snapshot until the cache is tied to a token"""
+        store = Mock()
+        client = mock_client(roomCacheSnapshot=store)
+        client.roomCache["rooms"] = RoomCache()
+
+        await client._saveRoomCacheSnapshot()
+        store.save.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_saves_changed_rooms(self, mock_client):
+        """Test a save only marks the rooms stored or changed since the one before as changed"""
+        store = Mock()
+        client = mock_client(roomCacheSnapshot=store)
+        client.roomCache["rooms"] = RoomCache()
+        client.roomCache["rooms"]["!a:matrix.org"] = room(rawEvents=_state("Room A"), roomID="!a:matrix.org")
+        client.roomCache["rooms"]["!b:matrix.org"] = room(rawEvents=_state("Room B"), roomID="!b:matrix.org")
+        client.firstSync = False
+        client._roomCacheToken = "s_1"
+
+        await client._saveRoomCacheSnapshot()
+        assert store.save.call_args.args[1].changed == {"!a:matrix.org", "!b:matrix.org"}
+
+        await client._processSync({"next_batch": "s_2", "rooms": {"join": {"!b:matrix.org": {
+            "timeline": {"events": [{"type": "m.room.name", "state_key": "", "content": {"name": "Renamed"}}]}}}}})
+        await client._saveRoomCacheSnapshot()
+        assert store.save.call_args.args[1].changed == {"!b:matrix.org"}
+        assert set(store.save.call_args.args[1].rooms) == {"!a:matrix.org", "!b:matrix.org"}
+
+    @pytest.mark.asyncio
+    async def test_failed_save_keeps_rooms_changed(self, mock_client):
+        """Test the rooms of a save that failed are written by the next one"""
+        store = Mock()
+        store.save.side_effect = [OSError("disk full"), None]
+        client = mock_client(roomCacheSnapshot=store)
+        client.roomCache["rooms"] = RoomCache()
+        client.roomCache["rooms"]["!a:matrix.org"] = room(rawEvents=_state("Room A"), roomID="!a:matrix.org")
+        client._roomCacheToken = "s_1"
+
+        await client._saveRoomCacheSnapshot()
+        await client._saveRoomCacheSnapshot()
+
+        assert store.save.call_args.args[1].changed == {"!a:matrix.org"}
+
+    @pytest.mark.asyncio
+    async def test_shutdown_waits_for_save_in_flight(self, mock_client):
+        """Test shutdown waits for a save the sync loop started, saves once more, then closes the store"""
+        calls = []
+        writing = threading.Event()
+        release = threading.Event()
+
+        def save(key, snapshot):
+            calls.append(("save", snapshot.token))
+            writing.set()
+            release.wait(1)
+
+        store = Mock(save=Mock(side_effect=save), close=Mock(side_effect=lambda: calls.append(("close", None))))
+        client = mock_client(runner={"_close_session": AsyncMock()}, roomCacheSnapshot=store)
+        client.loop = Mock()
+        client.roomCache["rooms"] = RoomCache()
+        client._roomCacheToken = "s_1"
+
+        #the sync loop is cancelled part way through a save
+        periodic = asyncio.ensure_future(client._saveRoomCacheSnapshot())
+        await asyncio.get_running_loop().run_in_executor(None, writing.wait, 1)
+        periodic.cancel()
+        client._roomCacheToken = "s_2"
+
+        shutdown = asyncio.ensure_future(client._async_destruction())
+        await asyncio.sleep(0.05)
+        assert calls == [("save", "s_1")]
+
+        release.set()
+        await shutdown
+        assert calls == [("save", "s_1"), ("save", "s_2"), ("close", None)]
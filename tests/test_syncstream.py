@@ -0,0 +1,223 @@
+import pytest
+import json
+import aiohttp
+from unittest.mock import Mock, AsyncMock, patch
+from halcyon.restrunner import Runner
+from halcyon.room import room
+from halcyon.syncstream import SyncStreamDecoder, decodeSyncStream
+
+
+def _sample_sync():
+    return {
+        "next_batch": "s72595_4483_1934",
+        "presence": {"events": [{"type": "m.presence", "content": {"status_msg": "quote \" and slash \\"}}]},
+        "rooms": {
+            "join": {
+                "!a:matrix.org": {"timeline": {"events": [
+                    {"type": "m.room.message", "content": {"body": "braces } { ] [ , : inside strings"}}
+                ]}},
+                "!b\"odd:matrix.org": {"state": {"events": []}, "numbers": [1, 2.5, True, None]},
+            },
+            "invite": {"!c:matrix.org": {"invite_state": {"events": []}}},
+            "leave": {},
+        },
+        "device_one_time_keys_count": {"signed_curve25519": 5},
+    }
+
+
+def _rebuild(rooms, skeleton):
+    full = dict(skeleton)
+    full["rooms"] = dict(skeleton["rooms"])
+    full["rooms"]["join"] = dict(rooms)
+    return full
+
+
+class TestSyncStreamDecoder:
+    """Test the incremental /sync decoder"""
+
+    @pytest.mark.parametrize("chunkSize", [1, 2, 7, 64, 100000])
+    def test_matches_json_loads(self, chunkSize):
+        """Test any chunking gives the same result as decoding it whole"""
+        resp = _sample_sync()
+        body = json.dumps(resp, indent=2, ensure_ascii=False).encode("utf-8")
+
+        rooms, skeleton = decodeSyncStream(body[i:i + chunkSize] for i in range(0, len(body), chunkSize))
+
+        assert _rebuild(rooms, skeleton) == resp
+        assert skeleton["rooms"]["join"] == {}
+        assert skeleton["next_batch"] == "s72595_4483_1934"
+
+    @pytest.mark.parametrize("chunkSize", [1, 3, 50, 100000])
+    def test_deeply_nested_room(self, chunkSize):
+        """Test values nested deeper than the skip regex handles, with brackets and escapes in strings"""
+        room = {"content": {"a": [[{"b": [[[["] } \\\" {"]]]]}]], "c": "tail"}, "next": [{}, [], "]"]}
+        resp = {"rooms": {"join": {"!deep:matrix.org": room, "!flat:matrix.org": {}}}, "next_batch": "s2"}
+        body = json.dumps(resp).encode("utf-8")
+
+        rooms, skeleton = decodeSyncStream(body[i:i + chunkSize] for i in range(0, len(body), chunkSize))
+
+        assert rooms == [("!deep:matrix.org", room), ("!flat:matrix.org", {})]
+        assert skeleton["next_batch"] == "s2"
+
+    def test_rooms_come_out_as_they_finish(self):
+        """Test a room is handed out before the rest of the body arrives"""
+        resp = _sample_sync()
+        body = json.dumps(resp).encode("utf-8")
+        cut = body.index(b'"!b')
+
+        decoder = SyncStreamDecoder()
+        first = decoder.feed(body[:cut])
+        assert [roomID for roomID, _ in first] == ["!a:matrix.org"]
+
+        second = decoder.feed(body[cut:])
+        assert [roomID for roomID, _ in second] == ['!b"odd:matrix.org']
+        assert decoder.close()["next_batch"] == "s72595_4483_1934"
+
+    def test_buffer_only_holds_current_room(self):
+        """Test finished rooms are dropped from the buffer"""
+        resp = {"rooms": {"join": {"!r" + str(i) + ":matrix.org": {"timeline": {"events": [{"body": "x" * 1000}]}} for i in range(50)}}, "next_batch": "s1"}
+        body = json.dumps(resp).encode("utf-8")
+
+        decoder = SyncStreamDecoder()
+        peak = 0
+        for i in range(0, len(body), 512):
+            decoder.feed(body[i:i + 512])
+            peak = max(peak, len(decoder._buf))
+
+        assert decoder.roomCount == 50
+        assert peak < 2000
+        assert len(body) > 50000
+
+    def test_truncated_body(self):
+        """Test a body that stops part way is an error"""
+        body = json.dumps(_sample_sync()).encode("utf-8")
+        decoder = SyncStreamDecoder()
+        decoder.feed(body[:len(body) // 2])
+
+        with pytest.raises(ValueError):
+            decoder.close()
+
+    def test_no_rooms(self):
+        """Test a response without rooms"""
+        rooms, skeleton = decodeSyncStream([b'{"next_batch": "s1", "rooms": null}'])
+        assert rooms == []
+        assert skeleton["next_batch"] == "s1"
+
+
+class _FakeStreamResponse:
+    def __init__(self, status, chunks=(), failAfter=None):
+        self.status = status
+        self.chunks = chunks
+        self.failAfter = failAfter
+        self.content = self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(Mock(), (), status=self.status)
+
+    async def iter_chunked(self, size):
+        for i, chunk in enumerate(self.chunks):
+            if i == self.failAfter:
+                raise aiohttp.ClientPayloadError("connection dropped")
+            yield chunk
+
+
+def _streamRunner(*responses):
+    with patch.object(Runner, "_wellknownLookup", return_value={"m.homeserver": {"base_url": "https://matrix.org"}}):
+        runner = Runner("matrix.org", user_id="@bot:matrix.org", access_token="token")
+    session = Mock()
+    session.get = Mock(side_effect=list(responses))
+    runner._ensure_session = AsyncMock(return_value=session)
+    return runner, session
+
+
+class TestRunnerStreamedSync:
+    """Test the streamed /sync request retries like the other requests"""
+
+    @pytest.mark.asyncio
+    async def test_retries_before_first_room(self):
+        """Test a failed response is retried with backoff"""
+        body = json.dumps(_sample_sync()).encode("utf-8")
+        runner, session = _streamRunner(_FakeStreamResponse(502), _FakeStreamResponse(200, [body]))
+
+        with patch("halcyon.restrunner.asyncio.sleep", new=AsyncMock()) as sleep:
+            items = [item async for item in runner.sync_stream_async()]
+
+        assert session.get.call_count == 2
+        assert sleep.await_count == 1
+        assert [roomID for kind, roomID, _ in items if kind == "join"] == ["!a:matrix.org", '!b"odd:matrix.org']
+        assert items[-1][2]["next_batch"] == "s72595_4483_1934"
+
+    @pytest.mark.asyncio
+    async def test_no_retry_once_rooms_were_handed_out(self):
+        """Test a connection dropped part way raises instead of handing the same rooms out twice"""
+        body = json.dumps(_sample_sync()).encode("utf-8")
+        cut = body.index(b'"!b')
+        runner, session = _streamRunner(_FakeStreamResponse(200, [body[:cut], body[cut:]], failAfter=1))
+
+        seen = []
+        with patch("halcyon.restrunner.asyncio.sleep", new=AsyncMock()):
+            with pytest.raises(aiohttp.ClientPayloadError):
+                async for kind, roomID, _ in runner.sync_stream_async():
+                    seen.append(roomID)
+
+        assert seen == ["!a:matrix.org"]
+        assert session.get.call_count == 1
+
+
+class TestClientStreamedSync:
+    """Test the client dispatches from the streamed decoder"""
+
+    @pytest.mark.asyncio
+    async def test_streamed_sync_dispatches(self, mock_client, sample_message_event):
+        """Test rooms are dispatched and the token taken from the tail of the stream"""
+        client = mock_client(rooms={roomID: room(roomID=roomID) for roomID in ("!a:matrix.org", "!b:matrix.org")}, ignoreFirstSync=False, streamSync=True)
+
+        async def fake_stream(**kwargs):
+            yield ("join", "!a:matrix.org", {"timeline": {"events": [sample_message_event]}})
+            yield ("join", "!b:matrix.org", {"timeline": {"events": [sample_message_event]}})
+            yield ("sync", None, {"next_batch": "s9", "rooms": {"join": {}, "leave": {"!gone:matrix.org": {}}}})
+
+        client.restrunner.sync_stream_async = fake_stream
+        seen = []
+
+        @client.event
+        async def on_message(message):
+            seen.append(message.event.id)
+
+        @client.event
+        async def on_room_leave(roomID):
+            seen.append(roomID)
+
+        await client._homeserverSync()
+
+        assert seen == ["$tBqxdcM:matrix.org", "$tBqxdcM:matrix.org", "!gone:matrix.org"]
+        assert client.sinceToken == "s9"
+
+    @pytest.mark.asyncio
+    async def test_streamed_first_sync_ignored(self, mock_client, sample_message_event):
+        """Test ignoreFirstSync still skips the first streamed sync"""
+        client = mock_client(rooms={}, streamSync=True)
+
+        async def fake_stream(**kwargs):
+            yield ("join", "!a:matrix.org", {"timeline": {"events": [sample_message_event]}})
+            yield ("sync", None, {"next_batch": "s1"})
+
+        client.restrunner.sync_stream_async = fake_stream
+        seen = []
+
+        @client.event
+        async def on_message(message):
+            seen.append(message)
+
+        await client._homeserverSync()
+
+        assert seen == []
+        assert client.firstSync is False
+        assert client.sinceToken == "s1"